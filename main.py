@@ -0,0 +1,104 @@
+"""
+One entry point for the pipeline scripts.
+
+    python main.py <command> [hydra overrides ...]
+    python main.py score-inter workers.max_workers=8 timing.enabled=True
+
+Every command runs the Hydra `main` of one script, from that script's
+directory, so its config and relative paths are the ones the script was
+written for. This is the way to run the scripts: they import each other as
+`src.*` modules, which needs the repo root on the path.
+
+Only the command's own module is imported, so DeepFace, TensorFlow,
+mediapipe and the Azure SDKs are only loaded by commands that use them, and
+Azure credentials are only created once a command talks to Azure.
+
+This file keeps to the standard library at module level: process pools
+spawn their workers, and a spawned worker imports the entry point again
+before it runs any task.
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# command: (script, help)
+COMMANDS = {
+    "download": ("src/data/selfies.py", "download the selfies of the configured users"),
+    "repair-missing": ("src/data/missing_selfies.py", "download the selfies missing from earlier downloads"),
+    "greenlight": ("src/process/greenlight_selfies.py", "run the face landmark quality checks"),
+    "embed": ("src/process/embeddings.py", "compute and save the face embeddings"),
+    "score-intra": ("src/process/deepface_intra.py", "score selfies of the same user"),
+    "score-inter": ("src/process/deepface_inter.py", "score latest selfies between users"),
+    "report": ("src/data/results.py", "convert the score csvs to datasets and print their stats"),
+    "harness": ("src/data/harness.py", "write the synthetic datalake and fake blob templates"),
+    "pack-shards": ("src/data/shards.py", "pack the downloaded selfies into shard files"),
+    "decode-accuracy": ("src/process/decode_accuracy.py", "compare reduced resolution decodes with full ones"),
+    "landmark-geometry": ("src/process/landmark_geometry.py", "score users on their landmark mesh shapes"),
+    "retrieve": ("src/process/retrieval.py", "shortlist and re-rank inter user pairs, or measure recall"),
+    "search": ("src/process/search.py", "find the nearest users within partitions"),
+    "null": ("src/process/null_distribution.py", "permutation null distributions of the user ids"),
+    "check-symmetry": ("src/process/check_commutativity.py", "score sampled pairs in both directions"),
+    "quantize": ("src/process/quantization.py", "write compact embedding copies and their accuracy report"),
+    "incremental": ("src/process/incremental.py", "score only new and changed users since the last run"),
+    "backend-parity": ("src/process/backends.py", "export models to ONNX and compare them with TensorFlow"),
+    "calibrate": ("src/process/calibration.py", "choose verification thresholds from genuine and impostor scores"),
+    "benchmark": ("src/benchmarks/run_benchmarks.py", "time the hot paths on a fixed sample"),
+    "contact-sheets": ("src/visualization/contact_sheets.py", "render contact sheets of lookalike pairs"),
+}
+
+
+def module_name(script: Path) -> str:
+    """Scripts import each other as `src.*` modules, so each is imported by its dotted path."""
+    return ".".join(script.relative_to(ROOT).with_suffix("").parts)
+
+
+def load_command(command: str):
+    """
+    Import the command's module from the repo root and return its Hydra
+    `main` and the seconds the import took. The working directory becomes
+    the script's own, which its relative paths ("../../results") expect.
+    """
+    script = ROOT / COMMANDS[command][0]
+    os.chdir(script.parent)
+    if ROOT.as_posix() not in sys.path:
+        sys.path.insert(0, ROOT.as_posix())
+    t0 = time.perf_counter()
+    module = importlib.import_module(module_name(script))
+    return module.main, time.perf_counter() - t0
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    """
+    The command, and everything after it as Hydra's own arguments, so flags
+    such as `--multirun` or `--cfg job` reach Hydra instead of argparse.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, (script, help) in COMMANDS.items():
+        subparser = subparsers.add_parser(command, help=help, description=f"{help} ({script})")
+        subparser.add_argument("overrides", nargs="*", help="hydra overrides and flags")
+    args = parser.parse_args(argv[:1])
+    args.overrides = list(argv[1:])
+    return args
+
+
+def main(argv: list | None = None) -> None:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    hydra_main, import_seconds = load_command(args.command)
+    print(f"Imported {args.command} in {import_seconds:.2f} s")
+    script = ROOT / COMMANDS[args.command][0]
+    # Hydra reads its overrides from sys.argv. An imported (not __main__)
+    # script's config_path would resolve against its package, so pass the
+    # config dir the scripts' "../../config" points to
+    sys.argv = [script.as_posix(), f"--config-path={ROOT / 'config'}", *args.overrides]
+    hydra_main()
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
@@ -0,0 +1,311 @@
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import combinations
+from pathlib import Path
+from typing import Callable
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.data.fake_blob import FakeBlobContainer, synthetic_selfie, write_blob
+from src.data.registry import path_key
+
+log = logging.getLogger(__name__)
+
+
+def timings(fn: Callable, items: list, warmup: int = 1) -> dict:
+    """Call `fn` on every item and summarise the per item wall times."""
+    for item in items[:warmup]:
+        fn(item)
+    seconds = []
+    for item in items:
+        t0 = time.perf_counter()
+        fn(item)
+        seconds.append(time.perf_counter() - t0)
+    seconds = np.asarray(seconds)
+    return {
+        "n": len(seconds),
+        "total_s": float(seconds.sum()),
+        "p50_ms": float(np.percentile(seconds, 50) * 1000),
+        "p95_ms": float(np.percentile(seconds, 95) * 1000),
+        "items_per_s": float(len(seconds) / seconds.sum()) if seconds.sum() else float("inf"),
+    }
+
+
+def wall_time(fn: Callable, n_items: int) -> dict:
+    """Time one call that processes `n_items` together (thread pools, matrix products)."""
+    t0 = time.perf_counter()
+    fn()
+    total = time.perf_counter() - t0
+    return {"n": n_items, "total_s": total, "items_per_s": n_items / total if total else float("inf")}
+
+
+def sample_selfies(cfg: DictConfig, work_dir: Path) -> list:
+    """Real selfies when `benchmarks.selfies_dir` is set, generated ones otherwise."""
+    if cfg.benchmarks.selfies_dir:
+        paths = sorted(Path(cfg.benchmarks.selfies_dir).glob("*/*.jpg"))
+        rng = np.random.default_rng(cfg.benchmarks.seed)
+        picks = rng.choice(len(paths), size=min(cfg.benchmarks.n_images, len(paths)), replace=False)
+        return [paths[i] for i in sorted(picks)]
+    rng = np.random.default_rng(cfg.benchmarks.seed)
+    paths = []
+    for i in range(cfg.benchmarks.n_images):
+        path = work_dir / "selfies" / str(1000 + i % 20) / f"2023-01-{1 + i // 20:02d}_{i:06d}.jpg"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        synthetic_selfie(rng).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def bench_download(cfg: DictConfig, paths: list, work_dir: Path) -> dict:
+    from src.data import selfies
+
+    container = FakeBlobContainer(
+        work_dir / "blobs", latency=cfg.benchmarks.blob_latency, synthetic=False
+    )
+    rows = []
+    for i, path in enumerate(paths):
+        user_id, (date, selfie_link_id) = path.parent.name, path.stem.split("_")
+        write_blob(container.root, "selfies", f"{date}/{user_id}/{i}.jpg", path.read_bytes())
+        rows.append(
+            {
+                "user_id": int(user_id),
+                "full_path": f"/blob/selfies/{date}/{user_id}/{i}.jpg",
+                "selfie_link_id": selfie_link_id,
+            }
+        )
+    fake_blobs = selfies.fake_blobs
+    selfies.fake_blobs = container
+    try:
+        save_dir = work_dir / "downloaded"
+        return {
+            **wall_time(lambda: selfies.get_selfies(pd.DataFrame(rows), save_dir), len(rows)),
+            "blob_latency_s": cfg.benchmarks.blob_latency,
+        }
+    finally:
+        selfies.fake_blobs = fake_blobs
+
+
+def bench_validate(cfg: DictConfig, paths: list, work_dir: Path) -> dict:
+    from src.process.greenlight_selfies import validate_selfie
+
+    return timings(lambda path: validate_selfie(path.as_posix()), paths)
+
+
+def bench_landmarks(cfg: DictConfig, paths: list, work_dir: Path) -> dict:
+    from src.process.greenlight_selfies import get_landmarks
+
+    # get_landmarks reports failures as a status, which would time the error path
+    if not Path(cfg.benchmarks.landmarks_model_path).exists():
+        raise FileNotFoundError(f"No landmarker model at {cfg.benchmarks.landmarks_model_path}")
+    return timings(
+        lambda path: get_landmarks(path.as_posix(), cfg.benchmarks.landmarks_model_path), paths
+    )
+
+
+def bench_embeddings(cfg: DictConfig, paths: list, work_dir: Path) -> dict:
+    from src.process.embeddings import represent_selfie
+
+    return {
+        model: timings(lambda path: represent_selfie(path, model), paths)
+        for model in cfg.benchmarks.models
+    }
+
+
+def bench_verify_vs_matrix(cfg: DictConfig, paths: list, work_dir: Path) -> dict:
+    import deepface.DeepFace as dpf
+
+    from src.process.embeddings import pairwise_distances, represent_selfie
+
+    paths = paths[: cfg.benchmarks.n_pair_images]
+    pairs = list(combinations(paths, 2))
+    results = {}
+    for model in cfg.benchmarks.models:
+        verify = wall_time(
+            lambda: [
+                dpf.verify(
+                    img1_path=a.as_posix(),
+                    img2_path=b.as_posix(),
+                    model_name=model,
+                    detector_backend="mediapipe",
+                    enforce_detection=False,
+                    distance_metric="cosine",
+                )
+                for a, b in pairs
+            ],
+            len(pairs),
+        )
+
+        def embed_and_multiply():
+            matrix = np.stack([represent_selfie(path, model) for path in paths])
+            pairwise_distances(matrix, matrix, "cosine")
+
+        matrix = wall_time(embed_and_multiply, len(pairs))
+        results[model] = {
+            "verify_per_pair": verify,
+            "embedding_matrix": matrix,
+            "speedup": verify["total_s"] / matrix["total_s"],
+        }
+    return results
+
+
+def bench_result_writes(cfg: DictConfig, paths: list, work_dir: Path) -> dict:
+    from src.data.results import SCORE_DTYPES, convert_scores, scan_scores
+
+    rng = np.random.default_rng(cfg.benchmarks.seed)
+    n = cfg.benchmarks.n_score_rows
+    df_scores = pd.DataFrame(
+        {
+            "user1_id": rng.integers(0, 12_000, n),
+            "user2_id": rng.integers(0, 12_000, n),
+            "img1_path": [path_key(paths[i % len(paths)]) for i in range(n)],
+            "img2_path": [path_key(paths[-1 - i % len(paths)]) for i in range(n)],
+            "verified": rng.random(n) < 0.1,
+            "distance": rng.random(n),
+            "threshold": 0.4,
+            "model": rng.choice(["VGG-Face", "Facenet", "ArcFace"], n),
+            "detector_backend": "mediapipe",
+            "similarity_metric": rng.choice(["cosine", "euclidean_l2"], n),
+            "facial_areas": "{'img1': {}, 'img2': {}}",
+            "time": rng.random(n),
+        }
+    )
+    chunks = np.array_split(np.arange(n), cfg.benchmarks.n_write_chunks)
+    csv_path = work_dir / "scores.csv"
+
+    def append_csv():
+        # same append per result pattern as the scoring stages
+        for chunk in chunks:
+            df_scores.iloc[chunk].to_csv(
+                csv_path, index=False, mode="a", header=not csv_path.exists()
+            )
+
+    def read_csv_aggregate():
+        df = pd.read_csv(csv_path).astype(
+            {col: dtype for col, dtype in SCORE_DTYPES.items() if col in df_scores}
+        )
+        df.groupby(["model", "similarity_metric"])["distance"].agg(["mean", "std"])
+
+    dataset_dir = work_dir / "scores_dataset"
+
+    def read_dataset_aggregate():
+        df = scan_scores(dataset_dir).to_table(
+            columns=["model", "similarity_metric", "distance"]
+        ).to_pandas()
+        df.groupby(["model", "similarity_metric"], observed=True)["distance"].agg(["mean", "std"])
+
+    results = {"csv_append": wall_time(append_csv, n)}
+    results["columnar_convert"] = wall_time(lambda: convert_scores(csv_path, dataset_dir), n)
+    results["csv_read_aggregate"] = wall_time(read_csv_aggregate, n)
+    results["columnar_read_aggregate"] = wall_time(read_dataset_aggregate, n)
+    results["csv_bytes"] = csv_path.stat().st_size
+    results["columnar_bytes"] = sum(p.stat().st_size for p in dataset_dir.rglob("*.parquet"))
+    return results
+
+
+BENCHMARKS = {
+    "download": bench_download,
+    "validate": bench_validate,
+    "landmarks": bench_landmarks,
+    "embeddings": bench_embeddings,
+    "verify_vs_matrix": bench_verify_vs_matrix,
+    "result_writes": bench_result_writes,
+}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run_benchmarks(cfg: DictConfig) -> dict:
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "n_images": cfg.benchmarks.n_images,
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        paths = sample_selfies(cfg, work_dir)
+        for name in cfg.benchmarks.cases:
+            log.info(f"Running {name}")
+            try:
+                record["cases"][name] = BENCHMARKS[name](cfg, paths, work_dir)
+            except Exception as e:
+                # a missing model or optional dependency only skips its own case
+                log.info(f"Error: {e}")
+                record["cases"][name] = {"error": str(e)}
+    return record
+
+
+def _throughputs(cases: dict, prefix: str = "") -> dict:
+    flat = {}
+    for name, value in cases.items():
+        if isinstance(value, dict):
+            if "items_per_s" in value:
+                flat[f"{prefix}{name}"] = value["items_per_s"]
+            else:
+                flat.update(_throughputs(value, f"{prefix}{name}."))
+    return flat
+
+
+def compare(history: list, tolerance: float = 0.2) -> pd.DataFrame:
+    """Throughput of the latest run against the previous one; flags drops beyond `tolerance`."""
+    if len(history) < 2:
+        return pd.DataFrame()
+    previous, latest = _throughputs(history[-2]["cases"]), _throughputs(history[-1]["cases"])
+    df = pd.DataFrame(
+        [
+            {"case": case, "previous": previous[case], "latest": latest[case]}
+            for case in sorted(latest)
+            if case in previous
+        ]
+    )
+    if df.empty:
+        return df
+    df["ratio"] = df["latest"] / df["previous"]
+    df["regression"] = df["ratio"] < 1 - tolerance
+    return df
+
+
+def load_history(history_path: Path | str) -> list:
+    history_path = Path(history_path)
+    if not history_path.exists():
+        return []
+    return [json.loads(line) for line in history_path.read_text().splitlines() if line]
+
+
+@hydra.main(config_path="../../config", config_name="config_benchmarks", version_base=None)
+def main(cfg: DictConfig):
+    record = run_benchmarks(cfg)
+    history_path = Path(cfg.benchmarks.history)
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    log.info(json.dumps(record, indent=2))
+    df_compare = compare(load_history(history_path), cfg.benchmarks.regression_tolerance)
+    if not df_compare.empty:
+        log.info(f"\n{df_compare.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
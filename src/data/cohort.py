@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+# lower edges of the BMI categories, left closed like the WHO cut-offs
+BMI_EDGES = [-np.inf, 18.5, 25, 30, np.inf]
+BMI_LABELS = ["underweight", "balanced", "overweight", "obese"]
+# countries with too few users to be their own stratum
+COUNTRY_MERGE = {"Austria": "Germany", "Switzerland": "Germany"}
+STRATA = ["gender_desc", "age_group_5y", "country_name", "bmi_cat"]
+
+
+def users_query(min_nr_selfies: int, participant_type: str) -> str:
+    return f"""
+    SELECT u.user_id,
+            u.gender_desc,
+            u.country_name,
+            u.age_group_5y,
+            u.weight_kg,
+            u.height_cm
+      FROM pg.users as u
+      WHERE u.nr_selfies > {min_nr_selfies} AND u.participant_type = '{participant_type}'
+    """
+
+
+def bmi_category(weight_kg: pd.Series, height_cm: pd.Series) -> pd.Categorical:
+    """BMI category per user; missing weight or height gives a missing category."""
+    bmi = weight_kg.to_numpy(dtype=float) / (height_cm.to_numpy(dtype=float) / 100) ** 2
+    return pd.cut(bmi, BMI_EDGES, right=False, labels=BMI_LABELS)
+
+
+def add_strata(df_users: pd.DataFrame, strata: list = STRATA) -> pd.DataFrame:
+    """
+    Categorical strata columns plus `stratum`, one code per combination of
+    strata, and its `selectors` label.
+
+    parameters
+    df_users : pd.DataFrame
+        rows of `pg.users` as returned by `users_query`.
+    strata : list
+        columns that define a stratum.
+
+    returns
+    pd.DataFrame
+        users with weight and height replaced by `bmi_cat`.
+    """
+    df_users = df_users.copy()
+    df_users["bmi_cat"] = bmi_category(df_users["weight_kg"], df_users["height_cm"])
+    df_users = df_users.drop(columns=["weight_kg", "height_cm"])
+    df_users["country_name"] = df_users["country_name"].replace(COUNTRY_MERGE)
+    for column in strata:
+        df_users[column] = df_users[column].astype("category")
+    # combine the category codes into one integer, -1 (missing) shifted to 0
+    codes = [df_users[column].cat.codes.to_numpy().astype(np.int64) + 1 for column in strata]
+    sizes = [len(df_users[column].cat.categories) + 1 for column in strata]
+    combined = np.ravel_multi_index(codes, sizes)
+    stratum, uniques = pd.factorize(combined, sort=True)
+    # labels are built once per stratum, not once per user
+    unique_codes = np.unravel_index(uniques, sizes)
+    labels = [
+        np.concatenate([["nan"], df_users[column].cat.categories.astype(str)])[code]
+        for column, code in zip(strata, unique_codes)
+    ]
+    df_users["stratum"] = stratum
+    df_users["selectors"] = pd.Categorical.from_codes(
+        stratum, [", ".join(parts) for parts in zip(*labels)]
+    )
+    return df_users
+
+
+def stratified_sample(
+    df_users: pd.DataFrame, n_per_stratum: int, seed: int = 42
+) -> pd.DataFrame:
+    """
+    Up to `n_per_stratum` users drawn at random from every stratum, all of a
+    stratum when it is smaller. The draw only depends on the seed and the user
+    ids, not on the order the users came in.
+    """
+    df_users = df_users.sort_values("user_id", ignore_index=True)
+    rng = np.random.default_rng(seed)
+    shuffled = df_users.iloc[rng.permutation(len(df_users))]
+    rank = shuffled.groupby("stratum", sort=False).cumcount()
+    return shuffled.loc[rank < n_per_stratum].sort_values(["stratum", "user_id"], ignore_index=True)
+
+
+def sample_cohort(datalake, cfg: DictConfig) -> pd.DataFrame:
+    """
+    Stratified sample of the users table.
+
+    parameters
+    datalake : DLorm
+        datalake to query `pg.users` from.
+    cfg : DictConfig
+        `cohort` block (min_nr_selfies, participant_type, strata, n_per_stratum, seed).
+    """
+    df_users = datalake.get_query(users_query(cfg.min_nr_selfies, cfg.participant_type))
+    df_users = add_strata(df_users, list(cfg.strata))
+    return stratified_sample(df_users, cfg.n_per_stratum, cfg.seed)
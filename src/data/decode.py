@@ -0,0 +1,165 @@
+import io
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from src.data.shards import read_bytes
+from src.data.timing import span
+
+# JPEG DCT scaling only supports these denominators
+DCT_SCALES = (1, 2, 4, 8)
+
+# side length (px) of the square input each consumer resizes the face crop to
+MODEL_INPUT_SIZES = {
+    "VGG-Face": 224,
+    "Facenet": 160,
+    "Facenet512": 160,
+    "OpenFace": 96,
+    "DeepFace": 152,
+    "DeepID": 55,
+    "ArcFace": 112,
+    "mediapipe": 256,
+}
+
+CV2_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def pick_scale(
+    image_size: tuple[int, int], target_side: int, face_fraction: float = 0.5
+) -> int:
+    """
+    Largest DCT scale that still leaves the face crop at least `target_side` px.
+
+    parameters
+    image_size : tuple[int, int]
+        (width, height) of the full resolution image.
+    target_side : int
+        input side length of the model consuming the face crop.
+    face_fraction : float
+        expected size of the face relative to the shorter image side.
+    """
+    face_side = min(image_size) * face_fraction
+    for scale in reversed(DCT_SCALES):
+        if face_side / scale >= target_side:
+            return scale
+    return 1
+
+
+def resolve_scale(
+    path: Path | str,
+    scale: int | str,
+    model: str,
+    face_fraction: float = 0.5,
+    shard_dir: Path | str | None = None,
+    data: bytes | None = None,
+) -> int:
+    if scale != "auto":
+        scale = int(scale)
+        if scale not in DCT_SCALES:
+            raise ValueError(f"Scale must be one of {DCT_SCALES} or 'auto', got {scale}")
+        return scale
+    if data is None:
+        with span("read"):
+            data = read_bytes(path, shard_dir)
+    with Image.open(io.BytesIO(data)) as img:
+        return pick_scale(img.size, MODEL_INPUT_SIZES[model], face_fraction)
+
+
+def read_selfie(
+    path: Path | str,
+    scale: int = 1,
+    bgr: bool = False,
+    backend: str = "pil",
+    shard_dir: Path | str | None = None,
+    data: bytes | None = None,
+) -> np.ndarray:
+    """
+    Decode a selfie at 1/`scale` resolution.
+
+    For JPEGs the downscaling happens inside the decoder (DCT scaling), so the
+    full resolution image is never materialised.
+
+    parameters
+    path : Path | str
+        image file to decode.
+    scale : int
+        one of 1, 2, 4 or 8.
+    bgr : bool
+        return channels in BGR order (DeepFace/OpenCV) instead of RGB (mediapipe).
+    backend : str
+        "pil" uses `Image.draft`, "cv2" uses the `IMREAD_REDUCED_*` flags.
+    shard_dir : Path | str | None
+        read the encoded bytes from the packed shards instead of the file.
+    data : bytes | None
+        encoded bytes that were already read, e.g. by a `PrefetchReader`.
+
+    returns
+    np.ndarray
+        uint8 array of shape (height, width, 3).
+    """
+    if scale not in DCT_SCALES:
+        raise ValueError(f"Scale must be one of {DCT_SCALES}, got {scale}")
+    if data is None:
+        with span("read"):
+            data = read_bytes(path, shard_dir)
+
+    with span("decode"):
+        return _decode(data, path, scale, bgr, backend)
+
+
+def _decode(data: bytes, path: Path | str, scale: int, bgr: bool, backend: str) -> np.ndarray:
+    if backend == "cv2":
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), CV2_REDUCED_FLAGS[scale])
+        if image is None:
+            raise ValueError(f"Unable to read {path} as an image.")
+        return image if bgr else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    with Image.open(io.BytesIO(data)) as img:
+        full_size = img.size
+        if scale > 1:
+            img.draft("RGB", (full_size[0] // scale, full_size[1] // scale))
+        img = img.convert("RGB")
+        # draft is a no-op for non JPEG files, reduce afterwards instead
+        if scale > 1 and img.size == full_size:
+            img = img.reduce(scale)
+        image = np.asarray(img)
+    return image[:, :, ::-1].copy() if bgr else image
+
+
+def deepface_input(
+    path: Path | str,
+    scale: int | str,
+    model: str,
+    face_fraction: float = 0.5,
+    shard_dir: Path | str | None = None,
+    data: bytes | None = None,
+) -> str | np.ndarray:
+    """
+    Argument for `DeepFace.verify`/`represent`: the path itself when the file
+    is read at full resolution, otherwise the decoded BGR array.
+    """
+    scale = resolve_scale(path, scale, model, face_fraction, shard_dir, data)
+    if scale == 1 and not shard_dir and data is None:
+        return Path(path).as_posix()
+    return read_selfie(path, scale=scale, bgr=True, shard_dir=shard_dir, data=data)
+
+
+def deepface_found_face(img: str | np.ndarray, facial_area: dict) -> bool:
+    """
+    Whether DeepFace found a face in a `deepface_input`. Without
+    `enforce_detection` it falls back to the whole image as the facial area.
+    """
+    if isinstance(img, np.ndarray):
+        height, width = img.shape[:2]
+    else:
+        with Image.open(img) as image:
+            width, height = image.size
+    area = (facial_area["x"], facial_area["y"], facial_area["w"], facial_area["h"])
+    return area != (0, 0, width, height)
@@ -1,15 +1,39 @@
-import pyodbc
-from azure.identity import ManagedIdentityCredential
-from azure.keyvault.secrets import SecretClient
+import sqlite3
+from functools import lru_cache
 
-# get credentials from the Azure ML workspace service principal
-credential = ManagedIdentityCredential()
 # access the KeyVault in another resource group
 KVUri = "https://bdf-dataeng-kv.vault.azure.net"
-kVClient = SecretClient(vault_url=KVUri, credential=credential)
+
+
+# created on first use rather than at import, so importing a module (in a
+# spawned worker, for `main.py --help` or against the harness) needs no
+# managed identity and no round trip to the identity endpoint
+@lru_cache(maxsize=None)
+def get_credential():
+    from azure.identity import ManagedIdentityCredential
+
+    # get credentials from the Azure ML workspace service principal
+    return ManagedIdentityCredential()
+
+
+@lru_cache(maxsize=None)
+def get_kv_client():
+    from azure.keyvault.secrets import SecretClient
+
+    return SecretClient(vault_url=KVUri, credential=get_credential())
+
 
 # create datalake connection
-def get_dl_conn():
+def get_dl_conn(datalake_path: str | None = None):
+    if datalake_path is not None:
+        # synthetic datalake from harness.py, attached as `pg` so the queries run unchanged
+        con = sqlite3.connect(":memory:")
+        con.execute("ATTACH DATABASE ? AS pg", (datalake_path,))
+        print("Connect to synthetic datalake \U00002705")
+        return con
+    import pyodbc
+
+    kVClient = get_kv_client()
     con = pyodbc.connect(
         driver="{ODBC Driver 17 for SQL Server}",
         server=kVClient.get_secret("datalake-sqlpool-server-prd").value,
@@ -0,0 +1,203 @@
+import random
+import shutil
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from PIL import Image
+
+OK = "ok"
+MISSING = "missing"
+CORRUPT = "corrupt"
+TEMPLATES_DIR = "_templates"
+
+
+class FakeDownloader:
+    """The part of `StorageStreamDownloader` the download code uses."""
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def readall(self) -> bytes:
+        return self.data
+
+    def readinto(self, stream) -> int:
+        stream.write(self.data)
+        return len(self.data)
+
+
+class FakeBlobContainer:
+    """
+    Filesystem backed stand-in for the selfie storage account.
+
+    Blobs that exist under `{root}/{container_name}/{blob_name}` are served as
+    they are. With `synthetic`, every other blob name gets a deterministic fate
+    from a hash of its name: missing with `missing_rate`, a truncated JPEG with
+    `corrupt_rate`, and otherwise one of the template JPEGs in `{root}/_templates`.
+    This lets millions of blobs exist without writing millions of files.
+    Every request sleeps `latency` plus up to `jitter` seconds.
+
+    Throttling is injected like the storage account does it: a request that
+    would be one more than `max_concurrent` in flight, or a random share
+    `throttle_rate` of requests, fails at once with `throttle_status`
+    (503 Server Busy or 429). `throttled` and `peak_concurrent` count what
+    the container saw.
+    """
+
+    def __init__(
+        self,
+        root: Path | str,
+        missing_rate: float = 0.0,
+        corrupt_rate: float = 0.0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        synthetic: bool = True,
+        seed: int = 0,
+        max_concurrent: int | None = None,
+        throttle_rate: float = 0.0,
+        throttle_status: int = 503,
+    ) -> None:
+        self.root = Path(root)
+        self.missing_rate = missing_rate
+        self.corrupt_rate = corrupt_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.synthetic = synthetic
+        self.seed = seed
+        self.max_concurrent = max_concurrent
+        self.throttle_rate = throttle_rate
+        self.throttle_status = throttle_status
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_concurrent = 0
+        self.throttled = 0
+        self.templates = [p.read_bytes() for p in sorted((self.root / TEMPLATES_DIR).glob("*.jpg"))]
+        if synthetic and not self.templates:
+            raise FileNotFoundError(f"No template JPEGs in {self.root / TEMPLATES_DIR}")
+
+    def _hash(self, blob_name: str) -> int:
+        return zlib.crc32(f"{self.seed}/{blob_name}".encode())
+
+    def fate(self, blob_name: str) -> str:
+        u = self._hash(blob_name) / 2**32
+        if u < self.missing_rate:
+            return MISSING
+        if u < self.missing_rate + self.corrupt_rate:
+            return CORRUPT
+        return OK
+
+    def wait(self) -> None:
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    @contextmanager
+    def request(self):
+        """One request in flight: throttled at once, or served after `wait`."""
+        with self._lock:
+            busy = self.max_concurrent is not None and self.in_flight >= self.max_concurrent
+            if busy or random.random() < self.throttle_rate:
+                self.throttled += 1
+                raise throttled_error(self.throttle_status)
+            self.in_flight += 1
+            self.peak_concurrent = max(self.peak_concurrent, self.in_flight)
+        try:
+            self.wait()
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def read(self, container_name: str, blob_name: str) -> bytes | None:
+        """Bytes of a blob, None if it does not exist."""
+        path = self.root / container_name / blob_name
+        if path.exists():
+            return path.read_bytes()
+        if not self.synthetic:
+            return None
+        fate = self.fate(blob_name)
+        if fate == MISSING:
+            return None
+        template = self.templates[self._hash(blob_name) % len(self.templates)]
+        if fate == CORRUPT:
+            return template[: len(template) // 3]
+        return template
+
+    def blob_client(self, container_name: str, blob_name: str) -> "FakeBlobClient":
+        return FakeBlobClient(self, container_name, blob_name)
+
+
+class FakeBlobClient:
+    """The part of `azure.storage.blob.BlobClient` the download code uses."""
+
+    def __init__(self, container: FakeBlobContainer, container_name: str, blob_name: str) -> None:
+        self.container = container
+        self.container_name = container_name
+        self.blob_name = blob_name
+
+    def exists(self) -> bool:
+        with self.container.request():
+            return self.container.read(self.container_name, self.blob_name) is not None
+
+    def download_blob(self) -> FakeDownloader:
+        with self.container.request():
+            data = self.container.read(self.container_name, self.blob_name)
+        if data is None:
+            raise ResourceNotFoundError(f"The specified blob {self.blob_name} does not exist.")
+        return FakeDownloader(data)
+
+
+def throttled_error(status: int) -> HttpResponseError:
+    """The error the SDK raises for a throttled request."""
+    error = HttpResponseError(message=f"{status} The server is busy.")
+    error.status_code = status
+    return error
+
+
+def harness_container(cfg) -> FakeBlobContainer | None:
+    """The container configured by the `harness` block, None when the harness is off."""
+    if not cfg.enabled:
+        return None
+    return FakeBlobContainer(
+        cfg.blob_root,
+        missing_rate=cfg.missing_rate,
+        corrupt_rate=cfg.corrupt_rate,
+        latency=cfg.latency,
+        jitter=cfg.jitter,
+        seed=cfg.seed,
+        max_concurrent=cfg.max_concurrent,
+        throttle_rate=cfg.throttle_rate,
+        throttle_status=cfg.throttle_status,
+    )
+
+
+def write_blob(root: Path | str, container_name: str, blob_name: str, data: bytes) -> None:
+    path = Path(root) / container_name / blob_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def synthetic_selfie(rng: np.random.Generator, size: tuple = (1080, 1440)) -> Image.Image:
+    """Smooth gradient plus noise, so the JPEG compresses roughly like a photo."""
+    w, h = size
+    gradient = np.linspace(0, 255, w)[None, :, None] * np.linspace(0.3, 1, h)[:, None, None]
+    noise = rng.normal(0, 12, size=(h, w, 3))
+    return Image.fromarray(np.clip(gradient + noise, 0, 255).astype(np.uint8))
+
+
+def write_templates(
+    root: Path | str, n_templates: int, seed: int = 0, template_paths: list | None = None
+) -> None:
+    """Template JPEGs for the container: copies of `template_paths`, or generated ones."""
+    templates_dir = Path(root) / TEMPLATES_DIR
+    templates_dir.mkdir(parents=True, exist_ok=True)
+    if template_paths:
+        for i, path in enumerate(template_paths[:n_templates]):
+            shutil.copyfile(path, templates_dir / f"template_{i:03d}.jpg")
+        return
+    rng = np.random.default_rng(seed)
+    for i in range(n_templates):
+        synthetic_selfie(rng).save(templates_dir / f"template_{i:03d}.jpg", quality=90)
@@ -0,0 +1,167 @@
+import sqlite3
+from datetime import date, timedelta
+from pathlib import Path
+
+import hydra
+import numpy as np
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.data.fake_blob import write_templates
+
+# production shape, see the duplicate selfie_link_id section of the README
+SCHEMA = [
+    """
+    CREATE TABLE selfie (
+        id INTEGER,
+        user_id INTEGER,
+        ts_date TEXT,
+        full_path TEXT,
+        selfie_link_id TEXT,
+        error_code TEXT,
+        anonymization_date TEXT
+    )
+    """,
+    """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        participant_type TEXT,
+        nr_selfies INTEGER,
+        gender_desc TEXT,
+        country_name TEXT,
+        age_group_5y TEXT,
+        weight_kg REAL,
+        height_cm REAL
+    )
+    """,
+    "CREATE TABLE measure_procedure (selfie_link_id TEXT)",
+]
+INDEXES = [
+    "CREATE INDEX selfie_user ON selfie (user_id)",
+    "CREATE INDEX selfie_link ON selfie (selfie_link_id)",
+    "CREATE INDEX measure_procedure_link ON measure_procedure (selfie_link_id)",
+]
+
+
+def selfies_per_user(rng: np.random.Generator, n_users: int, n_selfies: int) -> np.ndarray:
+    """Heavy tailed selfie counts (tens to thousands per user) that add up to `n_selfies`."""
+    weights = rng.lognormal(mean=0, sigma=1, size=n_users)
+    counts = rng.multinomial(n_selfies - n_users, weights / weights.sum()) + 1
+    return counts
+
+
+def link_ids(rng: np.random.Generator, users: np.ndarray) -> list:
+    """`{user_id}_{guid}` like the production selfie_link_ids."""
+    parts = rng.integers(0, 2**32, size=(len(users), 4), dtype=np.uint64)
+    return [
+        f"{u}_{a:08X}-{b >> 16:04X}-{b & 0xFFFF:04X}-{c >> 16:04X}-{c & 0xFFFF:04X}{d:08X}"
+        for u, (a, b, c, d) in zip(users.tolist(), parts.tolist())
+    ]
+
+
+def user_rows(rng: np.random.Generator, users: np.ndarray, counts: np.ndarray, cfg: DictConfig) -> list:
+    """Users with the demographics `cohort.py` stratifies on."""
+    n = len(users)
+    participant = np.where(rng.random(n) < cfg.participant_rate, "SKINLY", "CLINICAL")
+    gender = rng.choice(["female", "male", "diverse"], size=n, p=[0.6, 0.38, 0.02])
+    country = rng.choice(
+        ["Germany", "Austria", "Switzerland", "France", "Italy", "Spain"],
+        size=n,
+        p=[0.5, 0.1, 0.05, 0.15, 0.1, 0.1],
+    )
+    age = rng.integers(18, 75, size=n) // 5 * 5
+    height = rng.normal(171, 9, size=n).round(0)
+    weight = (rng.lognormal(np.log(24), 0.18, size=n) * (height / 100) ** 2).round(1)
+    return list(
+        zip(
+            users.tolist(),
+            participant.tolist(),
+            counts.tolist(),
+            gender.tolist(),
+            country.tolist(),
+            [f"{a}-{a + 4}" for a in age.tolist()],
+            weight.tolist(),
+            height.tolist(),
+        )
+    )
+
+
+def selfie_rows(
+    rng: np.random.Generator,
+    users: np.ndarray,
+    counts: np.ndarray,
+    first_id: int,
+    dates: np.ndarray,
+    cfg: DictConfig,
+) -> tuple[list, list]:
+    n = int(counts.sum())
+    user_of_row = np.repeat(users, counts)
+    ts_date = dates[rng.integers(0, len(dates), size=n)]
+    links = np.array(link_ids(rng, user_of_row), dtype=object)
+    # a duplicated selfie_link_id repeats the previous selfie of the same user and day
+    first_of_user = np.r_[True, user_of_row[1:] != user_of_row[:-1]]
+    duplicate = (rng.random(n) < cfg.duplicate_rate) & ~first_of_user
+    source = np.maximum.accumulate(np.where(duplicate, 0, np.arange(n)))
+    links, ts_date = links[source], ts_date[source]
+    ids = np.arange(first_id, first_id + n)
+    error = rng.random(n) < cfg.error_rate
+    anonymised = rng.random(n) < cfg.anonymised_rate
+    selfies = [
+        (i, u, d, f"/datalake/selfies/{d}/{u}/{i}.jpg", link, "E01" if err else None, d if anon else None)
+        for i, u, d, link, err, anon in zip(
+            ids.tolist(), user_of_row.tolist(), ts_date.tolist(), links.tolist(), error, anonymised
+        )
+    ]
+    unique_links = links[~duplicate]
+    measured = unique_links[rng.random(len(unique_links)) < cfg.measured_rate]
+    return selfies, [(link,) for link in measured.tolist()]
+
+
+def generate_datalake(db_path: Path | str, cfg: DictConfig, chunk_users: int = 500) -> None:
+    """
+    Synthetic `pg.selfie` / `pg.users` / `pg.measure_procedure` tables in one
+    sqlite file, at the configured cardinalities, written a chunk of users at a time.
+    """
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    db_path.unlink(missing_ok=True)
+    rng = np.random.default_rng(cfg.seed)
+    users = np.arange(1, cfg.n_users + 1) + 10_000
+    counts = selfies_per_user(rng, cfg.n_users, cfg.n_selfies)
+    start = date.fromisoformat(str(cfg.first_date))
+    dates = np.array(
+        [(start + timedelta(days=d)).isoformat() for d in range(cfg.n_days)], dtype=object
+    )
+
+    con = sqlite3.connect(db_path.as_posix())
+    for statement in SCHEMA:
+        con.execute(statement)
+    con.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)", user_rows(rng, users, counts, cfg))
+    next_id = 1
+    for start_user in tqdm(range(0, cfg.n_users, chunk_users), desc="Generating selfies"):
+        chunk = slice(start_user, start_user + chunk_users)
+        selfies, measured = selfie_rows(rng, users[chunk], counts[chunk], next_id, dates, cfg)
+        con.executemany("INSERT INTO selfie VALUES (?, ?, ?, ?, ?, ?, ?)", selfies)
+        con.executemany("INSERT INTO measure_procedure VALUES (?)", measured)
+        next_id += len(selfies)
+        con.commit()
+    for statement in INDEXES:
+        con.execute(statement)
+    con.commit()
+    con.close()
+
+
+@hydra.main(config_path="../../config", config_name="config_harness", version_base=None)
+def main(cfg: DictConfig) -> None:
+    generate_datalake(cfg.harness.datalake, cfg.harness)
+    template_paths = (
+        sorted(Path(cfg.harness.templates_from).glob("*/*.jpg"))
+        if cfg.harness.templates_from
+        else None
+    )
+    write_templates(cfg.harness.blob_root, cfg.harness.n_templates, cfg.harness.seed, template_paths)
+    print(f"Synthetic datalake at {cfg.harness.datalake}, blob templates in {cfg.harness.blob_root}")
+
+
+if __name__ == "__main__":
+    main()
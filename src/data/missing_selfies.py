@@ -1,6 +1,5 @@
 # %%
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 import logging
 from pathlib import Path
 
@@ -9,15 +8,18 @@ from PIL import Image
 import numpy as np
 import pandas as pd
 from azure.core.exceptions import ResourceNotFoundError
-from azure.identity import ManagedIdentityCredential
 from azure.storage.blob import BlobClient
-from dl_conn import get_dl_conn
-from dl_orm import DLorm
+from src.data.dl_conn import get_credential, get_dl_conn
+from src.data.dl_orm import DLorm
+from src.data.fake_blob import harness_container
 from omegaconf import DictConfig
+from src.data.registry import MISSING_BLOB, OK, SelfieRegistry, selfie_key
 from tqdm import tqdm
+from src.data.transfer import BlobTransfer
 import os
 
-credential = ManagedIdentityCredential()
+# fake blob container when the scale-test harness is enabled, see main
+fake_blobs = None
 
 def list_files_with_extension(directory, extension) -> list:
     files = []
@@ -60,7 +62,7 @@ def get_user_specific_selfie_data(cfg: DictConfig, users_missing: pd.DataFrame)
         AND u.participant_type = '{cfg.dl_filters.participant_type}'
         AND pgsfe.selfie_link_id in (SELECT DISTINCT selfie_link_id FROM pg.measure_procedure)
     """
-    con = get_dl_conn()
+    con = get_dl_conn(cfg.harness.datalake if cfg.harness.enabled else None)
     datalake = DLorm(con)
     df_selfies = (
         datalake.get_query(query)
@@ -79,16 +81,25 @@ def init_blob(
     filename: str,
     container_name: str = "selfies",
 ):
+    if fake_blobs is not None:
+        return fake_blobs.blob_client(container_name, f"{date}/{user_id}/{filename}")
     logging.getLogger("azure").setLevel(logging.ERROR)
 
     return BlobClient(
         account_url="https://claire1kstorage.blob.core.windows.net",
         container_name=container_name,
         blob_name=f"{date}/{user_id}/{filename}",
-        credential=credential,
+        credential=get_credential(),
+        # BlobTransfer retries, so throttling reaches its limiter at once
+        retry_total=0,
     )
 
 
+def row_key(row: dict) -> str:
+    date = Path(row["full_path"]).parts[3]
+    return selfie_key(row["user_id"], date, row["selfie_link_id"])
+
+
 def check_blob_exists(row):
     path = Path(row["full_path"])
     date = path.parts[3]
@@ -100,29 +111,63 @@ def check_blob_exists(row):
     return np.nan if blob.exists() else row["selfie_link_id"]
 
 
-def filter_bad_blobs(df_selfies: pd.DataFrame) -> pd.Series:
+def filter_bad_blobs(
+    df_selfies: pd.DataFrame,
+    registry: SelfieRegistry | None = None,
+    transfer: BlobTransfer | None = None,
+    recheck_missing: bool = False,
+) -> pd.Series:
+    """
+    Rows whose blob exists. Blobs the registry knows to be missing are not
+    checked again unless `recheck_missing`, which clears the missing status
+    of the ones that turned up.
+    """
+    transfer = transfer or BlobTransfer()
+    rows = df_selfies.to_dict("records")
     non_existent_blobs = []
-    with tqdm(total=len(df_selfies), ncols=100) as pbar:
-        with ThreadPoolExecutor(max_workers=40) as executor:
-            futures = [
-                executor.submit(check_blob_exists, row)
-                for row in df_selfies.to_dict("records")
-            ]
+    missing = set()
+    if registry is not None:
+        missing = registry.bad_keys([MISSING_BLOB])
+    if not recheck_missing:
+        # blobs already known to be missing need no round trip to the storage account
+        non_existent_blobs = [row["selfie_link_id"] for row in rows if row_key(row) in missing]
+        rows = [row for row in rows if row_key(row) not in missing]
+    checked = []
+    with tqdm(total=len(rows), ncols=100) as pbar:
+        with transfer.executor() as executor:
+            futures = {executor.submit(transfer.wrap(check_blob_exists), row): row for row in rows}
             for future in concurrent.futures.as_completed(futures):
                 try:
-                    non_existent_blobs.append(future.result())
+                    result = future.result()
+                    non_existent_blobs.append(result)
+                    checked.append(
+                        (row_key(futures[future]), OK if pd.isna(result) else MISSING_BLOB, "")
+                    )
                     pbar.update(1)
                 except Exception as e:
                     print(f"{future} raised an exception {e}")
                     pbar.update(1)
                     continue
+    if registry is not None:
+        # also clears a missing status recorded by the download stage
+        found = [key for key, status, _ in checked if status == OK and key in missing]
+        registry.clear(found, [MISSING_BLOB])
+        registry.record_many("blob_check", checked)
 
     return df_selfies.loc[~df_selfies["selfie_link_id"].isin(non_existent_blobs)]
 
 
-def clean_missing_selfie_blobs(df_selfies: pd.DataFrame) -> pd.DataFrame:
+def clean_missing_selfie_blobs(
+    df_selfies: pd.DataFrame,
+    registry: SelfieRegistry | None = None,
+    transfer: BlobTransfer | None = None,
+    recheck_missing: bool = False,
+) -> pd.DataFrame:
     df_filtered_latest = filter_bad_blobs(
-        df_selfies.sort_values("ts_date").groupby("user_id").tail(2)
+        df_selfies.sort_values("ts_date").groupby("user_id").tail(2),
+        registry,
+        transfer,
+        recheck_missing,
     ).drop_duplicates(subset=["user_id"])
     df_latest = df_filtered_latest[~df_filtered_latest['selfie_exists']]
     df_filtered_random = filter_bad_blobs(
@@ -130,7 +175,10 @@ def clean_missing_selfie_blobs(df_selfies: pd.DataFrame) -> pd.DataFrame:
             ~df_selfies["selfie_link_id"].isin(df_latest["selfie_link_id"])  
         ]
         .groupby("user_id")
-        .sample(5)
+        .sample(5),
+        registry,
+        transfer,
+        recheck_missing,
     )
     latest_selfie_users = df_latest.user_id.unique()
     df_filtered_random['missing_count'][df_filtered_random["user_id"].isin(latest_selfie_users)] -= 1
@@ -191,24 +239,45 @@ def get_selfie(dataframe_row: dict, save_dir: Path | str):
         raise ResourceNotFoundError(f"Blob for {user_id}-{date} not found.") from e
 
 
-def get_selfies(df_selfies: pd.DataFrame, save_dir: Path | str):
-    l = len(df_selfies)
-    with tqdm(total=l, ncols=100) as pbar:
-        with ThreadPoolExecutor(max_workers=40) as executor:
-            futures = [
-                executor.submit(get_selfie, row, save_dir=save_dir)
-                for row in df_selfies.to_dict("records")
-            ]
+def get_selfies(
+    df_selfies: pd.DataFrame,
+    save_dir: Path | str,
+    registry: SelfieRegistry | None = None,
+    transfer: BlobTransfer | None = None,
+):
+    transfer = transfer or BlobTransfer()
+    rows = df_selfies.to_dict("records")
+    if registry is not None:
+        bad_keys = registry.bad_keys()
+        rows = [row for row in rows if row_key(row) not in bad_keys]
+    downloaded = []
+    with tqdm(total=len(rows), ncols=100) as pbar:
+        with transfer.executor() as executor:
+            futures = {
+                executor.submit(transfer.wrap(get_selfie), row, save_dir=save_dir): row
+                for row in rows
+            }
             for future in concurrent.futures.as_completed(futures):
+                key = row_key(futures[future])
                 try:
                     data, save_path = future.result()
-                    with open(save_path, "wb") as f:
-                        data.readinto(f)
+                    # data is None when the selfie was already downloaded
+                    if data is not None:
+                        with open(save_path, "wb") as f:
+                            data.readinto(f)
+                    downloaded.append((key, OK, ""))
+                    pbar.update(1)
+                except ResourceNotFoundError as e:
+                    print(f"{future} raised an exception {e}")
+                    downloaded.append((key, MISSING_BLOB, str(e)))
                     pbar.update(1)
                 except Exception as e:
                     print(f"{future} raised an exception {e}")
+                    transfer.add_failed(futures[future], e)
                     pbar.update(1)
                     continue
+    if registry is not None:
+        registry.record_many("download", downloaded)
 
 
 # %%
@@ -217,22 +286,39 @@ def main_dl(cfg: DictConfig) -> None:
     users_missing_selfies.to_csv('./users_missing_selfies.csv', index=False)
     df_selfies = get_user_specific_selfie_data(cfg, users_missing_selfies)
     df_selfies.to_csv("./all_missing_selfies.csv", index=False)
-    df_clean_selfie_blobs = clean_missing_selfie_blobs(df_selfies)
+    registry = SelfieRegistry(cfg.registry.path)
+    transfer = BlobTransfer.from_config(cfg.transfer)
+    df_clean_selfie_blobs = clean_missing_selfie_blobs(
+        df_selfies, registry, transfer, cfg.registry.recheck_missing
+    )
     df_clean_selfie_blobs.to_csv("./downloaded_missing_selfies.csv", index=False)
-    get_selfies(df_clean_selfie_blobs, save_dir= cfg.selfie_data.save_dir)
+    get_selfies(df_clean_selfie_blobs, save_dir= cfg.selfie_data.save_dir, registry=registry, transfer=transfer)
+    transfer.save_retry_list(cfg.transfer.retry_list)
+    transfer.log_summary()
 
 
 def main_csv(cfg: DictConfig) -> None:
-    df_clean_selfie_blobs = pd.read_csv("./downloaded_missing_selfies.csv")
-    get_selfies(df_clean_selfie_blobs, save_dir= cfg.selfie_data.save_dir)
+    csv = cfg.transfer.retry_list if cfg.transfer.from_retry_list else "./downloaded_missing_selfies.csv"
+    df_clean_selfie_blobs = pd.read_csv(csv)
+    transfer = BlobTransfer.from_config(cfg.transfer)
+    get_selfies(
+        df_clean_selfie_blobs,
+        save_dir=cfg.selfie_data.save_dir,
+        registry=SelfieRegistry(cfg.registry.path),
+        transfer=transfer,
+    )
+    transfer.save_retry_list(cfg.transfer.retry_list)
+    transfer.log_summary()
 
 
 @hydra.main(config_path="../../config", config_name="config", version_base=None)
 def main(cfg: DictConfig) -> None:
+    global fake_blobs
+    fake_blobs = harness_container(cfg.harness)
     if cfg.selfie_data.download:
         main_dl(cfg)
         return
-    main_csv()
+    main_csv(cfg)
 
 
 if __name__ == "__main__":
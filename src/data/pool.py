@@ -0,0 +1,416 @@
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from pathlib import Path
+from typing import Any, Callable, Iterable, NamedTuple
+
+import pandas as pd
+import psutil
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+log = logging.getLogger(__name__)
+
+# messages from the workers to the pool
+SAMPLE = "sample"
+READY = "ready"
+STARTED = "started"
+DONE = "done"
+# events in the memory log that the pool adds itself
+SPAWN = "spawn"
+EXIT = "exit"
+RETIRE = "retire"
+MAIN = "main"
+
+
+class WorkerDied(RuntimeError):
+    """The worker running a task exited before returning its result, e.g. OOM killed."""
+
+
+def _usage(process: psutil.Process) -> tuple[int, float]:
+    cpu = process.cpu_times()
+    return process.memory_info().rss, cpu.user + cpu.system
+
+
+def _dumps(ok: bool, value) -> bytes:
+    try:
+        return pickle.dumps((ok, value))
+    except Exception as e:
+        return pickle.dumps((False, RuntimeError(f"Unpicklable task result: {e!r}")))
+
+
+def _worker(tasks, results, max_rss: int | None, sample_seconds: float, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    pid = os.getpid()
+    process = psutil.Process()
+    stop = threading.Event()
+    results.put((READY, None, pid, *_usage(process), None, False))
+
+    def heartbeat():
+        while not stop.wait(sample_seconds):
+            results.put((SAMPLE, None, pid, *_usage(process), None, False))
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        t0 = time.perf_counter()
+        # the first task of a worker imports the module of its function
+        task_id, fn, args, kwargs = pickle.loads(item)
+        load_seconds = time.perf_counter() - t0
+        results.put((STARTED, task_id, pid, *_usage(process), load_seconds, False))
+        try:
+            payload = _dumps(True, fn(*args, **kwargs))
+        except BaseException as e:
+            payload = _dumps(False, e)
+        rss, cpu = _usage(process)
+        # finish the task first, so recycling never loses work
+        retire = max_rss is not None and rss > max_rss
+        results.put((DONE, task_id, pid, rss, cpu, payload, retire))
+        if retire:
+            break
+    stop.set()
+
+
+class RecyclingProcessPool(Executor):
+    """
+    Process pool that recycles a worker once its RSS passes `max_rss` bytes,
+    instead of after a fixed number of tasks like `max_tasks_per_child`.
+
+    Every worker reports its RSS and CPU time after each task and every
+    `sample_seconds` in between. The samples are kept as the pool's memory log
+    (`memory_frame`, `save_memory`), which shows how much concurrency a VM can
+    hold. A worker that dies mid task, e.g. killed by the OOM killer, fails
+    that task with `WorkerDied` and is replaced.
+
+    Every worker's startup is timed too (`startup_frame`): from spawn until
+    it is ready for tasks, and how long its first task took to unpickle,
+    which is where the task function's module and its imports are loaded.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_rss: int | None = None,
+        sample_seconds: float = 30.0,
+        initializer=None,
+        initargs: tuple = (),
+        mp_context=None,
+    ) -> None:
+        # spawn like ProcessPoolExecutor with max_tasks_per_child, since workers
+        # are started from the pool's thread
+        self._ctx = mp_context or mp.get_context("spawn")
+        self._max_workers = max_workers
+        self._max_rss = max_rss
+        self._sample_seconds = sample_seconds
+        self._initializer = initializer
+        self._initargs = initargs
+        self._tasks = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._running = {}
+        self._workers = {}
+        self._next_id = 0
+        self._shutdown = False
+        self._t0 = time.monotonic()
+        self.samples = []
+        self._last_logged = {}
+        self._rss = {}
+        self._spawned = {}
+        self.startups = {}
+        self.peak_worker_rss = 0
+        self.peak_total_rss = 0
+        self.recycled = 0
+        self.died = 0
+        self._main = psutil.Process()
+        for _ in range(max_workers):
+            self._spawn()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _log_sample(self, event: str, pid: int, rss: int, cpu: float) -> None:
+        now = time.monotonic()
+        if event in (SAMPLE, READY, STARTED, DONE):
+            self._rss[pid] = rss
+            self.peak_worker_rss = max(self.peak_worker_rss, rss)
+            self.peak_total_rss = max(self.peak_total_rss, sum(self._rss.values()))
+            # per task reports only reach the log once per sample period per worker
+            if now - self._last_logged.get(pid, -self._sample_seconds) < self._sample_seconds:
+                return
+        elif event == EXIT:
+            self._rss.pop(pid, None)
+            self._last_logged.pop(pid, None)
+        self._last_logged[pid] = now
+        self.samples.append(
+            {"seconds": now - self._t0, "event": event, "pid": pid, "rss": rss, "cpu_s": cpu}
+        )
+
+    def _spawn(self) -> None:
+        process = self._ctx.Process(
+            target=_worker,
+            args=(
+                self._tasks,
+                self._results,
+                self._max_rss,
+                self._sample_seconds,
+                self._initializer,
+                self._initargs,
+            ),
+            daemon=True,
+        )
+        process.start()
+        self._workers[process.pid] = process
+        self._spawned[process.pid] = time.monotonic()
+        self._log_sample(SPAWN, process.pid, 0, 0.0)
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit to a pool that was shut down")
+            future = Future()
+            task_id = self._next_id
+            self._next_id += 1
+            self._pending[task_id] = future
+        try:
+            self._tasks.put(pickle.dumps((task_id, fn, args, kwargs)))
+        except Exception:
+            with self._lock:
+                del self._pending[task_id]
+            raise
+        return future
+
+    def _handle(self, message: tuple) -> None:
+        kind, task_id, pid, rss, cpu, payload, retire = message
+        self._log_sample(kind, pid, rss, cpu)
+        if kind == READY:
+            self.startups[pid] = {
+                "pid": pid,
+                "ready_s": time.monotonic() - self._spawned.pop(pid, self._t0),
+                "first_task_load_s": float("nan"),
+                "rss": rss,
+            }
+        elif kind == STARTED:
+            startup = self.startups.get(pid)
+            if startup is not None and pd.isna(startup["first_task_load_s"]):
+                startup["first_task_load_s"] = payload
+            self._running[pid] = task_id
+            with self._lock:
+                future = self._pending.get(task_id)
+            if future is not None:
+                future.set_running_or_notify_cancel()
+        elif kind == DONE:
+            self._running.pop(pid, None)
+            with self._lock:
+                future = self._pending.pop(task_id, None)
+            if future is not None and not future.cancelled():
+                ok, value = pickle.loads(payload)
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            if retire:
+                log.info(f"Recycling worker {pid} at {rss / 2**20:.0f} MiB RSS")
+                self.recycled += 1
+                self.samples.append(
+                    {"seconds": time.monotonic() - self._t0, "event": RETIRE, "pid": pid, "rss": rss, "cpu_s": cpu}
+                )
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                self._handle(self._results.get_nowait())
+            except queue.Empty:
+                return
+
+    def _reap(self) -> None:
+        """Replace workers that exited, failing the task a dead one was running."""
+        exited = [pid for pid, process in self._workers.items() if not process.is_alive()]
+        if exited:
+            # a retiring worker's last result can still be queued behind its exit
+            self._drain()
+        for pid in exited:
+            process = self._workers.pop(pid)
+            process.join()
+            self._spawned.pop(pid, None)
+            self._log_sample(EXIT, pid, 0, 0.0)
+            task_id = self._running.pop(pid, None)
+            if task_id is not None:
+                self.died += 1
+                with self._lock:
+                    future = self._pending.pop(task_id, None)
+                if future is not None and not future.cancelled():
+                    future.set_exception(
+                        WorkerDied(f"Worker {pid} exited with code {process.exitcode} mid task")
+                    )
+            with self._lock:
+                needed = not self._shutdown or bool(self._pending)
+            if needed and len(self._workers) < self._max_workers:
+                self._spawn()
+
+    def _collect(self) -> None:
+        last_reap = last_sample = time.monotonic()
+        while True:
+            try:
+                self._handle(self._results.get(timeout=0.5))
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            if now - last_reap >= 0.5:
+                self._reap()
+                last_reap = now
+            if now - last_sample >= self._sample_seconds:
+                self._log_sample(MAIN, self._main.pid, *_usage(self._main))
+                last_sample = now
+            with self._lock:
+                finished = self._shutdown and not self._pending
+            if finished and not self._workers:
+                return
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                for future in self._pending.values():
+                    future.cancel()
+        for _ in range(self._max_workers):
+            self._tasks.put(None)
+        if wait:
+            self._collector.join()
+            self._tasks.close()
+            self._results.close()
+
+    def memory_frame(self) -> pd.DataFrame:
+        """
+        RSS (bytes) and CPU seconds over time, per worker and for the main
+        process, at most one report per worker every `sample_seconds` plus
+        spawn, retire and exit events.
+        """
+        return pd.DataFrame(self.samples, columns=["seconds", "event", "pid", "rss", "cpu_s"])
+
+    def startup_frame(self) -> pd.DataFrame:
+        """
+        Per worker startup: seconds from spawn until ready for tasks (interpreter,
+        imports of the pool and initializer), seconds to unpickle its first
+        task (imports of the task's module) and RSS once ready.
+        """
+        return pd.DataFrame(
+            list(self.startups.values()), columns=["pid", "ready_s", "first_task_load_s", "rss"]
+        )
+
+    def save_memory(self, path: Path | str) -> None:
+        """Write the memory log, and the startup times next to it as worker_startup.csv."""
+        self.memory_frame().to_csv(path, index=False)
+        df_startup = self.startup_frame()
+        df_startup.to_csv(Path(path).with_name("worker_startup.csv"), index=False)
+        log.info(
+            f"Workers peaked at {self.peak_worker_rss / 2**30:.2f} GiB each, "
+            f"{self.peak_total_rss / 2**30:.2f} GiB together; "
+            f"recycled {self.recycled}, died {self.died}"
+        )
+        if not df_startup.empty:
+            log.info(
+                f"{len(df_startup)} workers started in {df_startup['ready_s'].median():.2f} s "
+                f"(max {df_startup['ready_s'].max():.2f} s), first task loaded in "
+                f"{df_startup['first_task_load_s'].median():.2f} s"
+            )
+
+
+class TaskResult(NamedTuple):
+    item: Any
+    result: Any
+    error: BaseException | None
+
+
+def bounded_map(
+    executor: Executor,
+    fn: Callable,
+    items: Iterable,
+    args: Callable[[Any], tuple] = lambda item: (item,),
+    max_in_flight: int | None = None,
+    release: Callable[[Any], None] | None = None,
+    desc: str | None = None,
+    total: int | None = None,
+):
+    """
+    Run `fn(*args(item))` on `executor` for every item, keeping at most
+    `max_in_flight` tasks submitted at once, and yield a `TaskResult` per item
+    as tasks finish.
+
+    Items are pulled from `items` only when there is room, so memory follows
+    the concurrency instead of the dataset. A task that raised yields its
+    exception as `error` instead of stopping the loop.
+
+    parameters
+    executor : Executor
+        thread or process pool to run the tasks on.
+    fn : Callable
+        task function; must be picklable for process pools.
+    items : Iterable
+        consumed lazily, e.g. rows, paths or a `PrefetchReader`.
+    args : Callable[[Any], tuple]
+        positional arguments of `fn` for an item, built in the calling process.
+    max_in_flight : int | None
+        window of submitted tasks; defaults to twice the executor's workers.
+    release : Callable[[Any], None] | None
+        called with the item once its task finished, from the executor's thread,
+        e.g. to hand prefetched bytes back to a `PrefetchReader`.
+    desc : str | None
+        progress bar label; None shows no progress bar.
+    total : int | None
+        progress bar length, defaults to `len(items)` when items has one.
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * executor._max_workers
+    if total is None and hasattr(items, "__len__"):
+        total = len(items)
+    items = iter(items)
+    in_flight = {}
+    exhausted = False
+    with tqdm(desc=desc, total=total, disable=desc is None) as pbar:
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(fn, *args(item))
+                if release is not None:
+                    future.add_done_callback(lambda _, item=item: release(item))
+                in_flight[future] = item
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                error = future.exception()
+                yield TaskResult(item, None if error else future.result(), error)
+                pbar.update(1)
+
+
+def recycling_pool(
+    cfg: DictConfig, max_workers: int | None = None, initializer=None, initargs: tuple = ()
+) -> RecyclingProcessPool:
+    """`RecyclingProcessPool` from a `workers` config block."""
+    return RecyclingProcessPool(
+        max_workers or cfg.max_workers,
+        max_rss=cfg.max_rss_bytes,
+        sample_seconds=cfg.sample_seconds,
+        initializer=initializer,
+        initargs=initargs,
+    )
+
+
+def memory_log_path(filename: str = "worker_memory.csv") -> Path:
+    """Path in the Hydra run output dir for a pool's memory log."""
+    from hydra.core.hydra_config import HydraConfig
+
+    return Path(HydraConfig.get().runtime.output_dir) / filename
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterable
+
+from src.data.shards import read_bytes
+
+
+class PrefetchReader:
+    """
+    Read selfies ahead of the consumer, in the order the work is scheduled.
+
+    Background threads keep reading the upcoming files into memory while the
+    consumer computes on the current one. Read ahead stops once `max_bytes`
+    of read but unreleased data (or `max_ahead` pending reads) are held, and
+    resumes as the consumer releases data.
+
+    Iterating yields `(path, data)` in the order of `paths`. `data` is None if
+    the read failed, so the consumer can fall back to reading the path itself
+    and report the error where it already does. With `auto_release` the data
+    of an item is released when the next one is requested; otherwise the
+    consumer calls `release` once it is done with it, e.g. from a future
+    callback when the data was handed to a worker process.
+
+    `stats` counts hits (data was in memory when asked for), misses (the
+    consumer had to wait for the read), reads, bytes read and seconds spent
+    waiting.
+    """
+
+    def __init__(
+        self,
+        paths: Iterable[Path | str],
+        max_bytes: int = 256 * 2**20,
+        threads: int = 4,
+        max_ahead: int = 64,
+        shard_dir: Path | str | None = None,
+        auto_release: bool = True,
+    ) -> None:
+        self.paths = list(paths)
+        self.max_bytes = max_bytes
+        self.max_ahead = max(max_ahead, 1)
+        self.shard_dir = shard_dir
+        self.auto_release = auto_release
+        self.stats = {"hits": 0, "misses": 0, "errors": 0, "reads": 0, "bytes": 0, "wait_seconds": 0.0}
+        self._held_bytes = 0
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True)
+        self._scheduler.start()
+
+    def _estimate(self) -> int:
+        reads = self.stats["reads"]
+        return self.stats["bytes"] // reads if reads else self.max_bytes
+
+    def _read(self, path: Path | str, reserved: int) -> bytes:
+        try:
+            # bytes, not a memoryview into a shard, so it can be pickled to workers
+            data = bytes(read_bytes(path, self.shard_dir))
+        except Exception:
+            with self._condition:
+                self._held_bytes -= reserved
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            # swap the reservation for the actual size
+            self._held_bytes += len(data) - reserved
+            self.stats["bytes"] += len(data)
+            self.stats["reads"] += 1
+            self._condition.notify_all()
+        return data
+
+    def _schedule(self) -> None:
+        for path in self.paths:
+            with self._condition:
+                # in flight reads reserve the average file size; one item ahead is
+                # always allowed, so a single file above the cap still gets read
+                self._condition.wait_for(
+                    lambda: self._closed
+                    or not self._pending
+                    or (
+                        self._held_bytes + self._estimate() <= self.max_bytes
+                        and len(self._pending) < self.max_ahead
+                    )
+                )
+                if self._closed:
+                    return
+                reserved = min(self._estimate(), self.max_bytes)
+                self._held_bytes += reserved
+                self._pending.append((path, self._executor.submit(self._read, path, reserved)))
+                self._condition.notify_all()
+
+    def release(self, data: bytes | None) -> None:
+        if not data:
+            return
+        with self._condition:
+            self._held_bytes -= len(data)
+            self._condition.notify_all()
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __iter__(self):
+        previous = None
+        try:
+            for _ in range(len(self.paths)):
+                with self._condition:
+                    self._condition.wait_for(lambda: self._pending)
+                    path, future = self._pending.popleft()
+                    self._condition.notify_all()
+                if self.auto_release:
+                    self.release(previous)
+                previous = self._result(future)
+                yield path, previous
+            if self.auto_release:
+                self.release(previous)
+        finally:
+            self.close()
+
+    def _result(self, future: Future) -> bytes | None:
+        if future.done():
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            t0 = time.perf_counter()
+            wait([future])
+            self.stats["wait_seconds"] += time.perf_counter() - t0
+        if future.exception() is not None:
+            self.stats["errors"] += 1
+            return None
+        return future.result()
+
+    def hit_rate(self) -> float:
+        asked = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / asked if asked else 0.0
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._scheduler.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable
+
+import pandas as pd
+
+OK = "ok"
+MISSING_BLOB = "missing_blob"
+CORRUPT = "corrupt"
+NO_FACE = "no_face"
+LANDMARK_FAILURE = "landmark_failure"
+BAD_STATUSES = (MISSING_BLOB, CORRUPT, NO_FACE, LANDMARK_FAILURE)
+
+
+def selfie_key(user_id: int, date: str, selfie_link_id: str) -> str:
+    """Key of a selfie as laid out on disk by the downloader: `{user_id}/{date}_{selfie_link_id}.jpg`."""
+    return f"{user_id}/{date}_{selfie_link_id}.jpg"
+
+
+def path_key(path: Path | str) -> str:
+    path = Path(path)
+    return f"{path.parent.name}/{path.name}"
+
+
+class SelfieRegistry:
+    """
+    Status of every selfie as seen by each pipeline stage, in one sqlite file.
+
+    Stages check `bad_keys` once before scheduling work, so known bad selfies
+    are dropped with a set lookup instead of failing again inside a worker.
+    A selfie is bad if any stage recorded one of `BAD_STATUSES` for it.
+    """
+
+    def __init__(self, db_path: Path | str) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connector = sqlite3.connect(
+            self.db_path.as_posix(), timeout=60, check_same_thread=False
+        )
+        self.connector.execute("PRAGMA journal_mode=WAL")
+        self.connector.execute(
+            """
+            CREATE TABLE IF NOT EXISTS selfie_status (
+                key TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                user_id INTEGER,
+                status TEXT NOT NULL,
+                detail TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (key, stage)
+            )
+            """
+        )
+        self.connector.commit()
+
+    def record_many(self, stage: str, records: Iterable[tuple[str, str, str]]) -> None:
+        """Upsert (key, status, detail) records of one stage."""
+        now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        rows = [
+            (key, stage, int(key.split("/")[0]), status, detail, now)
+            for key, status, detail in records
+        ]
+        with self._lock:
+            self.connector.executemany(
+                "INSERT OR REPLACE INTO selfie_status VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self.connector.commit()
+
+    def record(self, stage: str, key: str, status: str, detail: str = "") -> None:
+        self.record_many(stage, [(key, status, detail)])
+
+    def clear(self, keys: Iterable[str], statuses: Iterable[str] = BAD_STATUSES) -> None:
+        """
+        Drop the records of `keys` with one of `statuses` in every stage, e.g.
+        once a blob recorded as missing turns up.
+        """
+        statuses = tuple(statuses)
+        rows = [(key, *statuses) for key in keys]
+        if not statuses or not rows:
+            return
+        with self._lock:
+            self.connector.executemany(
+                "DELETE FROM selfie_status WHERE key = ? AND status IN "
+                f"({', '.join('?' * len(statuses))})",
+                rows,
+            )
+            self.connector.commit()
+
+    def bad_keys(self, statuses: Iterable[str] = BAD_STATUSES) -> set:
+        statuses = tuple(statuses)
+        if not statuses:
+            return set()
+        with self._lock:
+            rows = self.connector.execute(
+                "SELECT DISTINCT key FROM selfie_status WHERE status IN "
+                f"({', '.join('?' * len(statuses))})",
+                statuses,
+            ).fetchall()
+        return {key for (key,) in rows}
+
+    def bad_statuses(self, statuses: Iterable[str] = BAD_STATUSES) -> dict:
+        """The bad status of every bad key; for a key bad in several stages, the last one recorded."""
+        statuses = tuple(statuses)
+        if not statuses:
+            return {}
+        with self._lock:
+            rows = self.connector.execute(
+                "SELECT key, status FROM selfie_status WHERE status IN "
+                f"({', '.join('?' * len(statuses))}) ORDER BY updated_at",
+                statuses,
+            ).fetchall()
+        return dict(rows)
+
+    def bad_keys_by_user(self, statuses: Iterable[str] = BAD_STATUSES) -> dict:
+        by_user = {}
+        for key in self.bad_keys(statuses):
+            by_user.setdefault(int(key.split("/")[0]), set()).add(key)
+        return by_user
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql("SELECT * FROM selfie_status", con=self.connector)
+
+    def import_corrupted_csv(self, csv_path: Path | str, stage: str = "integrity") -> None:
+        """Seed the registry with the legacy `corrupted_files.csv` list."""
+        df_corrupted = pd.read_csv(csv_path)
+        self.record_many(
+            stage,
+            [(path_key(path), CORRUPT, "corrupted_files.csv") for path in df_corrupted["path"]],
+        )
+
+    def close(self) -> None:
+        self.connector.close()
+
+
+def drop_bad_paths(paths: Iterable[Path | str], bad_keys: set) -> list:
+    return [path for path in paths if path_key(path) not in bad_keys]
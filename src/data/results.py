@@ -0,0 +1,297 @@
+import shutil
+from pathlib import Path
+from typing import Iterable
+
+import hydra
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+PARTITION_COLS = ["model", "similarity_metric"]
+
+# same casts as the analysis notebooks did after loading the whole csv
+SCORE_DTYPES = {
+    "user_id": "int32",
+    "user1_id": "int32",
+    "user2_id": "int32",
+    "verified": "bool",
+    "distance": "float32",
+    "threshold": "float32",
+    "time": "float32",
+}
+
+
+def selfie_keys(paths: pd.Series) -> pd.Series:
+    """`registry.path_key` of a column of selfie paths, `{user_id}/{filename}`."""
+    return paths.str.split("/").str[-2:].str.join("/")
+
+
+def current_rows(df_scores: pd.DataFrame, keys: set) -> pd.DataFrame:
+    """
+    Score rows whose two selfies are both in `keys`, e.g. the img_keys of an
+    incremental manifest, dropping the scores of replaced selfies.
+    """
+    current = selfie_keys(df_scores["img1_path"]).isin(keys) & selfie_keys(df_scores["img2_path"]).isin(keys)
+    return df_scores.loc[current]
+
+
+def manifest_keys(manifest_path: Path | str) -> set:
+    return set(pd.read_csv(manifest_path, usecols=["img_key"])["img_key"])
+
+
+def arrow_schema(df_chunk: pd.DataFrame) -> pa.Schema:
+    """
+    Schema every chunk of a conversion is written with, from the first one:
+    its types after the SCORE_DTYPES casts, and string for text columns and
+    for columns that are empty in it, which pandas would read as double.
+    """
+    fields = []
+    for field in pa.Schema.from_pandas(df_chunk, preserve_index=False):
+        column = df_chunk[field.name]
+        if field.name not in SCORE_DTYPES and (
+            pd.api.types.is_object_dtype(column) or column.isna().all()
+        ):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def convert_scores(
+    csv_path: Path | str,
+    dataset_dir: Path | str,
+    chunksize: int = 1_000_000,
+    keys: set | None = None,
+) -> int:
+    """
+    Rewrite a score csv as a parquet dataset partitioned by model and metric.
+
+    The csv is read in chunks, so converting never holds the whole table. A
+    directory is read as the concatenation of the csv parts in it, e.g. the
+    per unit parts of a queued inter run. An existing dataset is removed
+    first, so a reconversion never keeps partitions or part files of the
+    previous one. With `keys`, only rows between selfies in `keys` are kept
+    (see `current_rows`).
+
+    returns
+    int
+        number of rows written.
+    """
+    dataset_dir = Path(dataset_dir)
+    csv_path = Path(csv_path)
+    csv_paths = sorted(csv_path.glob("*.csv")) if csv_path.is_dir() else [csv_path]
+    if dataset_dir.exists():
+        shutil.rmtree(dataset_dir)
+    chunks = (chunk for path in csv_paths for chunk in pd.read_csv(path, chunksize=chunksize))
+    n_rows, schema = 0, None
+    for i, df_chunk in enumerate(tqdm(chunks, desc=f"Converting {csv_path.name}")):
+        if keys is not None:
+            df_chunk = current_rows(df_chunk, keys)
+        df_chunk = df_chunk.astype(
+            {col: dtype for col, dtype in SCORE_DTYPES.items() if col in df_chunk}
+        )
+        if schema is None:
+            # inferred per chunk, a column empty in one chunk would be double there
+            schema = arrow_schema(df_chunk)
+        ds.write_dataset(
+            pa.Table.from_pandas(df_chunk, schema=schema, preserve_index=False),
+            dataset_dir,
+            format="parquet",
+            partitioning=PARTITION_COLS,
+            partitioning_flavor="hive",
+            basename_template=f"part-{i:05d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        n_rows += len(df_chunk)
+    return n_rows
+
+
+def scan_scores(dataset_dir: Path | str) -> ds.Dataset:
+    """Lazy handle on a converted score table; nothing is read until it is scanned."""
+    return ds.dataset(Path(dataset_dir), format="parquet", partitioning="hive")
+
+
+def score_filter(
+    models: Iterable[str] | None = None,
+    metrics: Iterable[str] | None = None,
+    expression: ds.Expression | None = None,
+) -> ds.Expression | None:
+    """
+    Combine model/metric selections and any extra `pyarrow.dataset` expression.
+    Model and metric filters prune whole partitions before any file is opened.
+    """
+    filters = []
+    if models is not None:
+        filters.append(ds.field("model").isin(list(models)))
+    if metrics is not None:
+        filters.append(ds.field("similarity_metric").isin(list(metrics)))
+    if expression is not None:
+        filters.append(expression)
+    if not filters:
+        return None
+    combined = filters[0]
+    for f in filters[1:]:
+        combined = combined & f
+    return combined
+
+
+def query(
+    dataset: ds.Dataset | Path | str,
+    columns: list | None = None,
+    models: Iterable[str] | None = None,
+    metrics: Iterable[str] | None = None,
+    expression: ds.Expression | None = None,
+) -> pd.DataFrame:
+    """Only the requested columns of the matching rows, as a DataFrame."""
+    if not isinstance(dataset, ds.Dataset):
+        dataset = scan_scores(dataset)
+    return dataset.to_table(
+        columns=columns, filter=score_filter(models, metrics, expression)
+    ).to_pandas()
+
+
+def iter_batches(
+    dataset: ds.Dataset | Path | str,
+    columns: list,
+    filter: ds.Expression | None = None,
+    batch_size: int = 1_000_000,
+):
+    if not isinstance(dataset, ds.Dataset):
+        dataset = scan_scores(dataset)
+    for batch in dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def partition_keys(
+    dataset: ds.Dataset | Path | str, filter: ds.Expression | None = None
+) -> list:
+    """Sorted (model, metric) pairs present, from the directory layout alone."""
+    if not isinstance(dataset, ds.Dataset):
+        dataset = scan_scores(dataset)
+    keys = set()
+    for fragment in dataset.get_fragments(filter=filter):
+        partition = ds.get_partition_keys(fragment.partition_expression)
+        keys.add(tuple(partition[col] for col in PARTITION_COLS))
+    return sorted(keys)
+
+
+def iter_partitions(
+    dataset: ds.Dataset | Path | str,
+    columns: list,
+    filter: ds.Expression | None = None,
+):
+    """Yield ((model, metric), DataFrame) one partition at a time."""
+    if not isinstance(dataset, ds.Dataset):
+        dataset = scan_scores(dataset)
+    for model, metric in partition_keys(dataset, filter):
+        partition = score_filter([model], [metric], filter)
+        yield (model, metric), dataset.to_table(columns=columns, filter=partition).to_pandas()
+
+
+def _merge_moments(a: pd.DataFrame, b: pd.DataFrame) -> pd.DataFrame:
+    """Chan et al. merge of per group (count, mean, m2), so std is exact over batches."""
+    a, b = a.align(b, fill_value=0)
+    count = a["count"] + b["count"]
+    safe = count.where(count > 0, 1)
+    delta = b["mean"] - a["mean"]
+    return pd.DataFrame(
+        {
+            "count": count,
+            "mean": a["mean"] + delta * b["count"] / safe,
+            "m2": a["m2"] + b["m2"] + delta**2 * a["count"] * b["count"] / safe,
+            "sum": a["sum"] + b["sum"],
+        }
+    )
+
+
+def grouped_stats(
+    dataset: ds.Dataset | Path | str,
+    value: str = "distance",
+    by: list = PARTITION_COLS,
+    filter: ds.Expression | None = None,
+    batch_size: int = 1_000_000,
+) -> pd.DataFrame:
+    """
+    Count, sum, mean and std (ddof=1, like pandas) of `value` per group, in one
+    streaming pass over record batches that only reads `by` and `value`.
+    """
+    moments = None
+    for df_batch in iter_batches(dataset, [*by, value], filter, batch_size):
+        grouped = df_batch.groupby(by, observed=True)[value]
+        batch_moments = pd.DataFrame(
+            {
+                "count": grouped.count(),
+                "mean": grouped.mean(),
+                "m2": grouped.var(ddof=0) * grouped.count(),
+                "sum": grouped.sum(),
+            }
+        ).astype("float64")
+        moments = batch_moments if moments is None else _merge_moments(moments, batch_moments)
+    if moments is None:
+        return pd.DataFrame(columns=[*by, "count", "sum", "mean", "std"])
+    moments["std"] = np.sqrt(moments["m2"] / (moments["count"] - 1).where(moments["count"] > 1))
+    moments["count"] = moments["count"].astype("int64")
+    return moments.drop(columns="m2").reset_index()[[*by, "count", "sum", "mean", "std"]]
+
+
+def partition_quantiles(
+    dataset: ds.Dataset | Path | str,
+    value: str = "distance",
+    quantiles: Iterable[float] = (0.05, 0.25, 0.5, 0.75, 0.95),
+    filter: ds.Expression | None = None,
+) -> pd.DataFrame:
+    """
+    Exact quantiles of `value` per model and metric. Memory is bounded by one
+    column of the largest partition, since partitions are read one at a time.
+    """
+    quantiles = list(quantiles)
+    records = []
+    for (model, metric), df_part in iter_partitions(dataset, [value], filter):
+        values = df_part[value].to_numpy()
+        records.append(
+            {
+                "model": model,
+                "similarity_metric": metric,
+                **{f"q{q:g}": np.quantile(values, q) for q in quantiles},
+            }
+        )
+    return pd.DataFrame(records)
+
+
+def per_user_diffs(
+    dataset: ds.Dataset | Path | str,
+    value: str = "distance",
+    user_col: str = "user_id",
+    filter: ds.Expression | None = None,
+) -> pd.DataFrame:
+    """
+    Absolute difference of `value` between consecutive rows of each user, per
+    model and metric, as `groupby([user, model, metric]).diff().abs()` did on
+    the full table. Partitions are processed one at a time.
+    """
+    list_df = []
+    for (model, metric), df_part in iter_partitions(dataset, [user_col, value], filter):
+        diffs = df_part.groupby(user_col)[value].diff().abs()
+        df_diff = df_part.loc[diffs.notna(), [user_col]].assign(
+            model=model, similarity_metric=metric, **{value: diffs.dropna()}
+        )
+        list_df.append(df_diff)
+    if not list_df:
+        return pd.DataFrame(columns=[user_col, "model", "similarity_metric", value])
+    return pd.concat(list_df, ignore_index=True)
+
+
+@hydra.main(config_path="../../config", config_name="config_results", version_base=None)
+def main(cfg: DictConfig) -> None:
+    for table in cfg.results.tables:
+        keys = manifest_keys(table.manifest) if table.get("manifest") else None
+        n_rows = convert_scores(table.csv, table.dataset, cfg.results.chunksize, keys)
+        print(f"Converted {n_rows} rows of {table.csv} to {table.dataset}")
+        print(grouped_stats(table.dataset).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,4 @@
 # %%
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
 import logging
 from pathlib import Path
 
@@ -9,14 +7,19 @@ from PIL import Image
 import numpy as np
 import pandas as pd
 from azure.core.exceptions import ResourceNotFoundError
-from azure.identity import ManagedIdentityCredential
 from azure.storage.blob import BlobClient
-from dl_conn import get_dl_conn
-from dl_orm import DLorm
+from src.data.cohort import sample_cohort
+from src.data.dl_conn import get_credential, get_dl_conn
+from src.data.dl_orm import DLorm
+from src.data.fake_blob import harness_container
 from omegaconf import DictConfig
-from tqdm import tqdm
+from src.data.pool import bounded_map
+from src.data.registry import MISSING_BLOB, OK, SelfieRegistry, selfie_key
+from src.data import timing
+from src.data.transfer import BlobTransfer
 
-credential = ManagedIdentityCredential()
+# fake blob container when the scale-test harness is enabled, see main
+fake_blobs = None
 
 
 def get_user_selfie_data(cfg: DictConfig) -> pd.DataFrame:
@@ -36,7 +39,7 @@ def get_user_selfie_data(cfg: DictConfig) -> pd.DataFrame:
         AND u.participant_type = '{cfg.dl_filters.participant_type}'
         AND pgsfe.selfie_link_id in (SELECT DISTINCT selfie_link_id FROM pg.measure_procedure)
     """
-    con = get_dl_conn()
+    con = get_dl_conn(cfg.harness.datalake if cfg.harness.enabled else None)
     datalake = DLorm(con)
     df_selfies = (
         datalake.get_query(query)
@@ -44,6 +47,11 @@ def get_user_selfie_data(cfg: DictConfig) -> pd.DataFrame:
         .drop_duplicates(subset=["user_id", "selfie_link_id"])
     )
     filter_users = get_users_w_min_nrselfies(df_selfies, cfg.dl_filters.nr_selfies)
+    if cfg.cohort.enabled:
+        # only download the selfies of a stratified sample of the users
+        df_cohort = sample_cohort(datalake, cfg.cohort)
+        df_cohort.to_csv("../../data/cohort.csv", index=False)
+        filter_users = np.intersect1d(filter_users, df_cohort["user_id"].to_numpy())
     df_selfies = df_selfies.loc[df_selfies["user_id"].isin(filter_users)]
     return df_selfies
 
@@ -71,16 +79,25 @@ def init_blob(
     filename: str,
     container_name: str = "selfies",
 ):
+    if fake_blobs is not None:
+        return fake_blobs.blob_client(container_name, f"{date}/{user_id}/{filename}")
     logging.getLogger("azure").setLevel(logging.ERROR)
 
     return BlobClient(
         account_url="https://claire1kstorage.blob.core.windows.net",
         container_name=container_name,
         blob_name=f"{date}/{user_id}/{filename}",
-        credential=credential,
+        credential=get_credential(),
+        # BlobTransfer retries, so throttling reaches its limiter at once
+        retry_total=0,
     )
 
 
+def row_key(row: dict) -> str:
+    date = Path(row["full_path"]).parts[3]
+    return selfie_key(row["user_id"], date, row["selfie_link_id"])
+
+
 def check_blob_exists(row):
     path = Path(row["full_path"])
     date = path.parts[3]
@@ -92,36 +109,67 @@ def check_blob_exists(row):
     return np.nan if blob.exists() else row["selfie_link_id"]
 
 
-def filter_bad_blobs(df_selfies: pd.DataFrame) -> pd.Series:
+def filter_bad_blobs(
+    df_selfies: pd.DataFrame,
+    registry: SelfieRegistry | None = None,
+    transfer: BlobTransfer | None = None,
+    recheck_missing: bool = False,
+) -> pd.Series:
+    """
+    Rows whose blob exists. Blobs the registry knows to be missing are not
+    checked again unless `recheck_missing`, which clears the missing status
+    of the ones that turned up.
+    """
+    transfer = transfer or BlobTransfer()
+    rows = df_selfies.to_dict("records")
     non_existent_blobs = []
-    with tqdm(total=len(df_selfies), ncols=100) as pbar:
-        with ThreadPoolExecutor(max_workers=40) as executor:
-            futures = [
-                executor.submit(check_blob_exists, row)
-                for row in df_selfies.to_dict("records")
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    non_existent_blobs.append(future.result())
-                    pbar.update(1)
-                except Exception as e:
-                    print(f"{future} raised an exception {e}")
-                    pbar.update(1)
-                    continue
+    missing = set()
+    if registry is not None:
+        missing = registry.bad_keys([MISSING_BLOB])
+    if not recheck_missing:
+        # blobs already known to be missing need no round trip to the storage account
+        non_existent_blobs = [row["selfie_link_id"] for row in rows if row_key(row) in missing]
+        rows = [row for row in rows if row_key(row) not in missing]
+    checked = []
+    with transfer.executor() as executor:
+        for row, result, error in bounded_map(
+            executor, transfer.wrap(check_blob_exists), rows, desc="Checking blobs"
+        ):
+            if error is not None:
+                print(f"{row['selfie_link_id']} raised an exception {error}")
+                continue
+            non_existent_blobs.append(result)
+            checked.append((row_key(row), OK if pd.isna(result) else MISSING_BLOB, ""))
+    if registry is not None:
+        # also clears a missing status recorded by the download stage
+        found = [key for key, status, _ in checked if status == OK and key in missing]
+        registry.clear(found, [MISSING_BLOB])
+        registry.record_many("blob_check", checked)
 
     return df_selfies.loc[~df_selfies["selfie_link_id"].isin(non_existent_blobs)]
 
 
-def clean_selfie_blobs(df_selfies: pd.DataFrame) -> pd.DataFrame:
+def clean_selfie_blobs(
+    df_selfies: pd.DataFrame,
+    registry: SelfieRegistry | None = None,
+    transfer: BlobTransfer | None = None,
+    recheck_missing: bool = False,
+) -> pd.DataFrame:
     df_filtered_latest = filter_bad_blobs(
-        df_selfies.sort_values("ts_date").groupby("user_id").tail(2)
+        df_selfies.sort_values("ts_date").groupby("user_id").tail(2),
+        registry,
+        transfer,
+        recheck_missing,
     ).drop_duplicates(subset=["user_id"])
     df_filtered_random = filter_bad_blobs(
         df_selfies.loc[
             ~df_selfies["selfie_link_id"].isin(df_filtered_latest["selfie_link_id"])
         ]
         .groupby("user_id")
-        .sample(5)
+        .sample(5),
+        registry,
+        transfer,
+        recheck_missing,
     )
     df_count_selfies = df_filtered_random.groupby("user_id").nunique().reset_index()
     passing_users = df_count_selfies.loc[df_count_selfies["full_path"] >= 2][
@@ -168,59 +216,109 @@ def get_selfie(dataframe_row: dict, save_dir: Path | str):
     save_path = save_dir / Path(f"{date}_{dataframe_row['selfie_link_id']}.jpg")
 
     try:
-        return (
-            download_blob(
-                user_id=user_id,
-                date=date,
-                filename=filename,
-                save_path=save_path,
-            ),
-            save_path,
-        )
+        with timing.span("download"):
+            return (
+                download_blob(
+                    user_id=user_id,
+                    date=date,
+                    filename=filename,
+                    save_path=save_path,
+                ),
+                save_path,
+            )
     except ResourceNotFoundError as e:
         raise ResourceNotFoundError(f"Blob for {user_id}-{date} not found.") from e
 
 
-def get_selfies(df_selfies: pd.DataFrame, save_dir: Path | str = "../../data/selfies"):
-    l = len(df_selfies)
-    with tqdm(total=l, ncols=100) as pbar:
-        with ThreadPoolExecutor(max_workers=40) as executor:
-            futures = [
-                executor.submit(get_selfie, row, save_dir=save_dir)
-                for row in df_selfies.to_dict("records")
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    data, save_path = future.result()
-                    with open(save_path, "wb") as f:
-                        data.readinto(f)
-                    pbar.update(1)
-                except Exception as e:
-                    print(f"{future} raised an exception {e}")
-                    pbar.update(1)
-                    continue
+def get_selfies(
+    df_selfies: pd.DataFrame,
+    save_dir: Path | str = "../../data/selfies",
+    registry: SelfieRegistry | None = None,
+    transfer: BlobTransfer | None = None,
+):
+    """
+    Download the rows' selfies through `transfer`. Missing blobs go to the
+    registry; rows that failed otherwise, e.g. still throttled after every
+    retry, go to `transfer.failed` for the retry list.
+    """
+    transfer = transfer or BlobTransfer()
+    rows = df_selfies.to_dict("records")
+    if registry is not None:
+        bad_keys = registry.bad_keys()
+        rows = [row for row in rows if row_key(row) not in bad_keys]
+    downloaded = []
+    with transfer.executor() as executor:
+        tasks = bounded_map(
+            executor,
+            transfer.wrap(get_selfie),
+            rows,
+            args=lambda row: (row, save_dir),
+            desc="Downloading selfies",
+        )
+        for row, download, error in timing.timed_iter(tasks):
+            key = row_key(row)
+            if error is not None:
+                print(f"{row['selfie_link_id']} raised an exception {error}")
+                if isinstance(error, ResourceNotFoundError):
+                    downloaded.append((key, MISSING_BLOB, str(error)))
+                else:
+                    transfer.add_failed(row, error)
+                continue
+            data, save_path = download
+            try:
+                # data is None when the selfie was already downloaded
+                if data is not None:
+                    # the blob body streams here, so this covers transfer and write
+                    with timing.span("write"):
+                        with open(save_path, "wb") as f:
+                            data.readinto(f)
+                downloaded.append((key, OK, ""))
+            except Exception as e:
+                print(f"{row['selfie_link_id']} raised an exception {e}")
+                transfer.add_failed(row, e)
+    if registry is not None:
+        registry.record_many("download", downloaded)
 
 
 # %%
 def main_dl(cfg: DictConfig) -> None:
     df_selfies = get_user_selfie_data(cfg)
     df_selfies.to_csv("../../data/all_selfies.csv", index=False)
-    df_clean_selfie_blobs = clean_selfie_blobs(df_selfies)
+    registry = SelfieRegistry(cfg.registry.path)
+    transfer = BlobTransfer.from_config(cfg.transfer)
+    df_clean_selfie_blobs = clean_selfie_blobs(
+        df_selfies, registry, transfer, cfg.registry.recheck_missing
+    )
     df_clean_selfie_blobs.to_csv("./downloaded_selfies.csv", index=False)
-    get_selfies(df_clean_selfie_blobs, save_dir="./selfies")
-
-
-def main_csv() -> None:
-    df_clean_selfie_blobs = pd.read_csv("./downloaded_selfies.csv")
-    get_selfies(df_clean_selfie_blobs, save_dir="./selfies")
+    get_selfies(df_clean_selfie_blobs, save_dir="./selfies", registry=registry, transfer=transfer)
+    transfer.save_retry_list(cfg.transfer.retry_list)
+    transfer.log_summary()
+
+
+def main_csv(cfg: DictConfig) -> None:
+    csv = cfg.transfer.retry_list if cfg.transfer.from_retry_list else "./downloaded_selfies.csv"
+    df_clean_selfie_blobs = pd.read_csv(csv)
+    transfer = BlobTransfer.from_config(cfg.transfer)
+    get_selfies(
+        df_clean_selfie_blobs,
+        save_dir="./selfies",
+        registry=SelfieRegistry(cfg.registry.path),
+        transfer=transfer,
+    )
+    transfer.save_retry_list(cfg.transfer.retry_list)
+    transfer.log_summary()
 
 
 @hydra.main(config_path="../../config", config_name="config", version_base=None)
 def main(cfg: DictConfig) -> None:
+    global fake_blobs
+    fake_blobs = harness_container(cfg.harness)
+    timing.start(cfg.timing.enabled)
     if cfg.selfie_data.download:
         main_dl(cfg)
-        return
-    main_csv()
+    else:
+        main_csv(cfg)
+    timing.write_report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,284 @@
+import csv
+import io
+import mmap
+import os
+from pathlib import Path
+from typing import Iterable
+
+import hydra
+import pandas as pd
+from omegaconf import DictConfig
+from PIL import Image
+from tqdm import tqdm
+
+from src.data.registry import path_key
+
+INDEX_NAME = "index.csv"
+INDEX_COLUMNS = ["key", "shard", "offset", "length"]
+
+
+def complete_length(path: Path | str) -> int:
+    """Bytes of `path` up to the end of its last complete line."""
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        # only the tail is read, a block at a time
+        while end > 0:
+            start = max(0, end - 2**16)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def read_index(shard_dir: Path | str) -> pd.DataFrame:
+    """
+    The shard index, without a trailing line cut off by a crash while it was
+    being written. Its selfie is packed again on the next run.
+    """
+    index_path = Path(shard_dir) / INDEX_NAME
+    with open(index_path, "rb") as f:
+        data = f.read()
+    data = data[: data.rfind(b"\n") + 1]
+    if not data:
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    return pd.read_csv(io.BytesIO(data))
+
+
+class ShardWriter:
+    """
+    Append selfies to a few large shard files instead of one file per selfie.
+
+    Shards are append only: every record is written at the end of the current
+    shard and its offset goes into `index.csv`, so packing can be resumed and
+    new selfies can be added without rewriting anything.
+
+    A selfie whose file no longer has the packed length, e.g. after it was
+    downloaded again, is appended once more by `add_file`; the last index row
+    of a key is the one readers use.
+
+    Every index row is flushed as soon as its record is in the shard, so a
+    crashed run loses at most the row being written, and both files are
+    fsynced every `sync_every` rows. A partial last row left by a crash is cut
+    off when the writer opens the index again.
+    """
+
+    def __init__(
+        self, shard_dir: Path | str, shard_size: int = 2**30, sync_every: int = 1000
+    ) -> None:
+        self.shard_dir = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.sync_every = sync_every
+        self.index_path = self.shard_dir / INDEX_NAME
+        length = complete_length(self.index_path) if self.index_path.exists() else 0
+        new_index = length == 0
+        if new_index:
+            self.packed = {}
+        else:
+            os.truncate(self.index_path, length)
+            df_index = read_index(self.shard_dir)
+            # packed length per key, from its last row
+            self.packed = dict(zip(df_index["key"], df_index["length"]))
+        shards = sorted(self.shard_dir.glob("shard_*.bin"))
+        self.shard_id = len(shards) - 1 if shards else 0
+        self._open_shard()
+        self.index_file = open(self.index_path, "w" if new_index else "a", newline="")
+        self.index_writer = csv.writer(self.index_file)
+        self.unsynced = 0
+        if new_index:
+            self.index_writer.writerow(INDEX_COLUMNS)
+            self.index_file.flush()
+
+    def _open_shard(self) -> None:
+        self.shard_path = self.shard_dir / f"shard_{self.shard_id:05d}.bin"
+        self.shard = open(self.shard_path, "ab")
+
+    def add(self, key: str, data: bytes, replace: bool = False) -> bool:
+        if key in self.packed and not replace:
+            return False
+        if self.shard.tell() > 0 and self.shard.tell() + len(data) > self.shard_size:
+            self.shard.close()
+            self.shard_id += 1
+            self._open_shard()
+        offset = self.shard.tell()
+        self.shard.write(data)
+        # the bytes have to be in the shard before the index points at them
+        self.shard.flush()
+        self.index_writer.writerow([key, self.shard_path.name, offset, len(data)])
+        self.index_file.flush()
+        self.packed[key] = len(data)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+        return True
+
+    def add_file(self, path: Path | str) -> bool:
+        key = path_key(path)
+        if key in self.packed and Path(path).stat().st_size == self.packed[key]:
+            return False
+        return self.add(key, Path(path).read_bytes(), replace=True)
+
+    def sync(self) -> None:
+        for f in (self.shard, self.index_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+
+    def close(self) -> None:
+        self.sync()
+        self.shard.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class ShardReader:
+    """
+    Zero copy access to packed selfies.
+
+    Each shard is memory mapped once; `get` returns a `memoryview` into the
+    mapping, so reading a selfie is a page fault on a large file instead of an
+    open/read/close round trip on the network mount.
+    """
+
+    def __init__(self, shard_dir: Path | str) -> None:
+        self.shard_dir = Path(shard_dir)
+        self._load()
+
+    def _index_stamp(self) -> tuple:
+        stat = (self.shard_dir / INDEX_NAME).stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> None:
+        self.stamp = self._index_stamp()
+        df_index = read_index(self.shard_dir)
+        self.index = {
+            key: (shard, int(offset), int(length))
+            for key, shard, offset, length in zip(
+                df_index["key"], df_index["shard"], df_index["offset"], df_index["length"]
+            )
+        }
+        # shards may have grown past their mappings; views already handed out keep theirs
+        self._maps = {}
+        self._by_user = None
+
+    def refresh(self) -> bool:
+        """Reload the index if it changed since it was read, e.g. by a later packing run."""
+        if self._index_stamp() == self.stamp:
+            return False
+        self._load()
+        return True
+
+    def _map(self, shard: str) -> mmap.mmap:
+        if shard not in self._maps:
+            with open(self.shard_dir / shard, "rb") as f:
+                self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> list:
+        return list(self.index)
+
+    def user_keys(self, user_id: int | str) -> list:
+        if self._by_user is None:
+            self._by_user = {}
+            for key in self.index:
+                self._by_user.setdefault(key.split("/")[0], []).append(key)
+        return sorted(self._by_user.get(str(user_id), []))
+
+    def get(self, key: str) -> memoryview:
+        shard, offset, length = self.index[key]
+        return memoryview(self._map(shard))[offset : offset + length]
+
+    def get_path(self, path: Path | str) -> memoryview:
+        return self.get(path_key(path))
+
+    def open_image(self, key: str) -> Image.Image:
+        return Image.open(io.BytesIO(self.get(key)))
+
+    def close(self) -> None:
+        for shard_map in self._maps.values():
+            shard_map.close()
+        self._maps = {}
+
+
+_readers = {}
+
+
+def shard_reader(shard_dir: Path | str, refresh: bool = False) -> ShardReader:
+    """
+    One reader per shard directory and process, so worker processes map each
+    shard once. `refresh` reloads a cached reader whose index has changed.
+    """
+    shard_dir = Path(shard_dir).as_posix()
+    if shard_dir not in _readers:
+        _readers[shard_dir] = ShardReader(shard_dir)
+    elif refresh:
+        _readers[shard_dir].refresh()
+    return _readers[shard_dir]
+
+
+def read_bytes(path: Path | str, shard_dir: Path | str | None = None) -> bytes | memoryview:
+    """
+    Bytes of a selfie, from the shards when they hold it and from the file
+    otherwise. A key missing from the cached index rereads the index first, in
+    case it was packed since.
+    """
+    if shard_dir:
+        reader = shard_reader(shard_dir)
+        key = path_key(path)
+        if key in reader or (reader.refresh() and key in reader):
+            return reader.get(key)
+    return Path(path).read_bytes()
+
+
+def list_selfie_paths(
+    save_dir: Path | str, shard_dir: Path | str | None = None
+) -> list:
+    """All selfie paths, listed from the shard index instead of the mount when reading from shards."""
+    save_dir = Path(save_dir)
+    if shard_dir:
+        return sorted(save_dir / key for key in shard_reader(shard_dir, refresh=True).keys())
+    return sorted(save_dir.glob("*/*.jpg"))
+
+
+def list_user_selfie_paths(
+    save_dir: Path | str, user_id: int | str, shard_dir: Path | str | None = None
+) -> list:
+    save_dir = Path(save_dir)
+    if shard_dir:
+        return [save_dir / key for key in shard_reader(shard_dir, refresh=True).user_keys(user_id)]
+    return sorted((save_dir / str(user_id)).glob("*.jpg"))
+
+
+def pack_selfies(
+    selfie_paths: Iterable[Path | str], shard_dir: Path | str, shard_size: int = 2**30
+) -> int:
+    selfie_paths = list(selfie_paths)
+    packed = 0
+    with ShardWriter(shard_dir, shard_size) as writer:
+        for path in tqdm(selfie_paths, desc="Packing selfies", ncols=100):
+            packed += writer.add_file(path)
+    return packed
+
+
+@hydra.main(config_path="../../config", config_name="config", version_base=None)
+def main(cfg: DictConfig) -> None:
+    selfie_paths = sorted(Path(cfg.selfie_data.save_dir).glob("*/*.jpg"))
+    packed = pack_selfies(selfie_paths, cfg.shards.dir, cfg.shards.size)
+    print(f"Packed {packed} new selfies into {cfg.shards.dir}")
+
+
+if __name__ == "__main__":
+    main()
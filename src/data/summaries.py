@@ -0,0 +1,309 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data.results import iter_batches
+
+# histogram ranges per distance metric; values outside land in under/overflow
+DEFAULT_RANGES = {
+    "cosine": (0.0, 2.0),
+    "euclidean_l2": (0.0, 2.0),
+    "euclidean": (0.0, 200.0),
+    "procrustes": (0.0, 1.0),
+}
+
+
+class QuantileSketch:
+    """
+    Log bucketed quantile sketch (DDSketch): every quantile is returned within
+    `relative_accuracy` of a true value, and two sketches merge by adding
+    bucket counts, so summaries of shards and runs combine without error.
+    Values at or below `min_value` (distances of identical images) share a
+    zero bucket.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.005, min_value: float = 1e-9) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        positive = values[values > self.min_value]
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        index, counts = np.unique(
+            np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True
+        )
+        for i, c in zip(index.tolist(), counts.tolist()):
+            self.buckets[i] = self.buckets.get(i, 0) + c
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can only merge sketches with the same relative accuracy")
+        for i, c in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + c
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return float("nan")
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                return float(2 * self.gamma**i / (self.gamma + 1))
+        return float(2 * self.gamma ** max(self.buckets) / (self.gamma + 1))
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "buckets": {str(i): c for i, c in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "QuantileSketch":
+        sketch = cls(d["relative_accuracy"], d["min_value"])
+        sketch.zero_count = d["zero_count"]
+        sketch.count = d["count"]
+        sketch.buckets = {int(i): c for i, c in d["buckets"].items()}
+        return sketch
+
+
+class DistanceSummary:
+    """Fixed bin histogram, moments and quantile sketch of one model/metric's distances."""
+
+    def __init__(
+        self,
+        bin_range: tuple = (0.0, 2.0),
+        n_bins: int = 400,
+        relative_accuracy: float = 0.005,
+    ) -> None:
+        self.edges = np.linspace(bin_range[0], bin_range[1], n_bins + 1)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.count = 0
+        self.verified = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.thresholds = set()
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def update(self, distances, verified=None, thresholds=None) -> None:
+        distances = np.asarray(distances, dtype=np.float64)
+        distances = distances[np.isfinite(distances)]
+        if not len(distances):
+            return
+        self.counts += np.histogram(distances, bins=self.edges)[0]
+        self.underflow += int((distances < self.edges[0]).sum())
+        self.overflow += int((distances > self.edges[-1]).sum())
+        self.count += len(distances)
+        self.sum += float(distances.sum())
+        self.sum_sq += float((distances**2).sum())
+        self.min = min(self.min, float(distances.min()))
+        self.max = max(self.max, float(distances.max()))
+        if verified is not None:
+            self.verified += int(np.asarray(verified, dtype=bool).sum())
+        if thresholds is not None:
+            self.thresholds.update(float(t) for t in np.unique(np.asarray(thresholds)))
+        self.sketch.update(distances)
+
+    def merge(self, other: "DistanceSummary") -> "DistanceSummary":
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Can only merge summaries with the same histogram bins")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.count += other.count
+        self.verified += other.verified
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.thresholds |= other.thresholds
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else float("nan")
+
+    @property
+    def std(self) -> float:
+        if self.count < 2:
+            return float("nan")
+        return float(np.sqrt(max(self.sum_sq - self.count * self.mean**2, 0) / (self.count - 1)))
+
+    def quantile(self, q: float) -> float:
+        return self.sketch.quantile(q)
+
+    def cdf(self, x: float) -> float:
+        """Share of distances at or below x, from the histogram (exact at bin edges)."""
+        below = self.underflow + self.counts[self.edges[1:] <= x].sum()
+        return float(below / self.count) if self.count else float("nan")
+
+    def to_dict(self) -> dict:
+        return {
+            "edges": [float(self.edges[0]), float(self.edges[-1]), len(self.counts)],
+            "counts": self.counts.tolist(),
+            "underflow": self.underflow,
+            "overflow": self.overflow,
+            "count": self.count,
+            "verified": self.verified,
+            "sum": self.sum,
+            "sum_sq": self.sum_sq,
+            "min": self.min,
+            "max": self.max,
+            "thresholds": sorted(self.thresholds),
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "DistanceSummary":
+        lo, hi, n_bins = d["edges"]
+        summary = cls((lo, hi), n_bins, d["sketch"]["relative_accuracy"])
+        summary.counts = np.asarray(d["counts"], dtype=np.int64)
+        for key in ["underflow", "overflow", "count", "verified", "sum", "sum_sq", "min", "max"]:
+            setattr(summary, key, d[key])
+        summary.thresholds = set(d["thresholds"])
+        summary.sketch = QuantileSketch.from_dict(d["sketch"])
+        return summary
+
+
+class SummarySet:
+    """
+    Distance summaries per (model, metric), updated from score tables as they
+    are written and saved as json next to the results.
+    """
+
+    def __init__(
+        self,
+        n_bins: int = 400,
+        ranges: dict | None = None,
+        relative_accuracy: float = 0.005,
+    ) -> None:
+        self.n_bins = n_bins
+        self.ranges = {**DEFAULT_RANGES, **(ranges or {})}
+        self.relative_accuracy = relative_accuracy
+        self.summaries = {}
+
+    def _summary(self, model: str, metric: str) -> DistanceSummary:
+        key = (model, metric)
+        if key not in self.summaries:
+            self.summaries[key] = DistanceSummary(
+                tuple(self.ranges.get(metric, (0.0, 2.0))), self.n_bins, self.relative_accuracy
+            )
+        return self.summaries[key]
+
+    def update(self, df_scores: pd.DataFrame) -> None:
+        """Add the rows of a score table in the deepface schema."""
+        for (model, metric), df_group in df_scores.groupby(
+            ["model", "similarity_metric"], observed=True
+        ):
+            self._summary(model, metric).update(
+                df_group["distance"].to_numpy(),
+                df_group["verified"].to_numpy() if "verified" in df_group else None,
+                df_group["threshold"].to_numpy() if "threshold" in df_group else None,
+            )
+
+    def merge(self, other: "SummarySet") -> "SummarySet":
+        for (model, metric), summary in other.summaries.items():
+            if (model, metric) in self.summaries:
+                self.summaries[(model, metric)].merge(summary)
+            else:
+                self.summaries[(model, metric)] = summary
+        return self
+
+    def __getitem__(self, key: tuple) -> DistanceSummary:
+        return self.summaries[key]
+
+    def __len__(self) -> int:
+        return len(self.summaries)
+
+    def save(self, path: Path | str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        payload = [
+            {"model": model, "similarity_metric": metric, **summary.to_dict()}
+            for (model, metric), summary in self.summaries.items()
+        ]
+        # write then rename, so a reader never sees half a file
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(payload))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path | str) -> "SummarySet":
+        summary_set = cls()
+        for d in json.loads(Path(path).read_text()):
+            summary_set.summaries[(d["model"], d["similarity_metric"])] = (
+                DistanceSummary.from_dict(d)
+            )
+        return summary_set
+
+    def to_frame(self, quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)) -> pd.DataFrame:
+        return pd.DataFrame(
+            [
+                {
+                    "model": model,
+                    "similarity_metric": metric,
+                    "count": s.count,
+                    "mean": s.mean,
+                    "std": s.std,
+                    "min": s.min,
+                    "max": s.max,
+                    "verified_rate": s.verified / s.count if s.count else float("nan"),
+                    "threshold": max(s.thresholds) if s.thresholds else float("nan"),
+                    **{f"q{q:g}": s.quantile(q) for q in quantiles},
+                }
+                for (model, metric), s in sorted(self.summaries.items())
+            ]
+        )
+
+
+def summary_path(summaries_dir: Path | str, stage: str) -> Path:
+    """
+    One file per call, so concurrent runs, and Hydra multirun jobs run one
+    after the other in the same process, never write the same summary.
+    """
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return Path(summaries_dir) / f"{stage}_{stamp}_{os.getpid()}_{uuid.uuid4().hex[:8]}.json"
+
+
+def load_summaries(summaries_dir: Path | str, pattern: str = "*.json") -> SummarySet:
+    """Merge every saved summary in a directory, e.g. all shards and runs of one stage."""
+    merged = SummarySet()
+    for path in sorted(Path(summaries_dir).glob(pattern)):
+        merged.merge(SummarySet.load(path))
+    return merged
+
+
+def summarise_dataset(dataset, summary_set: SummarySet | None = None) -> SummarySet:
+    """Backfill summaries of scores written before summaries existed, from a results dataset."""
+    summary_set = summary_set if summary_set is not None else SummarySet()
+    for df_batch in iter_batches(
+        dataset, ["model", "similarity_metric", "distance", "verified", "threshold"]
+    ):
+        summary_set.update(df_batch)
+    return summary_set
@@ -0,0 +1,270 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# log spaced duration buckets from 1us to ~3h, each 10% wider than the last
+BUCKET_GROWTH = 1.1
+MIN_SECONDS = 1e-6
+N_BUCKETS = 250
+EDGES = [MIN_SECONDS * BUCKET_GROWTH**i for i in range(N_BUCKETS + 1)]
+FLUSH_SECONDS = 10.0
+
+_enabled = False
+_spans_dir = None
+_stats = {}
+_lock = threading.Lock()
+_last_flush = 0.0
+_finalizer_pid = None
+_NULL_SPAN = nullcontext()
+
+
+class StageStats:
+    """Count, items, total and a duration histogram for one stage in one process."""
+
+    def __init__(self) -> None:
+        self.spans = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (N_BUCKETS + 2)
+
+    def add(self, seconds: float, n: int = 1) -> None:
+        self.spans += 1
+        self.items += n
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(EDGES, seconds)] += 1
+
+    def merge(self, other: "StageStats") -> "StageStats":
+        self.spans += other.spans
+        self.items += other.items
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        return self
+
+    def quantile(self, q: float) -> float:
+        """Geometric centre of the bucket holding the q-th span duration."""
+        if not self.spans:
+            return float("nan")
+        rank = q * (self.spans - 1)
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if rank < seen:
+                if i == 0:
+                    return MIN_SECONDS
+                if i > N_BUCKETS:
+                    return self.max
+                return math.sqrt(EDGES[i - 1] * EDGES[i])
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "spans": self.spans,
+            "items": self.items,
+            "total": self.total,
+            "max": self.max,
+            "buckets": {str(i): c for i, c in enumerate(self.buckets) if c},
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "StageStats":
+        stats = cls()
+        stats.spans, stats.items, stats.total, stats.max = d["spans"], d["items"], d["total"], d["max"]
+        for i, c in d["buckets"].items():
+            stats.buckets[int(i)] = c
+        return stats
+
+
+class _Span:
+    __slots__ = ("stage", "n", "t0")
+
+    def __init__(self, stage: str, n: int) -> None:
+        self.stage = stage
+        self.n = n
+
+    def __enter__(self) -> "_Span":
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        record(self.stage, time.perf_counter() - self.t0, self.n)
+
+
+def _worker_path() -> Path:
+    return _spans_dir / f"{os.getpid()}.json"
+
+
+def configure(spans_dir: Path | str | None) -> None:
+    """
+    Turn span timing on in this process, writing its stats to `spans_dir`, or
+    off with None. Stats a previous process with the same pid left there are
+    carried on, so each file stays one worker slot.
+    """
+    global _enabled, _spans_dir, _stats, _finalizer_pid
+    _enabled = spans_dir is not None
+    if not _enabled:
+        return
+    _spans_dir = Path(spans_dir)
+    _spans_dir.mkdir(parents=True, exist_ok=True)
+    _stats = {}
+    if _worker_path().exists():
+        _stats = {
+            stage: StageStats.from_dict(d)
+            for stage, d in json.loads(_worker_path().read_text()).items()
+        }
+    if _finalizer_pid != os.getpid():
+        # runs at exit of pool workers too, which skip atexit handlers; forked
+        # workers inherit the parent's finalizer, which only runs in the parent
+        Finalize(None, flush, kwargs={"force": True}, exitpriority=10)
+        _finalizer_pid = os.getpid()
+
+
+def init_worker(spans_dir: Path | str | None) -> None:
+    """`ProcessPoolExecutor` initializer, so workers time spans like the parent."""
+    configure(spans_dir)
+
+
+def record(stage: str, seconds: float, n: int = 1) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        if stage not in _stats:
+            _stats[stage] = StageStats()
+        _stats[stage].add(seconds, n)
+
+
+def span(stage: str, n: int = 1):
+    """
+    Context manager timing its block as one span of `stage` covering `n` items.
+    When timing is off this returns a shared no-op context.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(stage, n)
+
+
+def timed_iter(iterable, stage: str = "wait"):
+    """Yield from `iterable`, timing how long each next item took to arrive."""
+    if not _enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(stage, time.perf_counter() - t0)
+        yield item
+
+
+def flush(force: bool = False) -> None:
+    """Write this process's stats, at most every FLUSH_SECONDS unless forced."""
+    global _last_flush
+    if not _enabled or not _stats:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_SECONDS:
+        return
+    _last_flush = now
+    with _lock:
+        payload = json.dumps({stage: stats.to_dict() for stage, stats in _stats.items()})
+    tmp = _worker_path().with_suffix(".tmp")
+    tmp.write_text(payload)
+    os.replace(tmp, _worker_path())
+
+
+def load_stats(spans_dir: Path | str) -> dict:
+    """{worker: {stage: StageStats}} for every worker file in `spans_dir`."""
+    return {
+        path.stem: {
+            stage: StageStats.from_dict(d) for stage, d in json.loads(path.read_text()).items()
+        }
+        for path in sorted(Path(spans_dir).glob("*.json"))
+    }
+
+
+def _rows(stats_by_stage: dict, worker: str) -> list:
+    return [
+        {
+            "stage": stage,
+            "worker": worker,
+            "spans": stats.spans,
+            "items": stats.items,
+            "total_s": stats.total,
+            "mean_ms": stats.total / stats.spans * 1000,
+            "p50_ms": stats.quantile(0.5) * 1000,
+            "p95_ms": stats.quantile(0.95) * 1000,
+            "max_ms": stats.max * 1000,
+            "items_per_s": stats.items / stats.total if stats.total else float("inf"),
+        }
+        for stage, stats in sorted(stats_by_stage.items())
+        if stats.spans
+    ]
+
+
+def performance_report(spans_dir: Path | str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    returns
+    tuple[pd.DataFrame, pd.DataFrame]
+        per stage totals over all workers, and the same per worker.
+    """
+    by_worker = load_stats(spans_dir)
+    merged = {}
+    for stats_by_stage in by_worker.values():
+        for stage, stats in stats_by_stage.items():
+            merged.setdefault(stage, StageStats()).merge(stats)
+    df_stages = pd.DataFrame(_rows(merged, "all"))
+    df_workers = pd.DataFrame(
+        [row for worker, stats in by_worker.items() for row in _rows(stats, worker)]
+    )
+    if not df_stages.empty:
+        df_stages["workers"] = df_stages["stage"].map(
+            lambda stage: sum(stage in stats for stats in by_worker.values())
+        )
+    return df_stages, df_workers
+
+
+def start(enabled: bool) -> str | None:
+    """
+    Turn timing on for a Hydra run. Spans go under the run's output dir.
+
+    returns
+    str | None
+        the spans dir to pass to `init_worker` of process pools, None when off.
+    """
+    if not enabled:
+        configure(None)
+        return None
+    from hydra.core.hydra_config import HydraConfig
+
+    spans_dir = Path(HydraConfig.get().runtime.output_dir) / "spans"
+    configure(spans_dir)
+    return spans_dir.as_posix()
+
+
+def write_report() -> pd.DataFrame | None:
+    """Write performance.csv and performance_workers.csv next to the spans dir."""
+    if not _enabled:
+        return None
+    flush(force=True)
+    df_stages, df_workers = performance_report(_spans_dir)
+    df_stages.to_csv(_spans_dir.parent / "performance.csv", index=False)
+    df_workers.to_csv(_spans_dir.parent / "performance_workers.csv", index=False)
+    if not df_stages.empty:
+        log.info(f"Performance\n{df_stages.to_string(index=False, float_format='%.2f')}")
+    return df_stages
@@ -0,0 +1,225 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+log = logging.getLogger(__name__)
+
+# the storage account answers 503 Server Busy, and 429 on some endpoints, when throttling
+THROTTLE_STATUSES = (429, 503)
+TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRY_COLUMNS = ["user_id", "full_path", "selfie_link_id", "ts_date", "error", "attempts"]
+
+
+def status_code(error: BaseException) -> int | None:
+    return getattr(error, "status_code", None)
+
+
+def is_throttled(error: BaseException) -> bool:
+    return status_code(error) in THROTTLE_STATUSES
+
+
+def is_transient(error: BaseException) -> bool:
+    """Errors worth retrying: throttling, server errors, timeouts and dropped connections."""
+    return status_code(error) in TRANSIENT_STATUSES or isinstance(
+        error, (ServiceRequestError, ServiceResponseError, ConnectionError, TimeoutError)
+    )
+
+
+def retry_after(error: BaseException) -> float | None:
+    """Seconds from the Retry-After header of a throttled response, if it sent one."""
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class AimdLimiter:
+    """
+    Limit on the requests in flight to one storage account, adjusted like TCP
+    congestion control.
+
+    Every successful request within `latency_target` raises the limit by
+    `increase / limit`, so about `increase` per round of `limit` requests. A
+    throttled request (429/503), or a smoothed latency above `latency_target`,
+    multiplies it by `decrease`, at most once per smoothed latency, so one
+    burst of throttled responses counts as one signal.
+
+    parameters
+    initial, min_limit, max_limit : int
+        starting limit and its bounds.
+    latency_target : float | None
+        seconds per request above which the limit is lowered; None reacts to
+        throttling only.
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_target: float | None = None,
+    ) -> None:
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.latency = None
+        self._cond = threading.Condition()
+        self._t0 = time.monotonic()
+        self._last_decrease = -float("inf")
+        self.history = [(0.0, int(self.limit))]
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, seconds: float, throttled: bool = False) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+            slow = self.latency_target is not None and self.latency > self.latency_target
+            now = time.monotonic()
+            if throttled or slow:
+                if now - self._last_decrease > self.latency:
+                    self._set(max(self.min_limit, self.limit * self.decrease), now)
+                    self._last_decrease = now
+            else:
+                self._set(min(self.max_limit, self.limit + self.increase / self.limit), now)
+            self._cond.notify_all()
+
+    def _set(self, limit: float, now: float) -> None:
+        if int(limit) != int(self.limit):
+            self.history.append((now - self._t0, int(limit)))
+        self.limit = limit
+
+    def history_frame(self) -> pd.DataFrame:
+        """Seconds since start and the limit from then on, one row per change."""
+        return pd.DataFrame(self.history, columns=["seconds", "limit"])
+
+
+class BlobTransfer:
+    """
+    Runs blob requests under an `AimdLimiter` and retries throttled and
+    transient failures with full jitter exponential backoff: attempt n waits
+    a uniform draw up to min(max_delay, base_delay * 2**n), or the server's
+    Retry-After when that is longer. Missing blobs and other errors are not
+    retried.
+
+    The thread pool from `executor` is sized to `max_limit`; the limiter
+    decides how many of its threads talk to the storage account at a time.
+    Rows that still fail are collected with `add_failed` and written with
+    `save_retry_list`, so a later run downloads only those.
+    """
+
+    def __init__(
+        self,
+        limiter: AimdLimiter | None = None,
+        retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        seed: int | None = None,
+    ) -> None:
+        self.limiter = limiter or AimdLimiter()
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.throttled = 0
+        self.failed = []
+
+    @classmethod
+    def from_config(cls, cfg) -> "BlobTransfer":
+        """`BlobTransfer` from a `transfer` config block."""
+        limiter = AimdLimiter(
+            cfg.initial_concurrency,
+            cfg.min_concurrency,
+            cfg.max_concurrency,
+            cfg.increase,
+            cfg.decrease,
+            cfg.latency_target_seconds,
+        )
+        return cls(limiter, cfg.retries, cfg.base_delay_seconds, cfg.max_delay_seconds)
+
+    def executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self.limiter.max_limit)
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        with self._lock:
+            delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return max(delay, retry_after(error) or 0.0)
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """`fn(*args, **kwargs)` as one request under the limiter, retried while transient."""
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            t0 = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttled(e)
+                self.limiter.release(time.perf_counter() - t0, throttled)
+                with self._lock:
+                    self.requests += 1
+                    self.throttled += throttled
+                if not is_transient(e) or attempt == self.retries:
+                    e.attempts = attempt + 1
+                    raise
+                with self._lock:
+                    self.retried += 1
+                # back off outside the limiter, so the wait holds no slot
+                time.sleep(self.backoff(attempt, e))
+                continue
+            self.limiter.release(time.perf_counter() - t0)
+            with self._lock:
+                self.requests += 1
+            return result
+
+    def wrap(self, fn: Callable) -> Callable:
+        """`fn` as a task for the executor, every call going through `call`."""
+
+        def task(*args, **kwargs):
+            return self.call(fn, *args, **kwargs)
+
+        return task
+
+    def add_failed(self, row: dict, error: BaseException) -> None:
+        with self._lock:
+            self.failed.append(
+                {
+                    **{column: row.get(column) for column in RETRY_COLUMNS[:4]},
+                    "error": repr(error),
+                    "attempts": getattr(error, "attempts", 1),
+                }
+            )
+
+    def save_retry_list(self, path: Path | str) -> None:
+        """Replace the retry list with this run's failed rows; an empty list means nothing to retry."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame(self.failed, columns=RETRY_COLUMNS).to_csv(path, index=False)
+
+    def log_summary(self) -> None:
+        log.info(
+            f"{self.requests} blob requests, {self.throttled} throttled, {self.retried} retried, "
+            f"{len(self.failed)} failed; concurrency ended at {int(self.limiter.limit)} "
+            f"(max {max(limit for _, limit in self.limiter.history)})"
+        )
@@ -0,0 +1,250 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+import pandas as pd
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class Lease(NamedTuple):
+    unit_id: str
+    payload: dict
+    attempt: int
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Work units (e.g. blocks of rows of the inter user triangle) shared by any
+    number of processes and VMs through one sqlite file.
+
+    A worker leases a unit for `lease_seconds`, extends the lease with
+    `heartbeat` while it works and marks the unit done with `complete`. A lease
+    that is not extended in time, because its node died or hung, expires and
+    the unit is handed to the next `lease` call, until a unit has been tried
+    `max_attempts` times. Expiry uses wall clock time, so the nodes' clocks
+    must agree to well within `lease_seconds`.
+
+    Completing only succeeds while the lease is still held, but a unit whose
+    lease expired can still be finished by its old owner while another worker
+    redoes it. Work units should therefore write their output idempotently,
+    e.g. to one file per unit.
+
+    parameters
+    db_path : Path | str
+        sqlite file; on a mount shared between VMs use journal_mode "DELETE",
+        since WAL needs shared memory on one host.
+    lease_seconds : float
+        how long a lease lasts without a heartbeat.
+    max_attempts : int
+        leases per unit before it is marked failed.
+    owner : str | None
+        name of this worker in the queue, hostname:pid by default.
+    journal_mode : str
+        sqlite journal mode, "WAL" for a local disk.
+    """
+
+    def __init__(
+        self,
+        db_path: Path | str,
+        lease_seconds: float = 600,
+        max_attempts: int = 3,
+        owner: str | None = None,
+        journal_mode: str = "WAL",
+    ) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = owner or default_owner()
+        self._lock = threading.Lock()
+        # autocommit, so every write below is one explicit transaction
+        self.connector = sqlite3.connect(
+            self.db_path.as_posix(), timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.connector.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.connector.execute(
+            """
+            CREATE TABLE IF NOT EXISTS work_unit (
+                unit_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                detail TEXT,
+                updated_at TEXT
+            )
+            """
+        )
+        self.connector.execute(
+            "CREATE TABLE IF NOT EXISTS queue_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can
+        # never select the same unit before either marks it leased
+        with self._lock:
+            self.connector.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connector
+            except BaseException:
+                self.connector.execute("ROLLBACK")
+                raise
+            self.connector.execute("COMMIT")
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+    def ensure_plan(self, signature: str) -> None:
+        """
+        Record the plan the units were cut from, or check that it matches, so
+        nodes that see a different set of selfies cannot mix up the units.
+        """
+        with self._transaction() as con:
+            con.execute("INSERT OR IGNORE INTO queue_meta VALUES ('plan', ?)", (signature,))
+            (stored,) = con.execute("SELECT value FROM queue_meta WHERE key = 'plan'").fetchone()
+        if stored != signature:
+            raise ValueError(
+                f"Queue {self.db_path} was planned for {stored}, this node planned {signature}"
+            )
+
+    def add(self, units: Iterable[tuple[str, dict]]) -> int:
+        """Add (unit_id, payload) units; units that already exist are kept as they are."""
+        rows = [(unit_id, json.dumps(payload), PENDING, self._now()) for unit_id, payload in units]
+        with self._transaction() as con:
+            before = con.total_changes
+            con.executemany(
+                "INSERT OR IGNORE INTO work_unit (unit_id, payload, state, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            return con.total_changes - before
+
+    def lease(self, n: int = 1) -> list[Lease]:
+        """
+        Lease up to `n` pending units, or units whose lease expired, in unit_id
+        order. An empty list means nothing is left to lease right now.
+        """
+        now = time.time()
+        with self._transaction() as con:
+            con.execute(
+                "UPDATE work_unit SET state = ?, owner = NULL, detail = 'lease expired', updated_at = ? "
+                "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, self._now(), LEASED, now, self.max_attempts),
+            )
+            rows = con.execute(
+                "SELECT unit_id, payload, attempts FROM work_unit "
+                "WHERE state = ? OR (state = ? AND lease_expires < ?) "
+                "ORDER BY unit_id LIMIT ?",
+                (PENDING, LEASED, now, n),
+            ).fetchall()
+            con.executemany(
+                "UPDATE work_unit SET state = ?, owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE unit_id = ?",
+                [
+                    (LEASED, self.owner, now + self.lease_seconds, self._now(), unit_id)
+                    for unit_id, _, _ in rows
+                ],
+            )
+        return [Lease(unit_id, json.loads(payload), attempts + 1) for unit_id, payload, attempts in rows]
+
+    def wait_lease(self, n: int = 1, poll_seconds: float | None = None) -> list[Lease]:
+        """
+        Like `lease`, but while nothing is pending and other workers still hold
+        leases, poll every `poll_seconds`, so a lease lost by a crashed worker is
+        picked up when it expires. An empty list means the queue is finished.
+        """
+        poll_seconds = poll_seconds or self.lease_seconds / 3
+        while not (leases := self.lease(n)):
+            if self.counts()[LEASED] == 0:
+                break
+            time.sleep(poll_seconds)
+        return leases
+
+    def heartbeat(self, unit_ids: Iterable[str]) -> set:
+        """Extend the leases this worker still holds; returns the unit_ids it still holds."""
+        unit_ids = list(unit_ids)
+        if not unit_ids:
+            return set()
+        expires = time.time() + self.lease_seconds
+        with self._transaction() as con:
+            con.executemany(
+                "UPDATE work_unit SET lease_expires = ? WHERE unit_id = ? AND owner = ? AND state = ?",
+                [(expires, unit_id, self.owner, LEASED) for unit_id in unit_ids],
+            )
+            held = con.execute(
+                f"SELECT unit_id FROM work_unit WHERE owner = ? AND state = ? "
+                f"AND unit_id IN ({', '.join('?' * len(unit_ids))})",
+                (self.owner, LEASED, *unit_ids),
+            ).fetchall()
+        return {unit_id for (unit_id,) in held}
+
+    @contextmanager
+    def keep_alive(self, unit_ids: Iterable[str], interval: float | None = None):
+        """Heartbeat the leases from a background thread while the block runs."""
+        unit_ids = list(unit_ids)
+        interval = interval or self.lease_seconds / 3
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.heartbeat(unit_ids)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, unit_id: str) -> bool:
+        """Mark a unit done; False when the lease was lost to another worker meanwhile."""
+        with self._transaction() as con:
+            cursor = con.execute(
+                "UPDATE work_unit SET state = ?, lease_expires = NULL, updated_at = ? "
+                "WHERE unit_id = ? AND owner = ? AND state = ?",
+                (DONE, self._now(), unit_id, self.owner, LEASED),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, unit_id: str, detail: str = "") -> None:
+        """Give a unit back after an error; it is retried until `max_attempts`."""
+        with self._transaction() as con:
+            con.execute(
+                "UPDATE work_unit SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "owner = NULL, lease_expires = NULL, detail = ?, updated_at = ? "
+                "WHERE unit_id = ? AND owner = ? AND state = ?",
+                (self.max_attempts, FAILED, PENDING, detail, self._now(), unit_id, self.owner, LEASED),
+            )
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self.connector.execute(
+                "SELECT state, COUNT(*) FROM work_unit GROUP BY state"
+            ).fetchall()
+        return {state: 0 for state in (PENDING, LEASED, DONE, FAILED)} | dict(rows)
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql("SELECT * FROM work_unit ORDER BY unit_id", con=self.connector)
+
+    def close(self) -> None:
+        self.connector.close()
@@ -0,0 +1,279 @@
+import logging
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.data.decode import deepface_input
+from src.data.registry import SelfieRegistry, drop_bad_paths
+from src.data.shards import list_selfie_paths
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("tensorflow", "onnx")
+OPTIMIZATIONS = ("disable", "basic", "extended", "all")
+
+
+def preprocess(
+    img, model: str, detector_backend: str = "mediapipe", enforce_detection: bool = False
+) -> np.ndarray:
+    """
+    The first face of an image as the model's input batch of one, detected,
+    aligned, resized and normalised exactly like `DeepFace.represent`, so
+    every backend sees the same pixels.
+    """
+    from deepface.commons import functions
+
+    img_objs = functions.extract_faces(
+        img=img,
+        target_size=functions.find_target_size(model_name=model),
+        detector_backend=detector_backend,
+        grayscale=False,
+        enforce_detection=enforce_detection,
+        align=True,
+    )
+    face = functions.normalize_input(img=img_objs[0][0], normalization="base")
+    return np.asarray(face, dtype=np.float32)
+
+
+class EmbeddingBackend:
+    """
+    Runs one face model on preprocessed face batches (n, height, width, 3).
+    Subclasses load the model once per process and implement `embed`.
+    """
+
+    name = None
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+
+    def embed(self, faces: np.ndarray) -> np.ndarray:
+        """float32 embeddings of shape (n, dim)."""
+        raise NotImplementedError
+
+    def represent(self, img) -> np.ndarray:
+        """Embedding of the first face of an image path or BGR array, like `DeepFace.represent`."""
+        return self.embed(preprocess(img, self.model))[0]
+
+
+class TensorflowBackend(EmbeddingBackend):
+    """DeepFace's Keras model, as `DeepFace.represent` runs it."""
+
+    name = "tensorflow"
+
+    def __init__(self, model: str, net=None) -> None:
+        super().__init__(model)
+        if net is None:
+            import deepface.DeepFace as dpf
+
+            net = dpf.build_model(model)
+        self.net = net
+
+    def embed(self, faces: np.ndarray) -> np.ndarray:
+        return np.asarray(self.net(np.asarray(faces, dtype=np.float32), training=False), dtype=np.float32)
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    An exported model (see `export_onnx`) on ONNX Runtime's CPU provider.
+
+    parameters
+    onnx_path : Path | str
+        exported model.
+    intra_op_threads : int
+        threads within one operator; with a pool of worker processes keep
+        workers x threads at or below the cores, 0 lets ONNX Runtime use all.
+    inter_op_threads : int
+        threads across independent operators, only used by the parallel
+        execution mode, which helps branchy graphs and rarely face models.
+    optimization : str
+        graph optimization level, one of OPTIMIZATIONS.
+    optimized_path : Path | str | None
+        where to save the optimized graph, to inspect it or to load it with
+        optimization "disable" and skip the optimization at startup.
+    """
+
+    name = "onnx"
+
+    def __init__(
+        self,
+        model: str,
+        onnx_path: Path | str,
+        intra_op_threads: int = 1,
+        inter_op_threads: int = 1,
+        optimization: str = "all",
+        optimized_path: Path | str | None = None,
+    ) -> None:
+        import onnxruntime as ort
+
+        super().__init__(model)
+        levels = {
+            "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }
+        options = ort.SessionOptions()
+        options.graph_optimization_level = levels[optimization]
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1 else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+        if optimized_path is not None:
+            options.optimized_model_filepath = Path(optimized_path).as_posix()
+        self.session = ort.InferenceSession(
+            Path(onnx_path).as_posix(), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed(self, faces: np.ndarray) -> np.ndarray:
+        faces = np.ascontiguousarray(faces, dtype=np.float32)
+        return np.asarray(self.session.run(None, {self.input_name: faces})[0], dtype=np.float32)
+
+
+def onnx_path(onnx_dir: Path | str, model: str) -> Path:
+    return Path(onnx_dir) / f"{model}.onnx"
+
+
+def export_onnx(net, path: Path | str, opset: int = 13) -> Path:
+    """
+    Export a Keras model to ONNX with a variable batch size. Only needs
+    tf2onnx where the export runs, not where the ONNX model is served.
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    signature = [tf.TensorSpec((None, *net.input_shape[1:]), tf.float32, name="input")]
+    tf2onnx.convert.from_keras(net, input_signature=signature, opset=opset, output_path=path.as_posix())
+    return path
+
+
+@lru_cache(maxsize=None)
+def get_backend(
+    name: str,
+    model: str,
+    onnx_dir: str | None = None,
+    intra_op_threads: int = 1,
+    inter_op_threads: int = 1,
+    optimization: str = "all",
+) -> EmbeddingBackend:
+    """
+    The backend of a model, built once per process, so pool workers load a
+    model with their first task and reuse it for the rest.
+    """
+    if name == "tensorflow":
+        return TensorflowBackend(model)
+    if name == "onnx":
+        return OnnxBackend(
+            model, onnx_path(onnx_dir, model), intra_op_threads, inter_op_threads, optimization
+        )
+    raise ValueError(f"Unknown embedding backend {name}, expected one of {BACKENDS}")
+
+
+def backend_options(cfg: DictConfig) -> dict:
+    """Keyword arguments of `get_backend` from a `backend` config block."""
+    return {
+        "name": cfg.name,
+        "onnx_dir": cfg.onnx_dir,
+        "intra_op_threads": cfg.intra_op_threads,
+        "inter_op_threads": cfg.inter_op_threads,
+        "optimization": cfg.optimization,
+    }
+
+
+def parity(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    """How far a backend's embeddings are from the reference ones, row by row."""
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    cosine = 1 - np.sum(reference * candidate, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    )
+    return {
+        "n": len(reference),
+        "max_abs_diff": float(np.abs(reference - candidate).max()),
+        "max_rel_diff": float(
+            (np.linalg.norm(reference - candidate, axis=1) / np.linalg.norm(reference, axis=1)).max()
+        ),
+        "max_cosine_distance": float(cosine.max()),
+        "mean_cosine_distance": float(cosine.mean()),
+    }
+
+
+def seconds_per_call(backend: EmbeddingBackend, faces: list, warmup: int = 2) -> float:
+    for face in faces[:warmup]:
+        backend.embed(face)
+    t0 = time.perf_counter()
+    for face in faces:
+        backend.embed(face)
+    return (time.perf_counter() - t0) / len(faces)
+
+
+@hydra.main(config_path="../../config", config_name="config_inter", version_base=None)
+def main(cfg: DictConfig):
+    """
+    Export every model in `backend.parity.models` to ONNX where it is missing,
+    and compare ONNX Runtime against TensorFlow on a seeded sample of selfies.
+    """
+    shard_dir = cfg.shards.dir if cfg.shards.read else None
+    selfie_paths = drop_bad_paths(
+        list_selfie_paths(cfg.selfie_data.save_dir, shard_dir),
+        SelfieRegistry(cfg.registry.path).bad_keys(cfg.registry.skip),
+    )
+    rng = np.random.default_rng(cfg.backend.parity.seed)
+    sample = rng.choice(
+        len(selfie_paths), size=min(cfg.backend.parity.sample_size, len(selfie_paths)), replace=False
+    )
+    records = []
+    for model in cfg.backend.parity.models:
+        reference = TensorflowBackend(model)
+        path = onnx_path(cfg.backend.onnx_dir, model)
+        if cfg.backend.parity.export or not path.exists():
+            export_onnx(reference.net, path)
+            log.info(f"Exported {model} to {path}")
+        candidate = OnnxBackend(
+            model,
+            path,
+            cfg.backend.intra_op_threads,
+            cfg.backend.inter_op_threads,
+            cfg.backend.optimization,
+        )
+        faces = []
+        for i in sample:
+            img = deepface_input(
+                selfie_paths[i], cfg.decode.scale, model, cfg.decode.face_fraction, shard_dir
+            )
+            try:
+                faces.append(preprocess(img, model))
+            except Exception as e:
+                log.info(f"Model: {model}, selfie: {selfie_paths[i]}")
+                log.info(f"Error: {e}")
+        if not faces:
+            log.info(f"Skipping {model}: no sampled selfie could be preprocessed")
+            continue
+        batch = np.concatenate(faces)
+        records.append(
+            {
+                "model": model,
+                **parity(reference.embed(batch), candidate.embed(batch)),
+                "tensorflow_ms": seconds_per_call(reference, faces) * 1000,
+                "onnx_ms": seconds_per_call(candidate, faces) * 1000,
+            }
+        )
+    if not records:
+        log.info("No model had a preprocessed selfie, no parity report written")
+        return
+    df_parity = pd.DataFrame(records)
+    df_parity.to_csv(cfg.backend.parity.output, index=False)
+    log.info(f"\n{df_parity.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
@@ -0,0 +1,229 @@
+import logging
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.data.results import partition_keys, query
+from src.data.summaries import load_summaries
+
+log = logging.getLogger(__name__)
+
+
+def roc_curve(genuine: np.ndarray, impostor: np.ndarray) -> pd.DataFrame:
+    """
+    Error rates at every distinct distance threshold, a pair being accepted
+    when its distance is at or below the threshold.
+
+    Both distributions are merged and sorted once; the error rates are then
+    cumulative counts, so the whole curve is O(n log n).
+
+    returns
+    pd.DataFrame
+        threshold, far (impostors accepted) and frr (genuine pairs rejected),
+        with thresholds ascending.
+    """
+    genuine = np.asarray(genuine, dtype=np.float64)
+    impostor = np.asarray(impostor, dtype=np.float64)
+    distances = np.concatenate([genuine, impostor])
+    is_genuine = np.concatenate([np.ones(len(genuine), bool), np.zeros(len(impostor), bool)])
+    order = np.argsort(distances, kind="stable")
+    distances, is_genuine = distances[order], is_genuine[order]
+    genuine_accepted = np.cumsum(is_genuine)
+    impostor_accepted = np.cumsum(~is_genuine)
+    # with ties only the last position of each distance is a real threshold
+    last = np.r_[distances[1:] != distances[:-1], True]
+    return _rates(
+        distances[last], genuine_accepted[last], impostor_accepted[last], len(genuine), len(impostor)
+    )
+
+
+def roc_from_histograms(
+    genuine_counts: np.ndarray,
+    impostor_counts: np.ndarray,
+    edges: np.ndarray,
+    genuine_outside: tuple[int, int] = (0, 0),
+    impostor_outside: tuple[int, int] = (0, 0),
+) -> pd.DataFrame:
+    """
+    Same curve from two histograms with shared bins, thresholds at the bin
+    edges. `*_outside` are the (underflow, overflow) counts of distances
+    below and above the bins: underflow is accepted at every threshold,
+    overflow never, and both count in the totals the rates are shares of.
+    """
+    genuine_counts = np.asarray(genuine_counts)
+    impostor_counts = np.asarray(impostor_counts)
+    return _rates(
+        np.asarray(edges),
+        genuine_outside[0] + np.r_[0, np.cumsum(genuine_counts)],
+        impostor_outside[0] + np.r_[0, np.cumsum(impostor_counts)],
+        genuine_counts.sum() + sum(genuine_outside),
+        impostor_counts.sum() + sum(impostor_outside),
+    )
+
+
+def _rates(
+    thresholds: np.ndarray,
+    genuine_accepted: np.ndarray,
+    impostor_accepted: np.ndarray,
+    n_genuine: int,
+    n_impostor: int,
+) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "threshold": thresholds,
+            "far": impostor_accepted / max(n_impostor, 1),
+            "frr": 1 - genuine_accepted / max(n_genuine, 1),
+        }
+    )
+
+
+def equal_error_rate(roc: pd.DataFrame) -> tuple[float, float]:
+    """EER and its threshold, interpolated between the two thresholds where far - frr changes sign."""
+    diff = roc["far"].values - roc["frr"].values
+    i = int(np.searchsorted(diff, 0))
+    if i == 0:
+        return float(roc["frr"].iloc[0]), float(roc["threshold"].iloc[0])
+    if i == len(diff):
+        return float(roc["far"].iloc[-1]), float(roc["threshold"].iloc[-1])
+    # far rises and frr falls with the threshold, so diff is sorted
+    w = -diff[i - 1] / (diff[i] - diff[i - 1])
+    row0, row1 = roc.iloc[i - 1], roc.iloc[i]
+    eer = row0["far"] + w * (row1["far"] - row0["far"])
+    threshold = row0["threshold"] + w * (row1["threshold"] - row0["threshold"])
+    return float(eer), float(threshold)
+
+
+def far_at_frr(roc: pd.DataFrame, target_frr: float) -> tuple[float, float]:
+    """Lowest FAR (and its threshold) among thresholds that reject at most `target_frr` genuine pairs."""
+    i = int(np.argmax(roc["frr"].values <= target_frr))
+    if roc["frr"].iloc[i] > target_frr:
+        return float("nan"), float("nan")
+    return float(roc["far"].iloc[i]), float(roc["threshold"].iloc[i])
+
+
+def frr_at_far(roc: pd.DataFrame, target_far: float) -> tuple[float, float]:
+    """Lowest FRR (and its threshold) among thresholds that accept at most `target_far` impostors."""
+    i = int(np.searchsorted(roc["far"].values, target_far, side="right")) - 1
+    if i < 0:
+        return 1.0, float("nan")
+    return float(roc["frr"].iloc[i]), float(roc["threshold"].iloc[i])
+
+
+def min_cost_threshold(
+    roc: pd.DataFrame, cost_fa: float = 1.0, cost_fr: float = 1.0, p_genuine: float = 0.5
+) -> tuple[float, float]:
+    """Threshold minimising the expected cost of false accepts and false rejects."""
+    cost = cost_fa * (1 - p_genuine) * roc["far"].values + cost_fr * p_genuine * roc["frr"].values
+    i = int(np.argmin(cost))
+    return float(cost[i]), float(roc["threshold"].iloc[i])
+
+
+def auc(roc: pd.DataFrame) -> float:
+    far = np.r_[0.0, roc["far"].values]
+    tpr = np.r_[0.0, 1 - roc["frr"].values]
+    return float(np.sum(np.diff(far) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def operating_points(
+    roc: pd.DataFrame,
+    far_targets: list,
+    frr_targets: list,
+    cost_fa: float = 1.0,
+    cost_fr: float = 1.0,
+    p_genuine: float = 0.5,
+) -> dict:
+    eer, eer_threshold = equal_error_rate(roc)
+    min_cost, min_cost_thr = min_cost_threshold(roc, cost_fa, cost_fr, p_genuine)
+    record = {
+        "auc": auc(roc),
+        "eer": eer,
+        "eer_threshold": eer_threshold,
+        "min_cost": min_cost,
+        "min_cost_threshold": min_cost_thr,
+    }
+    for target in far_targets:
+        record[f"frr@far={target:g}"], record[f"threshold@far={target:g}"] = frr_at_far(roc, target)
+    for target in frr_targets:
+        record[f"far@frr={target:g}"], record[f"threshold@frr={target:g}"] = far_at_frr(roc, target)
+    return record
+
+
+def dataset_rocs(genuine_dataset: Path | str, impostor_dataset: Path | str):
+    """Yield ((model, metric), roc) from the score datasets, one partition in memory at a time."""
+    impostor_keys = set(partition_keys(impostor_dataset))
+    for key in partition_keys(genuine_dataset):
+        if key not in impostor_keys:
+            continue
+        model, metric = key
+        genuine = query(genuine_dataset, ["distance"], [model], [metric])["distance"]
+        impostor = query(impostor_dataset, ["distance"], [model], [metric])["distance"]
+        yield key, roc_curve(genuine.to_numpy(), impostor.to_numpy())
+
+
+def summary_rocs(
+    genuine_dir: Path | str,
+    impostor_dir: Path | str,
+    genuine_pattern: str = "intra_*.json",
+    impostor_pattern: str = "inter_*.json",
+):
+    """Yield ((model, metric), roc) from the streaming histograms, without reading any score."""
+    genuine = load_summaries(genuine_dir, genuine_pattern)
+    impostor = load_summaries(impostor_dir, impostor_pattern)
+    for key, genuine_summary in sorted(genuine.summaries.items()):
+        if key not in impostor.summaries:
+            continue
+        impostor_summary = impostor[key]
+        if not np.array_equal(genuine_summary.edges, impostor_summary.edges):
+            log.info(f"Skipping {key}: genuine and impostor histograms have different bins")
+            continue
+        yield key, roc_from_histograms(
+            genuine_summary.counts,
+            impostor_summary.counts,
+            genuine_summary.edges,
+            (genuine_summary.underflow, genuine_summary.overflow),
+            (impostor_summary.underflow, impostor_summary.overflow),
+        )
+
+
+@hydra.main(config_path="../../config", config_name="config_calibration", version_base=None)
+def main(cfg: DictConfig):
+    if cfg.calibration.source == "summaries":
+        rocs = summary_rocs(
+            cfg.calibration.summaries.dir,
+            cfg.calibration.summaries.dir,
+            cfg.calibration.summaries.genuine_pattern,
+            cfg.calibration.summaries.impostor_pattern,
+        )
+    else:
+        rocs = dataset_rocs(cfg.calibration.genuine_dataset, cfg.calibration.impostor_dataset)
+
+    records, list_roc = [], []
+    for (model, metric), roc in rocs:
+        records.append(
+            {
+                "model": model,
+                "similarity_metric": metric,
+                **operating_points(
+                    roc,
+                    list(cfg.calibration.far_targets),
+                    list(cfg.calibration.frr_targets),
+                    cfg.calibration.cost.false_accept,
+                    cfg.calibration.cost.false_reject,
+                    cfg.calibration.cost.p_genuine,
+                ),
+            }
+        )
+        list_roc.append(roc.assign(model=model, similarity_metric=metric))
+
+    df_calibration = pd.DataFrame(records)
+    df_calibration.to_csv(cfg.calibration.output, index=False)
+    pd.concat(list_roc).to_parquet(cfg.calibration.roc_output, index=False)
+    log.info(f"\n{df_calibration.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
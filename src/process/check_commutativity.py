@@ -1,38 +1,107 @@
-# %%
+import logging
+from collections import defaultdict
 from pathlib import Path
+
 import deepface.DeepFace as dpf
-from typing import List
+import hydra
 import pandas as pd
+from omegaconf import DictConfig
 
-# %%
-list_of_userdirs = list(Path("../../data/selfies").glob("*"))
-
-# %%
-results: List[dict] = []
-for user in list_of_userdirs[:5]:
-    pics = list(user.glob("*.jpg"))
-    results.extend(
-        (
-            dpf.verify(
-                img1_path=pics[0].as_posix(),
-                img2_path=pics[1].as_posix(),
-                enforce_detection=False,
-                detector_backend="mediapipe",
-                distance_metric="cosine",
-                model_name="OpenFace",
-            ),
-            dpf.verify(
-                img1_path=pics[1].as_posix(),
-                img2_path=pics[0].as_posix(),
-                enforce_detection=False,
-                detector_backend="mediapipe",
-                distance_metric="cosine",
-                model_name="OpenFace",
-            ),
+from src.data.decode import deepface_input
+from src.data.pool import bounded_map, recycling_pool
+from src.data.registry import SelfieRegistry, drop_bad_paths
+from src.data.shards import list_selfie_paths
+from src.process.pairs import plan, random_pairs
+
+log = logging.getLogger(__name__)
+
+
+def both_directions(
+    pic1: Path,
+    pic2: Path,
+    metric: str,
+    model: str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    shard_dir: Path | str | None = None,
+) -> dict:
+    """d(a, b) and d(b, a) of one pair, from the same decoded inputs."""
+    img1 = deepface_input(pic1, decode_scale, model, face_fraction, shard_dir)
+    img2 = deepface_input(pic2, decode_scale, model, face_fraction, shard_dir)
+    distances = [
+        dpf.verify(
+            img1_path=a,
+            img2_path=b,
+            enforce_detection=False,
+            detector_backend="mediapipe",
+            distance_metric=metric,
+            model_name=model,
+        )["distance"]
+        for a, b in ((img1, img2), (img2, img1))
+    ]
+    return {
+        "img1_path": pic1.as_posix(),
+        "img2_path": pic2.as_posix(),
+        "same_user": pic1.parent.name == pic2.parent.name,
+        "distance_ab": distances[0],
+        "distance_ba": distances[1],
+    }
+
+
+def symmetry_summary(df_audit: pd.DataFrame, tolerance: float = 1e-6) -> pd.DataFrame:
+    """Max and mean |d(a,b) - d(b,a)| and the share of pairs beyond `tolerance`, intra and inter."""
+    df_audit = df_audit.assign(abs_diff=(df_audit["distance_ab"] - df_audit["distance_ba"]).abs())
+    return (
+        df_audit.groupby("same_user")["abs_diff"]
+        .agg(pairs="count", max_abs_diff="max", mean_abs_diff="mean")
+        .join(
+            df_audit.assign(asymmetric=df_audit["abs_diff"] > tolerance)
+            .groupby("same_user")["asymmetric"]
+            .mean()
         )
+        .reset_index()
+    )
+
+
+@hydra.main(config_path="../../config", config_name="config", version_base=None)
+def main(cfg: DictConfig):
+    shard_dir = cfg.shards.dir if cfg.shards.read else None
+    paths_by_user = defaultdict(list)
+    for path in drop_bad_paths(
+        list_selfie_paths(cfg.selfie_data.save_dir, shard_dir),
+        SelfieRegistry(cfg.registry.path).bad_keys(cfg.registry.skip),
+    ):
+        paths_by_user[path.parent.name].append(path)
+    pairs = plan(
+        random_pairs(paths_by_user, cfg.audit.n_pairs, same_user=True, seed=cfg.audit.seed),
+        random_pairs(paths_by_user, cfg.audit.n_pairs, same_user=False, seed=cfg.audit.seed),
     )
+    rows = []
+    with recycling_pool(cfg.workers) as executor:
+        for (pic1, pic2), result, error in bounded_map(
+            executor,
+            both_directions,
+            pairs,
+            args=lambda pair: (
+                *pair,
+                cfg.metric,
+                cfg.model,
+                cfg.decode.scale,
+                cfg.decode.face_fraction,
+                shard_dir,
+            ),
+            desc="Auditing symmetry",
+        ):
+            if error is not None:
+                log.info(f"Pair {pic1}, {pic2}")
+                log.info(f"Error: {error}")
+                continue
+            rows.append(result)
+    df_audit = pd.DataFrame(rows)
+    df_audit.to_csv(f"../../results/symmetry_audit_{cfg.model}_{cfg.metric}.csv", index=False)
+    log.info(f"\n{symmetry_summary(df_audit, cfg.audit.tolerance).to_string(index=False)}")
 
-# %%
-df_results = pd.DataFrame.from_dict(results)
 
-# %%
+if __name__ == "__main__":
+    main()
+    print("Done!")
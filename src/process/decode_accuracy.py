@@ -0,0 +1,160 @@
+import logging
+import random
+from pathlib import Path
+
+import deepface.DeepFace as dpf
+import hydra
+import mediapipe as mp
+import numpy as np
+import pandas as pd
+from mediapipe.tasks import python
+from mediapipe.tasks.python import vision
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.data.decode import DCT_SCALES, read_selfie
+
+log = logging.getLogger(__name__)
+
+
+def get_landmarker(model_path: Path | str):
+    options = vision.FaceLandmarkerOptions(
+        base_options=python.BaseOptions(model_asset_path=Path(model_path).as_posix()),
+        running_mode=vision.RunningMode.IMAGE,
+        num_faces=1,
+        min_face_detection_confidence=0.5,
+        min_face_presence_confidence=0.5,
+    )
+    return vision.FaceLandmarker.create_from_options(options)
+
+
+def image_landmarks(landmarker, rgb_image: np.ndarray) -> np.ndarray | None:
+    image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_image)
+    faces = landmarker.detect(image).face_landmarks
+    if not faces:
+        return None
+    return np.array([(lm.x, lm.y) for lm in faces[0]], dtype=np.float32)
+
+
+def image_embedding(bgr_image: np.ndarray, model: str) -> np.ndarray:
+    return np.asarray(
+        dpf.represent(
+            img_path=bgr_image,
+            model_name=model,
+            enforce_detection=False,
+            detector_backend="mediapipe",
+        )[0]["embedding"],
+        dtype=np.float32,
+    )
+
+
+def cosine_distance(a: np.ndarray, b: np.ndarray) -> float:
+    return float(1 - a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def compare_scales(
+    img_path: Path, landmarker, models: list, backend: str = "pil"
+) -> list[dict]:
+    """
+    Compare landmarks and embeddings of every DCT scale against the full
+    resolution decode of the same selfie.
+
+    returns
+    list
+        one record per scale and model (model "mediapipe" holds the landmarks),
+        with the mean landmark displacement in normalised image coordinates or
+        the cosine distance to the full resolution embedding.
+    """
+    decoded = {
+        scale: read_selfie(img_path, scale=scale, backend=backend)
+        for scale in DCT_SCALES
+    }
+    records = []
+
+    reference = image_landmarks(landmarker, decoded[1])
+    for scale, rgb_image in decoded.items():
+        landmarks = image_landmarks(landmarker, rgb_image)
+        error = (
+            np.nan
+            if reference is None or landmarks is None
+            else float(np.linalg.norm(landmarks - reference, axis=1).mean())
+        )
+        records.append(
+            {
+                "img_path": img_path.as_posix(),
+                "model": "mediapipe",
+                "scale": scale,
+                "height": rgb_image.shape[0],
+                "detected": landmarks is not None,
+                "error": error,
+            }
+        )
+
+    for model in models:
+        reference = image_embedding(np.ascontiguousarray(decoded[1][:, :, ::-1]), model)
+        for scale, rgb_image in decoded.items():
+            embedding = image_embedding(np.ascontiguousarray(rgb_image[:, :, ::-1]), model)
+            records.append(
+                {
+                    "img_path": img_path.as_posix(),
+                    "model": model,
+                    "scale": scale,
+                    "height": rgb_image.shape[0],
+                    "detected": True,
+                    "error": cosine_distance(embedding, reference),
+                }
+            )
+    return records
+
+
+def summarise(
+    df_accuracy: pd.DataFrame, tolerance: float, landmark_tolerance: float
+) -> pd.DataFrame:
+    df_summary = (
+        df_accuracy.groupby(["model", "scale"])
+        .agg(
+            mean_error=("error", "mean"),
+            p95_error=("error", lambda x: x.quantile(0.95)),
+            detection_rate=("detected", "mean"),
+        )
+        .reset_index()
+    )
+    limit = np.where(df_summary["model"] == "mediapipe", landmark_tolerance, tolerance)
+    df_summary["within_tolerance"] = df_summary["p95_error"] <= limit
+    return df_summary
+
+
+def recommended_scales(df_summary: pd.DataFrame) -> dict:
+    passing = df_summary.loc[df_summary["within_tolerance"]]
+    return passing.groupby("model")["scale"].max().to_dict()
+
+
+@hydra.main(config_path="../../config", config_name="config_decode", version_base=None)
+def main(cfg: DictConfig):
+    selfie_paths = sorted(Path(cfg.selfie_data.save_dir).glob("*/*.jpg"))
+    random.seed(cfg.decode.seed)
+    sample = random.sample(selfie_paths, min(cfg.decode.sample_size, len(selfie_paths)))
+    landmarker = get_landmarker(cfg.landmarks.model_path)
+
+    records = []
+    for img_path in tqdm(sample, desc="Comparing decode scales"):
+        try:
+            records.extend(
+                compare_scales(img_path, landmarker, list(cfg.decode.models), cfg.decode.backend)
+            )
+        except Exception as e:
+            log.info(f"Error processing {img_path}: {e}")
+
+    df_accuracy = pd.DataFrame(records)
+    df_accuracy.to_csv("../../results/decode_accuracy.csv", index=False)
+    df_summary = summarise(
+        df_accuracy, cfg.decode.tolerance, cfg.decode.landmark_tolerance
+    )
+    df_summary.to_csv("../../results/decode_accuracy_summary.csv", index=False)
+    log.info(f"\n{df_summary.to_string(index=False)}")
+    log.info(f"Largest scale within tolerance per model: {recommended_scales(df_summary)}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
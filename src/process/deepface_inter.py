@@ -1,41 +1,73 @@
 # %%
-from concurrent.futures import ProcessPoolExecutor
-import concurrent.futures
+import os
 import pandas as pd
 from pathlib import Path
 import deepface.DeepFace as dpf
-from typing import List
+from typing import Iterable, List
 from omegaconf import DictConfig
 import hydra
 import logging
 
 from tqdm import tqdm
 
+from src.data.decode import deepface_found_face, deepface_input
+from src.data.pool import bounded_map, memory_log_path, recycling_pool
+from src.data.registry import NO_FACE, SelfieRegistry, drop_bad_paths, path_key
+from src.data.shards import list_selfie_paths
+from src.data.summaries import SummarySet, summary_path
+from src.data.work_queue import WorkQueue
+from src.process.pairs import by_first, inter_pairs, plan_signature, row_blocks
+from src.data import timing
+
 log = logging.getLogger(__name__)
 
 
-def get_users_latest_selfies(selfies_dir: Path | str):
-    selfies_dir = Path(selfies_dir)
-    latest_selfie_paths: List[Path] = [
-        sorted(user.glob("*.jpg"))[-1] for user in selfies_dir.glob("*")
-    ]
+def get_users_latest_selfies(
+    selfies_dir: Path | str,
+    bad_keys: set = frozenset(),
+    shard_dir: Path | str | None = None,
+):
+    latest_selfies = {}
+    # sorted by user, then by date, so the last path seen per user is the latest
+    for path in drop_bad_paths(list_selfie_paths(selfies_dir, shard_dir), bad_keys):
+        latest_selfies[path.parent.name] = path
+    latest_selfie_paths: List[Path] = list(latest_selfies.values())
     return latest_selfie_paths
 
 
-selfies = get_users_latest_selfies("../../data/selfies")
-
-
-def inter_user_comps(pic1: Path, pic2: Path, metric: str, model: str):
-    dpf_dict = dpf.verify(
-        img1_path=pic1.as_posix(),
-        img2_path=pic2.as_posix(),
-        enforce_detection=False,
-        detector_backend="mediapipe",
-        distance_metric=metric,
-        model_name=model,
-    )
+def inter_user_comps(
+    pic1: Path,
+    pic2: Path,
+    metric: str,
+    model: str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    shard_dir: Path | str | None = None,
+):
+    """
+    Scores of one pair of selfies, and (key, status, detail) registry records
+    of the selfies DeepFace found no face in.
+    """
+    img1 = deepface_input(pic1, decode_scale, model, face_fraction, shard_dir)
+    img2 = deepface_input(pic2, decode_scale, model, face_fraction, shard_dir)
+    # detection, both embeddings and the distance
+    with timing.span("verify"):
+        dpf_dict = dpf.verify(
+            img1_path=img1,
+            img2_path=img2,
+            enforce_detection=False,
+            detector_backend="mediapipe",
+            distance_metric=metric,
+            model_name=model,
+        )
+    no_face = [
+        (path_key(pic), NO_FACE, "deepface verify")
+        for pic, img, area in ((pic1, img1, "img1"), (pic2, img2, "img2"))
+        if not deepface_found_face(img, dpf_dict["facial_areas"][area])
+    ]
     dpf_dict["facial_areas"] = [dpf_dict["facial_areas"]]
-    return pd.DataFrame(
+    timing.flush()
+    df_scores = pd.DataFrame(
         {
             **{
                 "user1_id": int(pic1.parent.name),
@@ -46,55 +78,163 @@ def inter_user_comps(pic1: Path, pic2: Path, metric: str, model: str):
             **dpf_dict,
         }
     )
+    return df_scores, no_face
+
+
+def score_partners(
+    executor,
+    pic1: Path,
+    partners: Iterable[Path],
+    n_partners: int,
+    cfg: DictConfig,
+    output: Path | str,
+    summaries: SummarySet,
+    registry: SelfieRegistry | None = None,
+) -> None:
+    """
+    Score one selfie against its partners, appending the scores to `output`
+    and recording the selfies DeepFace found no face in to `registry`.
+    """
+    output = Path(output)
+    no_face = {}
+    tasks = bounded_map(
+        executor,
+        inter_user_comps,
+        partners,
+        args=lambda pic2: (
+            pic1,
+            pic2,
+            cfg.metric,
+            cfg.model,
+            cfg.decode.scale,
+            cfg.decode.face_fraction,
+            cfg.shards.dir if cfg.shards.read else None,
+        ),
+        desc="Inner loop iterating over user selfies",
+        total=n_partners,
+    )
+    for pic2, result, error in timing.timed_iter(tasks):
+        try:
+            if error is not None:
+                raise error
+            df_scores, records = result
+            no_face.update((key, (key, status, detail)) for key, status, detail in records)
+            with timing.span("write", len(df_scores)):
+                df_scores.to_csv(output, index=False, mode="a", header=not output.exists())
+            with timing.span("summarise", len(df_scores)):
+                summaries.update(df_scores)
+        except Exception as e:
+            log.info(
+                f"Metric: {cfg.metric}, model: {cfg.model}, user1: {pic1.parent.name}, user2: {pic2.parent.name}"
+            )
+            log.info(f"Error: {e}")
+    if registry is not None and no_face:
+        registry.record_many("verify", no_face.values())
+
+
+def run_queue(
+    executor, latest_selfie_paths: list, cfg: DictConfig, registry: SelfieRegistry | None = None
+) -> None:
+    """
+    Lease blocks of rows of the triangle from the shared work queue until all
+    are done or failed, so any number of VMs can work on one run. Every block writes its
+    own score part and summary, replaced whole when the block finishes, so a
+    block redone after a lost lease overwrites its output instead of doubling it.
+    """
+    queue = WorkQueue(
+        cfg.queue.path,
+        cfg.queue.lease_seconds,
+        cfg.queue.max_attempts,
+        journal_mode=cfg.queue.journal_mode,
+    )
+    queue.ensure_plan(plan_signature(latest_selfie_paths))
+    added = queue.add(
+        (f"rows_{start:06d}_{stop:06d}", {"start": start, "stop": stop})
+        for start, stop in row_blocks(len(latest_selfie_paths), cfg.queue.pairs_per_unit)
+    )
+    log.info(f"Queue {cfg.queue.path}: added {added} units, {queue.counts()}")
+    parts_dir = Path(cfg.queue.parts_dir)
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    # polls while other nodes hold leases, so the last node left redoes a crashed node's units
+    while leases := queue.wait_lease(poll_seconds=cfg.queue.heartbeat_seconds):
+        (lease,) = leases
+        start, stop = lease.payload["start"], lease.payload["stop"]
+        part = parts_dir / f"{lease.unit_id}.csv"
+        partial = parts_dir / f"{lease.unit_id}.{os.getpid()}.partial"
+        partial.unlink(missing_ok=True)
+        summaries = SummarySet(cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy)
+        try:
+            with queue.keep_alive([lease.unit_id], cfg.queue.heartbeat_seconds):
+                for i in tqdm(range(start, stop), desc=f"Unit {lease.unit_id}"):
+                    score_partners(
+                        executor,
+                        latest_selfie_paths[i],
+                        latest_selfie_paths[i + 1 :],
+                        len(latest_selfie_paths) - i - 1,
+                        cfg,
+                        partial,
+                        summaries,
+                        registry,
+                    )
+                summaries.save(Path(cfg.summaries.dir) / f"inter_{lease.unit_id}.json")
+                os.replace(partial, part)
+            if not queue.complete(lease.unit_id):
+                log.info(f"Lease on {lease.unit_id} expired before it finished, another worker redoes it")
+        except Exception as e:
+            log.info(f"Unit: {lease.unit_id}, attempt {lease.attempt}")
+            log.info(f"Error: {e}")
+            queue.fail(lease.unit_id, str(e))
+    log.info(f"Queue {cfg.queue.path}: {queue.counts()}")
+    queue.close()
 
 
 @hydra.main(config_path="../../config", config_name="config_inter", version_base=None)
 def main(cfg: DictConfig):
-    # chunks_of_users = np.array_split(list_of_users, 5)
-    # chunk_to_process = chunks_of_users[cfg.user_chunk]
-    latest_selfie_paths = get_users_latest_selfies(cfg.selfie_data.save_dir)
+    # in plan order, so the position of a selfie gives its number of partners
+    registry = SelfieRegistry(cfg.registry.path)
+    latest_selfie_paths = sorted(
+        get_users_latest_selfies(
+            cfg.selfie_data.save_dir,
+            registry.bad_keys(cfg.registry.skip),
+            cfg.shards.dir if cfg.shards.read else None,
+        ),
+        key=path_key,
+    )
+    spans_dir = timing.start(cfg.timing.enabled)
+    # one pool for the whole run, so workers keep their loaded models across outer users
+    executor = recycling_pool(cfg.workers, initializer=timing.init_worker, initargs=(spans_dir,))
+    if cfg.queue.enabled:
+        with executor:
+            run_queue(executor, latest_selfie_paths, cfg, registry)
+        executor.save_memory(memory_log_path())
+        timing.write_report()
+        return
+
     df_done = pd.read_csv("../../results/inter_user_scores.csv")
     finished_users = df_done["user1_id"].unique()
-    with tqdm(
+    summaries = SummarySet(cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy)
+    summaries_path = summary_path(cfg.summaries.dir, "inter")
+    with executor, tqdm(
         desc="Outer loop iterating over user selfies", total=len(latest_selfie_paths)
     ) as pbar_outer:
-        for i, pic1 in enumerate(latest_selfie_paths):
+        for i, (pic1, partners) in enumerate(by_first(inter_pairs(latest_selfie_paths))):
             if int(pic1.parent.name) in finished_users:
                 pbar_outer.update(1)
                 continue
-            with tqdm(
-                desc="Inner loop iterating over user selfies",
-                total=len(latest_selfie_paths[i + 1 :]),
-            ) as pbar_inner:
-                with ProcessPoolExecutor(max_workers=32) as executor:
-                    futures = [
-                        executor.submit(
-                            inter_user_comps,
-                            pic1,
-                            pic2,
-                            cfg.metric,
-                            cfg.model,
-                        )
-                        for pic2 in latest_selfie_paths[i + 1 :]
-                    ]
-                    for future in concurrent.futures.as_completed(futures):
-                        try:
-                            df_scores = future.result()
-                            df_scores.to_csv(
-                                "../../results/inter_user_scores.csv",
-                                index=False,
-                                mode="a",
-                                header=not Path(
-                                    "../../results/inter_user_scores.csv"
-                                ).exists(),
-                            )
-                        except Exception as e:
-                            log.info(
-                                f"Metric: {cfg.metric}, model: {cfg.model}, user1: {df_scores['user1_id']}, user2: {df_scores['user2_id']}"
-                            )
-                            log.info(f"Error: {e}")
-                        pbar_inner.update(1)
+            score_partners(
+                executor,
+                pic1,
+                partners,
+                len(latest_selfie_paths) - i - 1,
+                cfg,
+                "../../results/inter_user_scores.csv",
+                summaries,
+                registry,
+            )
+            summaries.save(summaries_path)
             pbar_outer.update(1)
+    executor.save_memory(memory_log_path())
+    timing.write_report()
 
 
 if __name__ == "__main__":
@@ -2,8 +2,6 @@ import hydra
 import time
 import logging
 from omegaconf import DictConfig
-import concurrent.futures
-from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from random import sample
 import more_itertools as mit
@@ -11,69 +9,146 @@ import deepface.DeepFace as dpf
 import pandas as pd
 import numpy as np
 import os
-from tqdm import tqdm
+
+from src.data.decode import deepface_found_face, deepface_input
+from src.data.pool import bounded_map, memory_log_path, recycling_pool
+from src.data.prefetch import PrefetchReader
+from src.data.registry import NO_FACE, SelfieRegistry, drop_bad_paths, path_key
+from src.data.shards import list_user_selfie_paths
+from src.data.summaries import SummarySet, summary_path
+from src.process.pairs import intra_pairs
+from src.data import timing
 
 log = logging.getLogger(__name__)
 
 
-def intra_user_comps(target_user: int, selfies_dir: Path, metric: str, model: str):
-    target_user_pics = list(Path(selfies_dir / str(target_user)).glob("*.jpg"))
-    list_df = []
-    for pic in target_user_pics[1:]:
-        dpf_dict = dpf.verify(
-            img1_path=target_user_pics[0].as_posix(),
-            img2_path=pic.as_posix(),
-            enforce_detection=False,
-            detector_backend="mediapipe",
-            distance_metric=metric,
-            model_name=model,
+def intra_user_comps(
+    target_user: int,
+    selfies_dir: Path,
+    metric: str,
+    model: str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    bad_keys: set = frozenset(),
+    shard_dir: Path | str | None = None,
+    prefetch: DictConfig | None = None,
+    pair_mode: str = "first",
+):
+    """
+    Scores of the configured pairs of one user's selfies, one frame per pair,
+    and (key, status, detail) registry records of the selfies DeepFace found
+    no face in.
+    """
+    pairs = intra_pairs(
+        drop_bad_paths(list_user_selfie_paths(selfies_dir, target_user, shard_dir), bad_keys),
+        pair_mode,
+    )
+    reader = None
+    if prefetch is not None and prefetch.enabled:
+        # read the second selfie of the next pairs while the current pair is verified
+        reader = PrefetchReader(
+            [pic2 for _, pic2 in pairs],
+            prefetch.max_bytes,
+            prefetch.threads,
+            prefetch.max_ahead,
+            shard_dir,
         )
+        partners = iter(reader)
+    else:
+        partners = ((pic2, None) for _, pic2 in pairs)
+    list_df = []
+    no_face = {}
+    pic1, img1 = None, None
+    for (anchor, _), (pic2, data) in zip(pairs, partners):
+        # pairs are grouped by their first selfie, which is decoded once per group
+        if anchor != pic1:
+            pic1 = anchor
+            img1 = deepface_input(pic1, decode_scale, model, face_fraction, shard_dir)
+        img2 = deepface_input(pic2, decode_scale, model, face_fraction, shard_dir, data)
+        # detection, both embeddings and the distance
+        with timing.span("verify"):
+            dpf_dict = dpf.verify(
+                img1_path=img1,
+                img2_path=img2,
+                enforce_detection=False,
+                detector_backend="mediapipe",
+                distance_metric=metric,
+                model_name=model,
+            )
+        for pic, img, area in ((pic1, img1, "img1"), (pic2, img2, "img2")):
+            if not deepface_found_face(img, dpf_dict["facial_areas"][area]):
+                no_face[path_key(pic)] = (path_key(pic), NO_FACE, "deepface verify")
         dpf_dict["facial_areas"] = [dpf_dict["facial_areas"]]
         list_df.append(
             pd.DataFrame(
                 {
                     **{
                         "user_id": target_user,
-                        "img1_path": target_user_pics[0].as_posix(),
-                        "img2_path": pic.as_posix(),
+                        "img1_path": pic1.as_posix(),
+                        "img2_path": pic2.as_posix(),
                     },
                     **dpf_dict,
                 }
             )
         )
-    return list_df
+    if reader is not None:
+        log.debug(f"User {target_user} prefetch: {reader.stats}")
+    timing.flush()
+    return list_df, list(no_face.values())
 
 
 @hydra.main(config_path="../../config", config_name="config", version_base=None)
 def main(cfg: DictConfig):
     # list_of_users = [user for user in os.listdir(cfg.selfie_data.save_dir)]
     list_of_users = pd.read_csv('../../analytics/check-selfie-quality/user_completed.csv').user_id.unique()
+    registry = SelfieRegistry(cfg.registry.path)
+    bad_keys_by_user = registry.bad_keys_by_user(cfg.registry.skip)
+    summaries = SummarySet(cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy)
+    spans_dir = timing.start(cfg.timing.enabled)
     
-    with tqdm(desc="Performing Facial Recognition", total=len(list_of_users)) as pbar:
-        with ProcessPoolExecutor(max_workers=8, max_tasks_per_child=3500) as executor:
-            futures = [
-                executor.submit(
-                    intra_user_comps,
-                    user,
-                    Path(cfg.selfie_data.save_dir),
-                    cfg.metric,
-                    cfg.model,
-                )
-                for user in list_of_users
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    df_scores = pd.concat(future.result())
+    with recycling_pool(
+        cfg.workers, initializer=timing.init_worker, initargs=(spans_dir,)
+    ) as executor:
+        tasks = bounded_map(
+            executor,
+            intra_user_comps,
+            list_of_users,
+            args=lambda user: (
+                user,
+                Path(cfg.selfie_data.save_dir),
+                cfg.metric,
+                cfg.model,
+                cfg.decode.scale,
+                cfg.decode.face_fraction,
+                bad_keys_by_user.get(user, frozenset()),
+                cfg.shards.dir if cfg.shards.read else None,
+                cfg.prefetch,
+                cfg.pairs.intra_mode,
+            ),
+            desc="Performing Facial Recognition",
+        )
+        for user, result, error in timing.timed_iter(tasks):
+            try:
+                if error is not None:
+                    raise error
+                list_df, no_face = result
+                registry.record_many("verify", no_face)
+                df_scores = pd.concat(list_df)
+                with timing.span("write", len(df_scores)):
                     df_scores.to_csv(
                         "../../results/scores.csv",
                         index=False,
                         mode="a",
                         header=not Path("../../results/scores.csv").exists(),
                     )
-                except Exception as e:
-                    log.info(f"Metric: {cfg.metric}, and model: {cfg.model}")
-                    log.info(f"Error: {e}")
-                pbar.update(1)
+                with timing.span("summarise", len(df_scores)):
+                    summaries.update(df_scores)
+            except Exception as e:
+                log.info(f"Metric: {cfg.metric}, model: {cfg.model}, user: {user}")
+                log.info(f"Error: {e}")
+    summaries.save(summary_path(cfg.summaries.dir, "intra"))
+    executor.save_memory(memory_log_path())
+    timing.write_report()
 
 
 if __name__ == "__main__":
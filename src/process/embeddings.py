@@ -0,0 +1,279 @@
+import concurrent.futures
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.data.decode import deepface_input
+from src.data.registry import SelfieRegistry, drop_bad_paths
+from src.data.shards import list_selfie_paths
+from src.process.backends import backend_options, get_backend
+
+log = logging.getLogger(__name__)
+
+
+def represent_selfie(
+    img_path: Path,
+    model: str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    shard_dir: Path | str | None = None,
+    backend: dict | None = None,
+) -> np.ndarray:
+    """
+    Embedding of a selfie's face, through `DeepFace.represent` or, given the
+    `get_backend` keyword arguments as `backend`, through that backend.
+    """
+    img = deepface_input(img_path, decode_scale, model, face_fraction, shard_dir)
+    if backend is not None:
+        return get_backend(model=model, **backend).represent(img)
+    # DeepFace (and with it TensorFlow) only loads where it is used
+    import deepface.DeepFace as dpf
+
+    return np.asarray(
+        dpf.represent(
+            img_path=img,
+            model_name=model,
+            enforce_detection=False,
+            detector_backend="mediapipe",
+        )[0]["embedding"],
+        dtype=np.float32,
+    )
+
+
+def compute_embeddings(
+    selfie_paths: list,
+    model: str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    max_workers: int = 8,
+    shard_dir: Path | str | None = None,
+    backend: dict | None = None,
+) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Embed every selfie once, so pair distances become matrix products instead
+    of one `dpf.verify` call (and two forward passes) per pair.
+
+    returns
+    tuple
+        index with user_id and img_path per row, and the float32 embedding matrix.
+    """
+    embeddings = {}
+    with tqdm(desc=f"Embedding selfies with {model}", total=len(selfie_paths)) as pbar:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    represent_selfie, path, model, decode_scale, face_fraction, shard_dir, backend
+                ): path
+                for path in selfie_paths
+            }
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    embeddings[path] = future.result()
+                except Exception as e:
+                    log.info(f"Model: {model}, selfie: {path}")
+                    log.info(f"Error: {e}")
+                pbar.update(1)
+
+    paths = [path for path in selfie_paths if path in embeddings]
+    df_index = pd.DataFrame(
+        {
+            "user_id": [int(Path(path).parent.name) for path in paths],
+            "img_path": [Path(path).as_posix() for path in paths],
+        }
+    )
+    return df_index, np.stack([embeddings[path] for path in paths])
+
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+class Int8Matrix:
+    """
+    Embedding matrix stored as int8 codes with a per dimension scale and
+    offset, a quarter of the float32 size. Indexing rows returns them
+    dequantized to float32, so the distance kernels only ever expand the
+    rows of the current block.
+    """
+
+    def __init__(self, codes: np.ndarray, scale: np.ndarray, offset: np.ndarray) -> None:
+        self.codes = codes
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+
+    @classmethod
+    def quantize(cls, matrix: np.ndarray) -> "Int8Matrix":
+        """Per dimension affine quantization of the range of every dimension to -127..127."""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        low, high = matrix.min(axis=0), matrix.max(axis=0)
+        offset = (high + low) / 2
+        scale = np.where(high > low, (high - low) / 254, 1).astype(np.float32)
+        codes = np.clip(np.rint((matrix - offset) / scale), -127, 127).astype(np.int8)
+        return cls(codes, scale, offset)
+
+    @property
+    def shape(self) -> tuple:
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes + self.offset.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        return np.asarray(self.codes[rows], dtype=np.float32) * self.scale + self.offset
+
+    def subset(self, rows) -> "Int8Matrix":
+        return Int8Matrix(np.asarray(self.codes[rows]), self.scale, self.offset)
+
+    def save(self, path: Path | str) -> None:
+        path = Path(path)
+        np.save(path, self.codes)
+        np.savez(path.with_name(f"{path.stem}_params.npz"), scale=self.scale, offset=self.offset)
+
+    @classmethod
+    def load(cls, path: Path | str, mmap: bool = False) -> "Int8Matrix":
+        path = Path(path)
+        params = np.load(path.with_name(f"{path.stem}_params.npz"))
+        return cls(np.load(path, mmap_mode="r" if mmap else None), params["scale"], params["offset"])
+
+
+def embeddings_path(embeddings_dir: Path | str, model: str, precision: str = "float32") -> Path:
+    # float32 keeps its original name, so existing embedding dirs stay readable
+    suffix = "" if precision == "float32" else f".{precision}"
+    return Path(embeddings_dir) / f"{model}{suffix}.npy"
+
+
+def to_precision(matrix: np.ndarray, precision: str):
+    if precision == "float32":
+        return np.asarray(matrix, dtype=np.float32)
+    if precision == "float16":
+        return np.asarray(matrix, dtype=np.float16)
+    if precision == "int8":
+        return Int8Matrix.quantize(matrix)
+    raise ValueError(f"Precision must be one of {PRECISIONS}, got {precision}")
+
+
+def save_embeddings(
+    embeddings_dir: Path | str,
+    model: str,
+    df_index: pd.DataFrame,
+    matrix: np.ndarray,
+    precisions: Iterable[str] = ("float32",),
+) -> None:
+    """Save the embeddings, plus compact float16 or int8 copies when asked for."""
+    embeddings_dir = Path(embeddings_dir)
+    embeddings_dir.mkdir(parents=True, exist_ok=True)
+    for precision in precisions:
+        compact = to_precision(matrix, precision)
+        path = embeddings_path(embeddings_dir, model, precision)
+        if isinstance(compact, Int8Matrix):
+            compact.save(path)
+        else:
+            np.save(path, compact)
+    df_index.to_csv(embeddings_dir / f"{model}_index.csv", index=False)
+
+
+def load_embeddings(
+    embeddings_dir: Path | str, model: str, mmap: bool = False, precision: str = "float32"
+) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    returns
+    tuple
+        index and the matrix in `precision`; an `Int8Matrix` for int8.
+    """
+    embeddings_dir = Path(embeddings_dir)
+    path = embeddings_path(embeddings_dir, model, precision)
+    if precision == "int8":
+        matrix = Int8Matrix.load(path, mmap)
+    else:
+        matrix = np.load(path, mmap_mode="r" if mmap else None)
+    df_index = pd.read_csv(embeddings_dir / f"{model}_index.csv")
+    return df_index, matrix
+
+
+def take_rows(matrix, rows):
+    """Rows of an embedding matrix, kept in its storage precision."""
+    return matrix.subset(rows) if isinstance(matrix, Int8Matrix) else np.asarray(matrix[rows])
+
+
+def l2_normalise(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def pairwise_distances(a: np.ndarray, b: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Distances between all rows of `a` and all rows of `b`, with the same
+    definitions as `deepface.commons.distance`.
+    """
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    if metric == "cosine":
+        return 1 - l2_normalise(a) @ l2_normalise(b).T
+    if metric == "euclidean_l2":
+        a, b = l2_normalise(a), l2_normalise(b)
+    elif metric != "euclidean":
+        raise ValueError(f"Unknown distance metric {metric}")
+    squared = (a**2).sum(axis=1)[:, None] + (b**2).sum(axis=1)[None, :] - 2 * a @ b.T
+    return np.sqrt(np.clip(squared, 0, None))
+
+
+def blocked_distances(a: np.ndarray, b, metric: str, block_size: int = 65536) -> np.ndarray:
+    """
+    `pairwise_distances` against `b` in blocks of rows, so a float16 or int8
+    `b` is only expanded to float32 one block at a time.
+    """
+    return np.concatenate(
+        [
+            pairwise_distances(a, b[start : start + block_size], metric)
+            for start in range(0, len(b), block_size)
+        ],
+        axis=1,
+    )
+
+
+def paired_distances(a: np.ndarray, b: np.ndarray, metric: str) -> np.ndarray:
+    """Distances between row i of `a` and row i of `b`, as in `pairwise_distances`."""
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    if metric == "cosine":
+        return 1 - (l2_normalise(a) * l2_normalise(b)).sum(axis=1)
+    if metric == "euclidean_l2":
+        a, b = l2_normalise(a), l2_normalise(b)
+    elif metric != "euclidean":
+        raise ValueError(f"Unknown distance metric {metric}")
+    return np.linalg.norm(a - b, axis=1)
+
+
+@hydra.main(config_path="../../config", config_name="config_inter", version_base=None)
+def main(cfg: DictConfig):
+    shard_dir = cfg.shards.dir if cfg.shards.read else None
+    selfie_paths = drop_bad_paths(
+        list_selfie_paths(cfg.selfie_data.save_dir, shard_dir),
+        SelfieRegistry(cfg.registry.path).bad_keys(cfg.registry.skip),
+    )
+    df_index, matrix = compute_embeddings(
+        selfie_paths,
+        cfg.model,
+        cfg.decode.scale,
+        cfg.decode.face_fraction,
+        shard_dir=shard_dir,
+        backend=backend_options(cfg.backend),
+    )
+    save_embeddings(cfg.embeddings.dir, cfg.model, df_index, matrix, cfg.embeddings.precisions)
+    log.info(f"Saved {matrix.shape} embeddings for {cfg.model} to {cfg.embeddings.dir}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
@@ -4,31 +4,56 @@ from pathlib import Path
 import cv2
 from omegaconf import DictConfig
 import hydra
-from tqdm import tqdm
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import mediapipe as mp
 from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
 import logging
 import time
+import numpy as np
+
+from src.data.decode import read_selfie, resolve_scale
+from src.data.pool import RecyclingProcessPool, bounded_map, memory_log_path, recycling_pool
+from src.data.prefetch import PrefetchReader
+from src.data.shards import list_selfie_paths, read_bytes
+from src.data import timing
+from src.data.registry import (
+    CORRUPT,
+    LANDMARK_FAILURE,
+    NO_FACE,
+    OK,
+    SelfieRegistry,
+    drop_bad_paths,
+    path_key,
+)
 
 # Set up logging
 logging.basicConfig(filename='landmark_processing.log', level=logging.DEBUG)
 
-base_options = python.BaseOptions(model_asset_path = cfg.landmarks.model_path)
-face_landmarker = vision.FaceLandmarker
-face_landmarker_options = vision.FaceLandmarkerOptions
-options = face_landmarker_options(
-    base_options=base_options,
-    running_mode=vision.RunningMode.IMAGE,
-    num_faces=1,
-    min_face_detection_confidence=0.5,
-    min_face_presence_confidence=0.5,
-    output_face_blendshapes=True,
-    output_facial_transformation_matrixes=True,
+# OSErrors about reading the selfie rather than its contents, raised even without an errno
+IO_ERRORS = (
+    FileNotFoundError,
+    PermissionError,
+    IsADirectoryError,
+    NotADirectoryError,
+    ConnectionError,
+    TimeoutError,
+    InterruptedError,
 )
 
+
+def landmarker_options(model_path: Path | str):
+    return vision.FaceLandmarkerOptions(
+        base_options=python.BaseOptions(model_asset_path=Path(model_path).as_posix()),
+        running_mode=vision.RunningMode.IMAGE,
+        num_faces=1,
+        min_face_detection_confidence=0.5,
+        min_face_presence_confidence=0.5,
+        output_face_blendshapes=True,
+        output_facial_transformation_matrixes=True,
+    )
+
+
 def list_files_with_extension(directory, extension):
     files = []
     for filename in os.listdir(directory):
@@ -37,7 +62,9 @@ def list_files_with_extension(directory, extension):
     return files
 
 
-def get_selfie_paths(save_dir: Path | str = cfg.selfie_data.save_dir):
+def get_selfie_paths(save_dir: Path | str, shard_dir: Path | str | None = None):
+    if shard_dir:
+        return [path.as_posix() for path in list_selfie_paths(save_dir, shard_dir)]
     selfies_dir = Path(save_dir)
     users_selfie_paths = []
     for user in selfies_dir.glob('*'):
@@ -46,9 +73,14 @@ def get_selfie_paths(save_dir: Path | str = cfg.selfie_data.save_dir):
     return users_selfie_paths
 
 
-def validate_selfie(img_path: Path | str):
+def validate_selfie(img_path: Path | str, shard_dir: Path | str | None = None):
     try:
-        image = cv2.imread(img_path)
+        with timing.span("validate"):
+            if shard_dir:
+                data = np.frombuffer(read_bytes(img_path, shard_dir), dtype=np.uint8)
+                image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            else:
+                image = cv2.imread(img_path)
         if image is None:
             return img_path, False, "Unable to read the file as an image."
         else:
@@ -57,28 +89,98 @@ def validate_selfie(img_path: Path | str):
         return img_path, False, f"Error: {str(e)}"
     
 
-def validate_selfies(selfie_paths: list):
+def validate_selfies(
+    selfie_paths: list,
+    registry: SelfieRegistry | None = None,
+    shard_dir: Path | str | None = None,
+):
     validation_results = []
-    with tqdm(desc="Validating selfies...", total=len(selfie_paths)) as pbar:
-        with ThreadPoolExecutor(max_workers=40) as executor:
-            futures = [
-                executor.submit(
-                    validate_selfie,
-                    path
-                )
-                for path in selfie_paths
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                validation_results.append(future.result())
-                pbar.update(1)
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        tasks = bounded_map(
+            executor,
+            validate_selfie,
+            selfie_paths,
+            args=lambda path: (path, shard_dir),
+            desc="Validating selfies...",
+        )
+        for path, result, error in timing.timed_iter(tasks, "validate_wait"):
+            validation_results.append(
+                result if error is None else (path, False, f"Error: {str(error)}")
+            )
+    if registry is not None:
+        registry.record_many(
+            "validate",
+            [
+                (path_key(path), OK if valid else CORRUPT, error)
+                for path, valid, error in validation_results
+            ],
+        )
     return validation_results
 
 
-def get_landmarks(img_path: Path):
+def skipped_selfies(selfie_paths: list, bad_statuses: dict) -> pd.DataFrame:
+    """
+    Validation rows of the selfies skipped through the registry. Selfies the
+    landmarker rejected are valid images, corrupt and missing ones are not.
+    """
+    rows = []
+    for path in selfie_paths:
+        status = bad_statuses.get(path_key(path))
+        if status is not None:
+            rows.append((path, status in (NO_FACE, LANDMARK_FAILURE), f"Skipped: {status} in the selfie registry."))
+    return pd.DataFrame(rows, columns=['selfie_path', 'valid', 'error'])
+
+
+def get_landmarks(
+    img_path: Path,
+    model_path: Path | str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    shard_dir: Path | str | None = None,
+    data: bytes | None = None,
+):
+    """
+    Landmarks of the first face of one selfie, with its registry status.
+
+    Only a selfie that fails to decode or to detect is recorded as a landmark
+    failure, including unidentified or truncated images, which PIL reports as
+    an OSError without an errno. Errors that say nothing about the image (the
+    landmarker failing to load, out of memory, an OSError from the operating
+    system such as a missing file or a failed read) are raised, so they
+    surface as task errors and the selfie is tried again on the next run.
+    """
     try:
-        landmarker = vision.FaceLandmarker.create_from_options(options)
-        image = mp.Image.create_from_file(img_path)
-        landmarks = landmarker.detect(image).face_landmarks[0]
+        with timing.span("landmarker_init"):
+            landmarker = vision.FaceLandmarker.create_from_options(landmarker_options(model_path))
+        try:
+            scale = resolve_scale(img_path, decode_scale, "mediapipe", face_fraction, shard_dir, data)
+            if scale == 1 and not shard_dir and data is None:
+                with timing.span("read_decode"):
+                    image = mp.Image.create_from_file(img_path)
+            else:
+                # landmarks are normalised to the image size, so they are scale invariant
+                image = mp.Image(
+                    image_format=mp.ImageFormat.SRGB,
+                    data=read_selfie(img_path, scale=scale, shard_dir=shard_dir, data=data),
+                )
+            with timing.span("detect"):
+                faces = landmarker.detect(image).face_landmarks
+        except MemoryError:
+            raise
+        except OSError as e:
+            # decoders raise OSErrors without an errno for bytes that are not a
+            # (complete) image, e.g. UnidentifiedImageError or a truncated JPEG
+            if isinstance(e, IO_ERRORS) or e.errno is not None:
+                raise
+            logging.error(f"Error processing image at path {img_path}: {str(e)}")
+            return (img_path, None, 0, LANDMARK_FAILURE)
+        except Exception as e:
+            logging.error(f"Error processing image at path {img_path}: {str(e)}")
+            return (img_path, None, 0, LANDMARK_FAILURE)
+        if not faces:
+            logging.error(f"No face detected in image at path {img_path}")
+            return (img_path, None, 0, NO_FACE)
+        landmarks = faces[0]
         landmarks_coordinates = []
         for landmark in landmarks:
             x = landmark.x
@@ -86,51 +188,129 @@ def get_landmarks(img_path: Path):
             z = landmark.z
             landmarks_coordinates.append((x,y,z))
         length = len(landmarks_coordinates)
-        return (img_path, landmarks_coordinates, length)
-    except Exception as e:
-        logging.error(f"Error processing image at path {image_path}: {str(e)}")
-        return None
+        return (img_path, landmarks_coordinates, length, OK)
+    finally:
+        timing.flush()
 
 
-def get_all_landmarks(selfie_paths: list) -> list:
+def get_all_landmarks(
+    selfie_paths: list,
+    model_path: Path | str,
+    decode_scale: int | str = 1,
+    face_fraction: float = 0.5,
+    registry: SelfieRegistry | None = None,
+    shard_dir: Path | str | None = None,
+    prefetch: DictConfig | None = None,
+    spans_dir: str | None = None,
+    workers: DictConfig | None = None,
+) -> list:
     """
         parameters
         selfie_paths : list
             list of all selfie paths we want to get facial landmarks for.
+        model_path : Path | str
+            path to the mediapipe face landmarker task file.
+        decode_scale : int | str
+            JPEG DCT scale (1, 2, 4, 8 or "auto") to decode the selfies at.
+        face_fraction : float
+            expected face size relative to the shorter image side, used by "auto".
+        registry : SelfieRegistry | None
+            registry to record no face and landmark failures in.
+        shard_dir : Path | str | None
+            read the selfies from the packed shards in this directory.
+        prefetch : DictConfig | None
+            read ahead settings (max_bytes, threads, max_ahead); when enabled the
+            selfies are read in the main process while the workers compute.
+        spans_dir : str | None
+            where the workers write their stage timings, from `timing.start`.
+        workers : DictConfig | None
+            pool settings (max_workers, max_rss_bytes, sample_seconds); without
+            them 8 workers run and are never recycled.
 
         returns
         list
             a list of lists that contain for each selfie: file path, landmarks, number of landmarks
     """
     landmark_results = []
-    with tqdm(desc="Calculating landmarks...", total=len(selfie_paths)) as pbar:
-        with ProcessPoolExecutor(max_workers = 8, max_tasks_per_child=4500) as executor:
-            futures = {executor.submit(get_landmarks, path) for path in selfie_paths}
-            for future in as_completed(futures):
-                try:
-                    result = future.result()
-                    if result is not None:
-                        landmark_results.append(result)
-                except Exception as e:
-                    # Log or store information about the failed task
-                    logging.error(f"Error processing image: {str(e)}")
-                pbar.update(1)
+    statuses = []
+    if workers is not None:
+        pool = recycling_pool(workers, initializer=timing.init_worker, initargs=(spans_dir,))
+    else:
+        pool = RecyclingProcessPool(8, initializer=timing.init_worker, initargs=(spans_dir,))
+    reader, release = None, None
+    if prefetch is not None and prefetch.enabled:
+        # reading blocks once max_bytes are held by queued tasks
+        reader = PrefetchReader(
+            selfie_paths,
+            prefetch.max_bytes,
+            prefetch.threads,
+            prefetch.max_ahead,
+            shard_dir,
+            auto_release=False,
+        )
+        items = reader
+        release = lambda item: reader.release(item[1])
+    else:
+        items = ((path, None) for path in selfie_paths)
+    with pool as executor:
+        tasks = bounded_map(
+            executor,
+            get_landmarks,
+            items,
+            args=lambda item: (item[0], model_path, decode_scale, face_fraction, shard_dir, item[1]),
+            release=release,
+            desc="Calculating landmarks...",
+            total=len(selfie_paths),
+        )
+        for (path, _), result, error in timing.timed_iter(tasks, "landmarks_wait"):
+            if error is not None:
+                # Log or store information about the failed task
+                logging.error(f"Error processing image {path}: {str(error)}")
+                continue
+            img_path, landmarks, length, status = result
+            statuses.append((path_key(img_path), status, ""))
+            if status == OK:
+                landmark_results.append((img_path, landmarks, length))
+    if reader is not None:
+        logging.info(f"Prefetch: {reader.stats}, hit rate {reader.hit_rate():.2f}")
+    if workers is not None:
+        executor.save_memory(memory_log_path("landmark_worker_memory.csv"))
+    if registry is not None:
+        registry.record_many("landmarks", statuses)
     return landmark_results
 
 
 @hydra.main(config_path="../../config", config_name="config", version_base=None)
 def main(cfg: DictConfig):
     print('Getting selfie paths...')
-    selfiepaths = get_selfie_paths(cfg.selfie_data.save_dir)
-    selfie_validation = validate_selfies(selfiepaths)
+    spans_dir = timing.start(cfg.timing.enabled)
+    registry = SelfieRegistry(cfg.registry.path)
+    shard_dir = cfg.shards.dir if cfg.shards.read else None
+    all_selfie_paths = get_selfie_paths(cfg.selfie_data.save_dir, shard_dir)
+    bad_statuses = registry.bad_statuses(cfg.registry.skip)
+    selfiepaths = drop_bad_paths(all_selfie_paths, bad_statuses)
+    selfie_validation = validate_selfies(selfiepaths, registry, shard_dir)
     df_validation = pd.DataFrame(selfie_validation, columns=['selfie_path', 'valid', 'error'])
 
     good_selfies = df_validation[df_validation.valid].selfie_path.tolist()
-    selfie_landmarks = get_all_landmarks(good_selfies)
+    selfie_landmarks = get_all_landmarks(
+        good_selfies,
+        cfg.landmarks.model_path,
+        cfg.decode.scale,
+        cfg.decode.face_fraction,
+        registry,
+        shard_dir,
+        cfg.prefetch,
+        spans_dir,
+        cfg.workers,
+    )
     df_landmarks = pd.DataFrame(selfie_landmarks, columns=['selfie_path', 'landmarks', 'length'])
     
+    # selfies skipped through the registry keep their row, with the status that got them skipped
+    df_validation = pd.concat([df_validation, skipped_selfies(all_selfie_paths, bad_statuses)], ignore_index=True)
     df_final = pd.merge(df_validation, df_landmarks, on = 'selfie_path', how = 'left')
     df_final.to_csv('../../results/valid_selfies_w_landmark.csv')
+    timing.write_report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+import hashlib
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.data import timing
+from src.data.pool import memory_log_path, recycling_pool
+from src.data.registry import SelfieRegistry, path_key
+from src.data.results import current_rows
+from src.data.shards import shard_reader
+from src.data.summaries import SummarySet
+from src.process.deepface_inter import get_users_latest_selfies, score_partners
+
+log = logging.getLogger(__name__)
+
+SCORE_COLUMNS = ["user1_id", "img1_path", "user2_id", "img2_path", "model", "similarity_metric", "distance"]
+TOPK_COLUMNS = [
+    "model",
+    "similarity_metric",
+    "user_id",
+    "img_path",
+    "partner_id",
+    "partner_img_path",
+    "distance",
+    "rank",
+]
+
+
+FINGERPRINT_COLUMNS = ["size", "mtime_ns", "shard", "offset"]
+
+
+def selfie_fingerprints(paths: list, shard_dir: Path | str | None = None) -> pd.DataFrame:
+    """
+    user_id, img_key and fingerprint of every user's latest selfie: size and
+    mtime of a file on disk, or shard, offset and length of a packed selfie.
+    A selfie whose key is unchanged but was downloaded again (e.g. by
+    `missing_selfies.main_dl`) shows up as a different size or mtime, and once
+    packed again as a new shard location.
+    """
+    reader = shard_reader(shard_dir, refresh=True) if shard_dir else None
+    records = []
+    for path in paths:
+        path = Path(path)
+        key = path_key(path)
+        if reader is not None and key in reader:
+            shard, offset, size = reader.index[key]
+            mtime_ns = -1
+        else:
+            stat = path.stat()
+            shard, offset, size, mtime_ns = "", -1, stat.st_size, stat.st_mtime_ns
+        records.append(
+            {
+                "user_id": int(path.parent.name),
+                "img_key": key,
+                "img_path": path.as_posix(),
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "shard": shard,
+                "offset": offset,
+            }
+        )
+    return pd.DataFrame(records, columns=["user_id", "img_key", "img_path", *FINGERPRINT_COLUMNS])
+
+
+def load_manifest(manifest_path: Path | str) -> pd.DataFrame | None:
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        return None
+    df_manifest = pd.read_csv(manifest_path, dtype={"shard": str})
+    # manifests written before selfies were fingerprinted by their shard location
+    for column, default in (("shard", ""), ("offset", -1)):
+        if column not in df_manifest:
+            df_manifest[column] = default
+    return df_manifest.fillna({"shard": ""})
+
+
+def save_manifest(df_manifest: pd.DataFrame, manifest_path: Path | str) -> None:
+    """Replace the manifest in one step, so it only ever describes a committed run."""
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    partial = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.partial")
+    df_manifest.assign(committed_at=datetime.now().isoformat(timespec="seconds")).to_csv(
+        partial, index=False
+    )
+    os.replace(partial, manifest_path)
+
+
+def find_delta(df_current: pd.DataFrame, df_manifest: pd.DataFrame) -> tuple[np.ndarray, np.ndarray, set]:
+    """
+    Users to rescore since the committed run.
+
+    returns
+    tuple
+        user_ids that are new or whose latest selfie changed, user_ids that
+        are gone, and the img_keys of the committed run that are stale.
+    """
+    df_merged = df_current.merge(
+        df_manifest[["user_id", "img_key", *FINGERPRINT_COLUMNS]],
+        on="user_id",
+        how="outer",
+        suffixes=("", "_committed"),
+        indicator=True,
+    )
+    new = df_merged["_merge"] == "left_only"
+    gone = df_merged["_merge"] == "right_only"
+    both = df_merged["_merge"] == "both"
+    changed = both & (df_merged["img_key"] != df_merged["img_key_committed"])
+    for column in FINGERPRINT_COLUMNS:
+        changed |= both & (df_merged[column] != df_merged[f"{column}_committed"])
+    stale = set(df_merged.loc[changed | gone, "img_key_committed"])
+    return (
+        np.sort(df_merged.loc[new | changed, "user_id"].to_numpy()),
+        np.sort(df_merged.loc[gone, "user_id"].to_numpy()),
+        stale,
+    )
+
+
+def delta_name(df_current: pd.DataFrame, delta: np.ndarray) -> str:
+    """Name of a delta's score part, the same when an uncommitted delta is rerun."""
+    df_delta = df_current.loc[df_current["user_id"].isin(delta)].sort_values("img_key")
+    digest = hashlib.sha256()
+    for row in df_delta[["img_key", *FINGERPRINT_COLUMNS]].itertuples(index=False):
+        digest.update((":".join(map(str, row)) + "\n").encode())
+    return f"delta_{digest.hexdigest()[:16]}"
+
+
+def both_directions(df_scores: pd.DataFrame) -> pd.DataFrame:
+    """Inter scores as (user, partner) rows from both sides of every pair."""
+    columns = ["model", "similarity_metric", "distance"]
+    forward = df_scores[["user1_id", "img1_path", "user2_id", "img2_path", *columns]]
+    forward.columns = ["user_id", "img_path", "partner_id", "partner_img_path", *columns]
+    backward = df_scores[["user2_id", "img2_path", "user1_id", "img1_path", *columns]]
+    backward.columns = forward.columns
+    return pd.concat([forward, backward], ignore_index=True)
+
+
+def top_k(df_pairs: pd.DataFrame, k: int) -> pd.DataFrame:
+    """The k nearest partners per user, model and metric, ranked from 1."""
+    df_pairs = df_pairs.sort_values(
+        ["model", "similarity_metric", "user_id", "distance"], kind="stable"
+    ).drop_duplicates(["model", "similarity_metric", "user_id", "partner_id"])
+    df_top = df_pairs.groupby(["model", "similarity_metric", "user_id"], sort=False).head(k).copy()
+    df_top["rank"] = df_top.groupby(["model", "similarity_metric", "user_id"]).cumcount() + 1
+    return df_top[TOPK_COLUMNS].reset_index(drop=True)
+
+
+def build_topk(
+    scores: Path | str | list, k: int, keys: set | None = None, chunksize: int = 1_000_000
+) -> pd.DataFrame:
+    """
+    Top k table of every score in csvs or directories of csv parts, read in
+    chunks and folded into the running top k, so memory stays at k per user.
+    With `keys`, only scores between selfies in `keys` count, so scores of
+    replaced selfies left in the parts are dropped.
+    """
+    sources = [Path(source) for source in (scores if isinstance(scores, list) else [scores])]
+    paths = []
+    for source in dict.fromkeys(source.resolve() for source in sources if source.exists()):
+        paths += sorted(source.glob("*.csv")) if source.is_dir() else [source]
+    df_top = pd.DataFrame(columns=TOPK_COLUMNS)
+    for path in paths:
+        chunks = pd.read_csv(path, usecols=SCORE_COLUMNS, chunksize=chunksize)
+        for df_chunk in tqdm(chunks, desc=f"Top {k} of {path.name}"):
+            if keys is not None:
+                df_chunk = current_rows(df_chunk, keys)
+            df_top = top_k(pd.concat([df_top.drop(columns="rank"), both_directions(df_chunk)]), k)
+    return df_top
+
+
+def update_topk(
+    df_topk: pd.DataFrame, df_delta: pd.DataFrame, stale_keys: set, gone: np.ndarray, k: int
+) -> pd.DataFrame:
+    """
+    Drop the entries of stale selfies and gone users, and fold in the new
+    scores. A user that lost an entry to a stale selfie can end up with fewer
+    than k partners, when its next nearest was never in the table; those are
+    logged; `build_topk` over all scores with the current keys, run with
+    `incremental.rebuild`, fills them in again.
+    """
+    stale_paths = df_topk["img_path"].map(path_key).isin(stale_keys) | df_topk[
+        "partner_img_path"
+    ].map(path_key).isin(stale_keys)
+    stale = stale_paths | df_topk["user_id"].isin(gone) | df_topk["partner_id"].isin(gone)
+    df_kept = df_topk.loc[~stale].drop(columns="rank")
+    df_updated = top_k(pd.concat([df_kept, both_directions(df_delta)], ignore_index=True), k)
+    sizes = df_updated.groupby(["model", "similarity_metric", "user_id"]).size()
+    if (sizes < k).any():
+        log.info(f"{(sizes < k).sum()} users hold fewer than {k} partners after dropping stale selfies")
+    return df_updated
+
+
+def score_delta(
+    executor,
+    df_current: pd.DataFrame,
+    delta: np.ndarray,
+    cfg: DictConfig,
+    output: Path | str,
+    summaries: SummarySet,
+    registry: SelfieRegistry | None = None,
+) -> None:
+    """
+    new x existing and new x new pairs only: every delta user's latest selfie
+    against every unchanged user and every delta user after it.
+    """
+    paths = [Path(path) for path in df_current.sort_values("img_key")["img_path"]]
+    is_delta = np.isin([int(path.parent.name) for path in paths], delta)
+    unchanged = [path for path, d in zip(paths, is_delta) if not d]
+    delta_paths = [path for path, d in zip(paths, is_delta) if d]
+    for i, pic1 in enumerate(tqdm(delta_paths, desc="Scoring new and changed users")):
+        partners = unchanged + delta_paths[i + 1 :]
+        score_partners(executor, pic1, partners, len(partners), cfg, output, summaries, registry)
+
+
+@hydra.main(config_path="../../config", config_name="config_inter", version_base=None)
+def main(cfg: DictConfig):
+    shard_dir = cfg.shards.dir if cfg.shards.read else None
+    registry = SelfieRegistry(cfg.registry.path)
+    latest = get_users_latest_selfies(
+        cfg.selfie_data.save_dir, registry.bad_keys(cfg.registry.skip), shard_dir
+    )
+    df_current = selfie_fingerprints(latest, shard_dir)
+    df_manifest = load_manifest(cfg.incremental.manifest)
+    if df_manifest is None:
+        if not cfg.incremental.bootstrap:
+            raise FileNotFoundError(
+                f"No manifest at {cfg.incremental.manifest}; after a full run set incremental.bootstrap"
+            )
+        # the last full run covered the current selfies
+        save_manifest(df_current, cfg.incremental.manifest)
+        build_topk(cfg.incremental.full_scores, cfg.incremental.k, set(df_current["img_key"])).to_csv(
+            cfg.incremental.topk, index=False
+        )
+        log.info(f"Bootstrapped manifest with {len(df_current)} users and the top {cfg.incremental.k} table")
+        return
+
+    if cfg.incremental.rebuild:
+        # from the committed run's selfies, the ones the scores on disk cover
+        build_topk(
+            [cfg.incremental.full_scores, cfg.incremental.scores_dir],
+            cfg.incremental.k,
+            set(df_manifest["img_key"]),
+        ).to_csv(cfg.incremental.topk, index=False)
+        log.info(f"Rebuilt the top {cfg.incremental.k} table of {len(df_manifest)} users")
+        return
+
+    delta, gone, stale_keys = find_delta(df_current, df_manifest)
+    n_pairs = len(delta) * (len(df_current) - len(delta)) + len(delta) * (len(delta) - 1) // 2
+    log.info(
+        f"{len(delta)} new or changed users, {len(gone)} gone; scoring {n_pairs} pairs "
+        f"instead of {len(df_current) * (len(df_current) - 1) // 2}"
+    )
+    if len(delta) == 0 and len(gone) == 0:
+        return
+    scores_dir = Path(cfg.incremental.scores_dir)
+    scores_dir.mkdir(parents=True, exist_ok=True)
+    name = delta_name(df_current, delta)
+    output = scores_dir / f"{name}.csv"
+    partial = scores_dir / f"{name}.partial"
+    # left over from a crashed run of the same delta
+    partial.unlink(missing_ok=True)
+    summaries = SummarySet(cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy)
+    spans_dir = timing.start(cfg.timing.enabled)
+    executor = recycling_pool(cfg.workers, initializer=timing.init_worker, initargs=(spans_dir,))
+    with executor:
+        score_delta(executor, df_current, delta, cfg, partial, summaries, registry)
+    executor.save_memory(memory_log_path())
+
+    # commit: scores, summary and top k first, the manifest last, so a crash
+    # before the manifest is replaced reruns the same delta into the same file
+    if partial.exists():
+        df_delta = pd.read_csv(partial)
+        os.replace(partial, output)
+    else:
+        df_delta = pd.DataFrame(columns=SCORE_COLUMNS)
+    # named after the delta, so a rerun after a crash replaces it instead of adding a second one
+    summaries.save(Path(cfg.summaries.dir) / f"inter_{name}.json")
+    df_topk = pd.read_csv(cfg.incremental.topk)
+    update_topk(df_topk, df_delta, stale_keys, gone, cfg.incremental.k).to_csv(
+        cfg.incremental.topk, index=False
+    )
+    save_manifest(df_current, cfg.incremental.manifest)
+    timing.write_report()
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
@@ -0,0 +1,236 @@
+import logging
+import time
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.data.summaries import SummarySet, summary_path
+
+log = logging.getLogger(__name__)
+
+MODEL_NAME = "LandmarkProcrustes"
+METRIC_NAME = "procrustes"
+
+
+def parse_landmarks(landmarks: str) -> np.ndarray:
+    """Turn the stringified list of (x, y, z) tuples written by greenlight_selfies into an array."""
+    values = landmarks.translate(str.maketrans("", "", "[]() ")).split(",")
+    return np.array(values, dtype=np.float32).reshape(-1, 3)
+
+
+def load_landmarks(landmarks_csv: Path | str, n_landmarks: int = 478) -> pd.DataFrame:
+    df_landmarks = pd.read_csv(landmarks_csv, usecols=["selfie_path", "landmarks", "length"])
+    df_landmarks = df_landmarks.loc[df_landmarks["length"] == n_landmarks].copy()
+    df_landmarks["user_id"] = (
+        df_landmarks["selfie_path"].map(lambda x: Path(x).parent.name).astype(int)
+    )
+    return df_landmarks.sort_values(["user_id", "selfie_path"], ignore_index=True)
+
+
+def stack_landmarks(df_landmarks: pd.DataFrame) -> np.ndarray:
+    return np.stack([parse_landmarks(lm) for lm in df_landmarks["landmarks"]])
+
+
+def normalise_shapes(shapes: np.ndarray) -> np.ndarray:
+    """
+    Remove translation and scale from a batch of landmark meshes.
+
+    parameters
+    shapes : np.ndarray
+        array of shape (n_faces, n_landmarks, 3).
+
+    returns
+    np.ndarray
+        centred meshes with unit Frobenius norm, in float64 since near identical
+        faces are exactly where float32 round off shows up in the distance.
+    """
+    shapes = shapes.astype(np.float64)
+    shapes = shapes - shapes.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(shapes, axis=(1, 2), keepdims=True)
+    return shapes / np.where(norms == 0, 1, norms)
+
+
+def _sym3_eigvalsh(s: np.ndarray) -> np.ndarray:
+    """Closed form eigenvalues of a batch of symmetric 3x3 matrices, ascending."""
+    a11, a22, a33 = s[..., 0, 0], s[..., 1, 1], s[..., 2, 2]
+    a12, a13, a23 = s[..., 0, 1], s[..., 0, 2], s[..., 1, 2]
+    q = (a11 + a22 + a33) / 3
+    p1 = a12**2 + a13**2 + a23**2
+    p2 = (a11 - q) ** 2 + (a22 - q) ** 2 + (a33 - q) ** 2 + 2 * p1
+    p = np.sqrt(p2 / 6)
+    p_safe = np.where(p == 0, 1, p)
+    b11, b22, b33 = (a11 - q) / p_safe, (a22 - q) / p_safe, (a33 - q) / p_safe
+    b12, b13, b23 = a12 / p_safe, a13 / p_safe, a23 / p_safe
+    det_b = (
+        b11 * (b22 * b33 - b23 * b23)
+        - b12 * (b12 * b33 - b23 * b13)
+        + b13 * (b12 * b23 - b22 * b13)
+    )
+    phi = np.arccos(np.clip(det_b / 2, -1, 1)) / 3
+    eig_max = q + 2 * p * np.cos(phi)
+    eig_min = q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+    eig_mid = 3 * q - eig_max - eig_min
+    return np.stack([eig_min, eig_mid, eig_max], axis=-1)
+
+
+def _det3(m: np.ndarray) -> np.ndarray:
+    return (
+        m[..., 0, 0] * (m[..., 1, 1] * m[..., 2, 2] - m[..., 1, 2] * m[..., 2, 1])
+        - m[..., 0, 1] * (m[..., 1, 0] * m[..., 2, 2] - m[..., 1, 2] * m[..., 2, 0])
+        + m[..., 0, 2] * (m[..., 1, 0] * m[..., 2, 1] - m[..., 1, 1] * m[..., 2, 0])
+    )
+
+
+def cross_covariances(block: np.ndarray, shapes: np.ndarray) -> np.ndarray:
+    """M[i, j] = block[i].T @ shapes[j] for every pair, as one matrix product."""
+    b, k, d = block.shape
+    n = shapes.shape[0]
+    lhs = block.transpose(0, 2, 1).reshape(b * d, k)
+    rhs = shapes.transpose(1, 0, 2).reshape(k, n * d)
+    return (lhs @ rhs).reshape(b, d, n, d).transpose(0, 2, 1, 3)
+
+
+def _rotation_nuclear_norm(m: np.ndarray, allow_reflection: bool = False) -> np.ndarray:
+    """Sum of singular values of a batch of 3x3 matrices, sign corrected for proper rotations."""
+    singular_values = np.sqrt(np.clip(_sym3_eigvalsh(np.swapaxes(m, -1, -2) @ m), 0, None))
+    nuclear = singular_values.sum(axis=-1)
+    if not allow_reflection:
+        # a proper rotation cannot flip the axis of the smallest singular value
+        nuclear = nuclear - 2 * (_det3(m) < 0) * singular_values[..., 0]
+    return nuclear
+
+
+def procrustes_distances(
+    block: np.ndarray, shapes: np.ndarray, allow_reflection: bool = False
+) -> np.ndarray:
+    """
+    Full Procrustes distance between every mesh in `block` and every mesh in
+    `shapes`, both already passed through `normalise_shapes`.
+
+    The optimal rotation never has to be materialised: for unit size centred
+    meshes the distance is sqrt(1 - nuc(M)**2), where nuc(M) is the sum of the
+    singular values of the 3x3 cross covariance M.
+
+    returns
+    np.ndarray
+        array of shape (len(block), len(shapes)) with distances in [0, 1].
+    """
+    nuclear = _rotation_nuclear_norm(cross_covariances(block, shapes), allow_reflection)
+    return np.sqrt(np.clip(1 - nuclear**2, 0, None)).astype(np.float32)
+
+
+def paired_procrustes_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Full Procrustes distance between a[i] and b[i] for aligned batches."""
+    nuclear = _rotation_nuclear_norm(np.einsum("nka,nkb->nab", a, b))
+    return np.sqrt(np.clip(1 - nuclear**2, 0, None)).astype(np.float32)
+
+
+def to_score_table(
+    rows: np.ndarray,
+    cols: np.ndarray,
+    distances: np.ndarray,
+    df_selfies: pd.DataFrame,
+    threshold: float,
+    elapsed: float,
+) -> pd.DataFrame:
+    """Score rows in the same schema as deepface_inter writes."""
+    return pd.DataFrame(
+        {
+            "user1_id": df_selfies["user_id"].values[rows],
+            "user2_id": df_selfies["user_id"].values[cols],
+            "img1_path": df_selfies["selfie_path"].values[rows],
+            "img2_path": df_selfies["selfie_path"].values[cols],
+            "verified": distances <= threshold,
+            "distance": distances,
+            "threshold": threshold,
+            "model": MODEL_NAME,
+            "detector_backend": "mediapipe",
+            "similarity_metric": METRIC_NAME,
+            "facial_areas": None,
+            "time": elapsed / max(len(distances), 1),
+        }
+    )
+
+
+def inter_user_scores(
+    df_latest: pd.DataFrame,
+    shapes: np.ndarray,
+    threshold: float,
+    block_size: int = 256,
+):
+    """Yield score tables for the upper triangle of all user pairs, one row block at a time."""
+    n = len(shapes)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        t0 = time.perf_counter()
+        distances = procrustes_distances(shapes[start:stop], shapes[start:])
+        rows, cols = np.triu_indices(stop - start, k=1, m=n - start)
+        elapsed = time.perf_counter() - t0
+        yield to_score_table(
+            rows + start,
+            cols + start,
+            distances[rows, cols],
+            df_latest,
+            threshold,
+            elapsed,
+        )
+
+
+def intra_user_scores(
+    df_selfies: pd.DataFrame, shapes: np.ndarray, threshold: float
+) -> pd.DataFrame:
+    """First selfie of each user against the rest, like deepface_intra."""
+    t0 = time.perf_counter()
+    positions = np.arange(len(df_selfies))
+    first = (df_selfies.groupby("user_id").cumcount() == 0).values
+    first_pos = pd.Series(positions[first], index=df_selfies["user_id"].values[first])
+    rows = first_pos.loc[df_selfies["user_id"].values[~first]].values
+    cols = positions[~first]
+    distances = paired_procrustes_distances(shapes[rows], shapes[cols])
+    df_scores = to_score_table(
+        rows, cols, distances, df_selfies, threshold, time.perf_counter() - t0
+    )
+    df_scores = df_scores.drop(columns=["user2_id"]).rename(columns={"user1_id": "user_id"})
+    return df_scores
+
+
+@hydra.main(config_path="../../config", config_name="config_geometry", version_base=None)
+def main(cfg: DictConfig):
+    df_selfies = load_landmarks(cfg.geometry.landmarks_csv)
+    shapes = normalise_shapes(stack_landmarks(df_selfies))
+    log.info(f"Loaded {len(df_selfies)} landmark meshes of {df_selfies['user_id'].nunique()} users")
+
+    df_intra = intra_user_scores(df_selfies, shapes, cfg.geometry.threshold)
+    df_intra.to_csv(cfg.geometry.intra_scores, index=False)
+    intra_summaries = SummarySet(
+        cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy
+    )
+    intra_summaries.update(df_intra)
+    intra_summaries.save(summary_path(cfg.summaries.dir, "geometry_intra"))
+
+    # latest selfie per user, same selection as deepface_inter
+    latest = df_selfies.groupby("user_id").cumcount(ascending=False) == 0
+    df_latest = df_selfies.loc[latest].reset_index(drop=True)
+    latest_shapes = shapes[latest.values]
+
+    output = Path(cfg.geometry.inter_scores)
+    output.unlink(missing_ok=True)
+    n_blocks = -(-len(df_latest) // cfg.geometry.block_size)
+    summaries = SummarySet(cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy)
+    for df_scores in tqdm(
+        inter_user_scores(df_latest, latest_shapes, cfg.geometry.threshold, cfg.geometry.block_size),
+        desc="Scoring landmark geometry",
+        total=n_blocks,
+    ):
+        df_scores.to_csv(output, index=False, mode="a", header=not output.exists())
+        summaries.update(df_scores)
+    summaries.save(summary_path(cfg.summaries.dir, "geometry_inter"))
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
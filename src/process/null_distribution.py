@@ -0,0 +1,262 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.data.pool import bounded_map
+from src.data.summaries import QuantileSketch
+from src.process.embeddings import load_embeddings, paired_distances
+
+log = logging.getLogger(__name__)
+
+QUANTILES = [0.01, 0.05, 0.5, 0.95, 0.99]
+# direction in which each statistic is extreme when same user pairs are closer than chance
+LOWER_IS_EXTREME = {"mean": True, "median": True, "share_below": False}
+
+# embedding matrix and group slots of the worker, set once by `init_worker`
+_matrix = None
+_slots = None
+
+
+def init_worker(
+    embeddings_dir: Path | str,
+    model: str,
+    precision: str = "float32",
+    slots: "GroupSlots | None" = None,
+) -> None:
+    """
+    Memory map the embedding matrix and keep the `GroupSlots`, so batch tasks
+    only carry a seed.
+    """
+    global _matrix, _slots
+    _, _matrix = load_embeddings(embeddings_dir, model, mmap=True, precision=precision)
+    _slots = slots
+
+
+class GroupSlots:
+    """
+    Slot layout of the groups: rows sorted by label, so every group is a
+    contiguous run of slots. The unordered slot pairs within each group are
+    numbered group by group, in `np.triu_indices` order, and only computed
+    for a range of that numbering at a time, so the layout takes memory per
+    selfie and per group, never per pair.
+
+    attributes
+    order : np.ndarray
+        row per slot, the observed assignment.
+    n_pairs : int
+        number of within group pairs.
+    """
+
+    def __init__(self, labels: np.ndarray):
+        self.order = np.argsort(labels, kind="stable")
+        _, starts, sizes = np.unique(labels[self.order], return_index=True, return_counts=True)
+        keep = sizes > 1
+        self.starts = starts[keep].astype(np.int64)
+        self.sizes = sizes[keep].astype(np.int64)
+        # first pair number of every group
+        self.offsets = np.r_[0, np.cumsum(self.sizes * (self.sizes - 1) // 2)]
+        self.n_pairs = int(self.offsets[-1])
+
+    def pairs(self, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+        """First and second slot of the pairs numbered `start` to `stop`."""
+        index = np.arange(start, stop, dtype=np.int64)
+        group = np.searchsorted(self.offsets, index, side="right") - 1
+        k = index - self.offsets[group]
+        n = self.sizes[group]
+        # row and column of the k-th entry of the upper triangle of an n x n group
+        i = n - 2 - np.floor(np.sqrt(-8 * k + 4 * n * (n - 1) - 7) / 2 - 0.5).astype(np.int64)
+        j = k + i + 1 - n * (n - 1) // 2 + (n - i) * (n - i - 1) // 2
+        return self.starts[group] + i, self.starts[group] + j
+
+
+def permutation_statistics(
+    matrix: np.ndarray,
+    assignments: np.ndarray,
+    slots: GroupSlots,
+    metric: str,
+    threshold: float,
+    chunk_size: int = 8192,
+    median_accuracy: float = 0.001,
+) -> dict:
+    """
+    Statistics of the within group pair distances for a batch of assignments
+    of rows to slots, streamed over chunks of pairs: the mean and the share
+    at or below `threshold` are exact, the median comes from a
+    `QuantileSketch` per assignment.
+
+    parameters
+    matrix : np.ndarray
+        embedding matrix, one row per selfie.
+    assignments : np.ndarray
+        (permutations, slots) rows of `matrix` in each slot.
+    slots : GroupSlots
+        slot layout of the groups.
+    chunk_size : int
+        distances computed at once over all assignments. Memory is bounded by
+        chunk_size distances and 2 * chunk_size float32 embeddings, plus the
+        sketches, which grow with the log of the distance range.
+    median_accuracy : float
+        relative accuracy of the median.
+    """
+    n_permutations = len(assignments)
+    pairs_per_chunk = max(1, chunk_size // n_permutations)
+    total = np.zeros(n_permutations)
+    below = np.zeros(n_permutations, dtype=np.int64)
+    sketches = [QuantileSketch(median_accuracy) for _ in range(n_permutations)]
+    for start in range(0, slots.n_pairs, pairs_per_chunk):
+        slots_a, slots_b = slots.pairs(start, min(start + pairs_per_chunk, slots.n_pairs))
+        distances = paired_distances(
+            matrix[assignments[:, slots_a].ravel()],
+            matrix[assignments[:, slots_b].ravel()],
+            metric,
+        ).reshape(n_permutations, -1)
+        total += distances.sum(axis=1, dtype=np.float64)
+        below += (distances <= threshold).sum(axis=1)
+        for sketch, row in zip(sketches, distances):
+            sketch.update(row)
+    n_pairs = max(slots.n_pairs, 1)
+    return {
+        "mean": total / n_pairs,
+        "median": np.array([sketch.quantile(0.5) for sketch in sketches]),
+        "share_below": below / n_pairs,
+    }
+
+
+def null_batch(
+    seed: np.random.SeedSequence,
+    n_permutations: int,
+    metric: str,
+    threshold: float,
+    chunk_size: int = 8192,
+    median_accuracy: float = 0.001,
+    matrix: np.ndarray | None = None,
+    slots: GroupSlots | None = None,
+) -> dict:
+    """
+    Statistics for `n_permutations` shuffles of the user ids over the selfies.
+    `matrix` and `slots` default to the worker's own.
+    """
+    slots = _slots if slots is None else slots
+    rng = np.random.default_rng(seed)
+    assignments = rng.permuted(np.tile(slots.order, (n_permutations, 1)), axis=1)
+    return permutation_statistics(
+        _matrix if matrix is None else matrix,
+        assignments,
+        slots,
+        metric,
+        threshold,
+        chunk_size,
+        median_accuracy,
+    )
+
+
+def null_summary(observed: dict, null: dict) -> pd.DataFrame:
+    """
+    Observed statistic against its permutation null distribution, with a
+    one sided p value that counts the observed assignment as a permutation.
+    """
+    records = []
+    for statistic, values in null.items():
+        value = float(observed[statistic][0])
+        extreme = values <= value if LOWER_IS_EXTREME[statistic] else values >= value
+        std = values.std(ddof=1) if len(values) > 1 else np.nan
+        records.append(
+            {
+                "statistic": statistic,
+                "observed": value,
+                "null_mean": values.mean(),
+                "null_std": std,
+                **{f"q{q * 100:g}": v for q, v in zip(QUANTILES, np.quantile(values, QUANTILES))},
+                "z": (value - values.mean()) / std if std else np.nan,
+                "p_value": (1 + extreme.sum()) / (1 + len(values)),
+                "n_permutations": len(values),
+            }
+        )
+    return pd.DataFrame(records)
+
+
+def null_distribution(
+    embeddings_dir: Path | str,
+    model: str,
+    labels: np.ndarray,
+    cfg: DictConfig,
+    precision: str = "float32",
+) -> tuple[dict, dict]:
+    """
+    Observed statistics and their permutation null across worker processes.
+    Every batch has its own child seed of `cfg.seed`, so the result does not
+    depend on the number of workers or the order batches finish in.
+    """
+    slots = GroupSlots(np.asarray(labels))
+    init_worker(embeddings_dir, model, precision)
+    observed = permutation_statistics(
+        _matrix,
+        slots.order[None, :],
+        slots,
+        cfg.metric,
+        cfg.threshold,
+        cfg.chunk_size,
+        cfg.median_accuracy,
+    )
+    n_batches = -(-cfg.n_permutations // cfg.batch_size)
+    seeds = np.random.SeedSequence(cfg.seed).spawn(n_batches)
+    sizes = [min(cfg.batch_size, cfg.n_permutations - i * cfg.batch_size) for i in range(n_batches)]
+    batches = [None] * n_batches
+    with ProcessPoolExecutor(
+        max_workers=cfg.max_workers,
+        initializer=init_worker,
+        # the slot layout goes to every worker once, not with every batch
+        initargs=(embeddings_dir, model, precision, slots),
+    ) as executor:
+        tasks = bounded_map(
+            executor,
+            null_batch,
+            range(n_batches),
+            args=lambda i: (
+                seeds[i],
+                sizes[i],
+                cfg.metric,
+                cfg.threshold,
+                cfg.chunk_size,
+                cfg.median_accuracy,
+            ),
+            desc="Permuting user ids",
+        )
+        for i, statistics, error in tasks:
+            if error is not None:
+                raise error
+            batches[i] = statistics
+    null = {name: np.concatenate([batch[name] for batch in batches]) for name in observed}
+    return observed, null
+
+
+@hydra.main(config_path="../../config", config_name="config_null", version_base=None)
+def main(cfg: DictConfig):
+    df_index, _ = load_embeddings(cfg.embeddings.dir, cfg.permutation.model, mmap=True)
+    log.info(
+        f"{len(df_index)} selfies of {df_index['user_id'].nunique()} users, "
+        f"{cfg.permutation.n_permutations} permutations"
+    )
+    observed, null = null_distribution(
+        cfg.embeddings.dir,
+        cfg.permutation.model,
+        df_index["user_id"].to_numpy(),
+        cfg.permutation,
+        cfg.embeddings.precision,
+    )
+    df_summary = null_summary(observed, null)
+    df_summary.insert(0, "model", cfg.permutation.model)
+    df_summary.insert(1, "similarity_metric", cfg.permutation.metric)
+    df_summary.to_csv(cfg.permutation.output, index=False)
+    pd.DataFrame(null).to_csv(cfg.permutation.permutations_output, index_label="permutation")
+    log.info(f"\n{df_summary.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
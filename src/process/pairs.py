@@ -0,0 +1,125 @@
+import hashlib
+import random
+from itertools import combinations, groupby
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.data.registry import path_key
+
+# DeepFace.verify runs one direction of a pair; the scored distance is symmetric
+# for the metrics we use, which check_commutativity.py audits
+
+
+def ordered_pair(a: Path | str, b: Path | str) -> tuple[Path, Path]:
+    """The pair with the smaller `path_key` first, so (a, b) and (b, a) are one pair."""
+    a, b = Path(a), Path(b)
+    return (a, b) if path_key(a) <= path_key(b) else (b, a)
+
+
+def pair_key(a: Path | str, b: Path | str) -> tuple[str, str]:
+    a, b = ordered_pair(a, b)
+    return path_key(a), path_key(b)
+
+
+def intra_pairs(paths: Iterable[Path | str], mode: str = "first") -> list:
+    """
+    Pairs within one user's selfies, in `path_key` order.
+
+    parameters
+    paths : Iterable[Path | str]
+        selfies of a single user.
+    mode : str
+        "first" compares the earliest selfie with every later one, "all"
+        compares every unordered pair once.
+    """
+    paths = sorted((Path(p) for p in paths), key=path_key)
+    if mode == "first":
+        return [(paths[0], p) for p in paths[1:]]
+    if mode == "all":
+        return list(combinations(paths, 2))
+    raise ValueError(f"Mode must be 'first' or 'all', got {mode}")
+
+
+def inter_pairs(latest_paths: Iterable[Path | str]) -> Iterator[tuple[Path, Path]]:
+    """
+    Every unordered pair of the users' latest selfies, lazily, since 12k users
+    make ~77M pairs. Pairs come grouped by their first selfie.
+    """
+    return combinations(sorted((Path(p) for p in latest_paths), key=path_key), 2)
+
+
+def row_blocks(n: int, pairs_per_block: int) -> list[tuple[int, int]]:
+    """
+    Split the rows of the `inter_pairs` triangle of `n` selfies into
+    [start, stop) blocks of about `pairs_per_block` pairs each; row i pairs
+    selfie i with the n - i - 1 selfies after it.
+    """
+    pairs_before = np.cumsum(np.r_[0, np.arange(n - 1, 0, -1)])
+    cuts = np.searchsorted(pairs_before, np.arange(0, pairs_before[-1], pairs_per_block), side="right") - 1
+    starts = np.unique(cuts)
+    return [(int(a), int(b)) for a, b in zip(starts, np.r_[starts[1:], n - 1])]
+
+
+def plan_signature(paths: Iterable[Path | str]) -> str:
+    """Fingerprint of the ordered selfies a plan was cut from."""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path_key(path).encode())
+        digest.update(b"\n")
+    return digest.hexdigest()[:16]
+
+
+def by_first(pairs: Iterable[tuple[Path, Path]]) -> Iterator[tuple[Path, Iterator[Path]]]:
+    """(a, iterator of b) for pairs already grouped by their first selfie."""
+    for a, group in groupby(pairs, key=lambda pair: pair[0]):
+        yield a, (b for _, b in group)
+
+
+def random_pairs(paths_by_user: dict, n: int, same_user: bool, seed: int = 0) -> list:
+    """
+    Seeded spot check pairs drawn without building the full pair list: two
+    selfies of one user, or one selfie each of two users. Duplicates drawn
+    by chance are merged, so fewer than `n` pairs can come back.
+    """
+    rng = random.Random(seed)
+    users = sorted(paths_by_user)
+    if same_user:
+        users = [user for user in users if len(paths_by_user[user]) > 1]
+    if not users or (not same_user and len(users) < 2):
+        return []
+    pairs = []
+    for _ in range(n):
+        if same_user:
+            pairs.append(rng.sample(sorted(paths_by_user[rng.choice(users)], key=path_key), 2))
+        else:
+            user1, user2 = rng.sample(users, 2)
+            pairs.append((rng.choice(paths_by_user[user1]), rng.choice(paths_by_user[user2])))
+    return plan(pairs)
+
+
+def plan(*pair_groups: Iterable[tuple]) -> list:
+    """
+    One deduplicated, deterministically ordered list of unordered pairs from
+    any number of requests, e.g. intra pairs, inter pairs and spot checks.
+    """
+    planned = {}
+    for pairs in pair_groups:
+        for a, b in pairs:
+            planned.setdefault(pair_key(a, b), ordered_pair(a, b))
+    return [planned[key] for key in sorted(planned)]
+
+
+def drop_scored(
+    pairs: Iterable[tuple],
+    df_scores: pd.DataFrame,
+    img1_col: str = "img1_path",
+    img2_col: str = "img2_path",
+) -> list:
+    """Pairs without a score yet in either direction."""
+    scored = {
+        pair_key(a, b) for a, b in zip(df_scores[img1_col], df_scores[img2_col])
+    }
+    return [(a, b) for a, b in pairs if pair_key(a, b) not in scored]
@@ -0,0 +1,120 @@
+import logging
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.process.embeddings import (
+    blocked_distances,
+    embeddings_path,
+    load_embeddings,
+    save_embeddings,
+    to_precision,
+)
+
+log = logging.getLogger(__name__)
+
+
+def top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k smallest distances per row, in no particular order."""
+    return np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+
+def quantization_report(
+    matrix: np.ndarray,
+    metric: str,
+    precisions: list,
+    ks: list,
+    thresholds: list,
+    sample_size: int = 1000,
+    seed: int = 42,
+) -> pd.DataFrame:
+    """
+    How much compact copies of an embedding matrix change what the distances
+    are used for, on a seeded sample of query rows against all rows.
+
+    parameters
+    matrix : np.ndarray
+        float32 embeddings, the reference.
+    precisions : list
+        compact precisions to compare, "float16" and/or "int8".
+    ks : list
+        neighbour counts for recall@k, the share of the float32 top k that
+        the compact copy also ranks in its top k.
+    thresholds : list
+        distance thresholds for the decision flip rate, the share of pairs
+        that are verified under one precision and not under the other.
+
+    returns
+    pd.DataFrame
+        one row per precision with its size, distance errors, recall@k and
+        flip rate per threshold.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    queries = np.sort(rng.choice(len(matrix), size=min(sample_size, len(matrix)), replace=False))
+    rows = np.arange(len(queries))
+    exact = blocked_distances(matrix[queries], matrix, metric)
+    exact[rows, queries] = np.inf
+    ks = [k for k in ks if k < len(matrix)]
+    exact_top = {k: top_k(exact, k) for k in ks}
+    records = []
+    for precision in precisions:
+        compact = to_precision(matrix, precision)
+        approx = blocked_distances(compact[queries], compact, metric)
+        approx[rows, queries] = np.inf
+        finite = np.isfinite(exact)
+        error = np.abs(approx[finite] - exact[finite])
+        record = {
+            "precision": precision,
+            "bytes": compact.nbytes,
+            "compression": matrix.nbytes / compact.nbytes,
+            "max_abs_error": float(error.max()),
+            "mean_abs_error": float(error.mean()),
+            "top1_agreement": float(np.mean(exact.argmin(axis=1) == approx.argmin(axis=1))),
+        }
+        for k in ks:
+            approx_top = top_k(approx, k)
+            hits = (exact_top[k][:, :, None] == approx_top[:, None, :]).any(axis=2)
+            record[f"recall_at_{k}"] = float(hits.mean())
+        for threshold in thresholds:
+            flips = (exact[finite] <= threshold) != (approx[finite] <= threshold)
+            record[f"flip_rate_{threshold:g}"] = float(flips.mean())
+        records.append(record)
+    return pd.DataFrame(records)
+
+
+@hydra.main(config_path="../../config", config_name="config_quantization", version_base=None)
+def main(cfg: DictConfig):
+    list_df = []
+    for model in cfg.quantization.models:
+        if not embeddings_path(cfg.embeddings.dir, model).exists():
+            log.info(f"No float32 embeddings for {model} in {cfg.embeddings.dir}")
+            continue
+        df_index, matrix = load_embeddings(cfg.embeddings.dir, model)
+        df_report = quantization_report(
+            matrix,
+            cfg.quantization.metric,
+            list(cfg.quantization.precisions),
+            list(cfg.quantization.k),
+            list(cfg.quantization.thresholds),
+            cfg.quantization.sample_size,
+            cfg.quantization.seed,
+        )
+        df_report.insert(0, "model", model)
+        df_report.insert(1, "similarity_metric", cfg.quantization.metric)
+        list_df.append(df_report)
+        if cfg.quantization.save:
+            save_embeddings(cfg.embeddings.dir, model, df_index, matrix, cfg.quantization.precisions)
+    if not list_df:
+        log.info(f"No float32 embeddings of any model in {cfg.embeddings.dir}, no report written")
+        return
+    df_report = pd.concat(list_df, ignore_index=True)
+    df_report.to_csv(cfg.quantization.output, index=False)
+    log.info(f"\n{df_report.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
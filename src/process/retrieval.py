@@ -0,0 +1,251 @@
+import concurrent.futures
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.data.summaries import SummarySet, summary_path
+from src.process.deepface_inter import inter_user_comps
+from src.process.embeddings import blocked_distances, load_embeddings, take_rows
+from src.process.landmark_geometry import (
+    load_landmarks,
+    normalise_shapes,
+    procrustes_distances,
+    stack_landmarks,
+)
+
+log = logging.getLogger(__name__)
+
+
+def latest_per_user(df_index: pd.DataFrame, path_col: str = "img_path") -> np.ndarray:
+    """Positions of each user's latest selfie, the same pick as deepface_inter."""
+    df_sorted = df_index.reset_index(drop=True).sort_values(["user_id", path_col])
+    return df_sorted.groupby("user_id").tail(1).index.values
+
+
+def embedding_signal(
+    embeddings_dir: Path | str, model: str, metric: str, precision: str = "float32"
+):
+    df_index, matrix = load_embeddings(embeddings_dir, model, precision=precision)
+    latest = latest_per_user(df_index)
+    df_users = df_index.iloc[latest].reset_index(drop=True)
+    # kept in the stored precision, expanded to float32 one block at a time
+    matrix = take_rows(matrix, latest)
+
+    def distance_block(start: int, stop: int) -> np.ndarray:
+        return blocked_distances(matrix[start:stop], matrix, metric)
+
+    return df_users, distance_block
+
+
+def landmark_signal(landmarks_csv: Path | str):
+    df_index = load_landmarks(landmarks_csv).rename(columns={"selfie_path": "img_path"})
+    latest = latest_per_user(df_index)
+    df_users = df_index.iloc[latest].reset_index(drop=True)[["user_id", "img_path"]]
+    shapes = normalise_shapes(stack_landmarks(df_index.iloc[latest]))
+
+    def distance_block(start: int, stop: int) -> np.ndarray:
+        return procrustes_distances(shapes[start:stop], shapes)
+
+    return df_users, distance_block
+
+
+def shortlist(
+    distance_block: Callable[[int, int], np.ndarray],
+    n: int,
+    shortlist_size: int,
+    block_size: int = 1024,
+) -> np.ndarray:
+    """
+    The `shortlist_size` nearest users of every user under the cheap signal.
+
+    returns
+    np.ndarray
+        array of shape (n, shortlist_size) with neighbour positions, nearest first.
+    """
+    shortlist_size = min(shortlist_size, n - 1)
+    neighbours = np.empty((n, shortlist_size), dtype=np.int64)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        distances = np.asarray(distance_block(start, stop), dtype=np.float32)
+        rows = np.arange(stop - start)
+        distances[rows, rows + start] = np.inf
+        nearest = np.argpartition(distances, shortlist_size - 1, axis=1)[:, :shortlist_size]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        neighbours[start:stop] = np.take_along_axis(nearest, order, axis=1)
+    return neighbours
+
+
+def candidate_pairs(neighbours: np.ndarray) -> np.ndarray:
+    """Unordered, deduplicated (i < j) pairs out of the per user shortlists."""
+    rows = np.repeat(np.arange(len(neighbours)), neighbours.shape[1])
+    cols = neighbours.ravel()
+    pairs = np.stack([np.minimum(rows, cols), np.maximum(rows, cols)], axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def rerank(
+    pairs: np.ndarray,
+    df_users: pd.DataFrame,
+    cfg: DictConfig,
+    output: Path | str,
+) -> None:
+    """Score the candidate pairs with the expensive model, in the deepface_inter schema."""
+    output = Path(output)
+    img_paths = [Path(path) for path in df_users["img_path"]]
+    summaries = SummarySet(cfg.summaries.n_bins, relative_accuracy=cfg.summaries.relative_accuracy)
+    with tqdm(desc=f"Re-ranking with {cfg.retrieval.model}", total=len(pairs)) as pbar:
+        with ProcessPoolExecutor(max_workers=cfg.retrieval.max_workers) as executor:
+            futures = [
+                executor.submit(
+                    inter_user_comps,
+                    img_paths[i],
+                    img_paths[j],
+                    cfg.retrieval.metric,
+                    cfg.retrieval.model,
+                    cfg.decode.scale,
+                    cfg.decode.face_fraction,
+                    cfg.shards.dir if cfg.shards.read else None,
+                )
+                for i, j in pairs
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    df_scores, _ = future.result()
+                    df_scores.to_csv(output, index=False, mode="a", header=not output.exists())
+                    summaries.update(df_scores)
+                except Exception as e:
+                    log.info(f"Metric: {cfg.retrieval.metric}, model: {cfg.retrieval.model}")
+                    log.info(f"Error: {e}")
+                pbar.update(1)
+    summaries.save(summary_path(cfg.summaries.dir, output.stem))
+
+
+def candidate_sets(neighbours: np.ndarray, shortlist_size: int) -> list[set]:
+    """Users each user ends up scored against: its own shortlist plus everyone who shortlisted it."""
+    candidates = [set(row[:shortlist_size].tolist()) for row in neighbours]
+    for i, row in enumerate(neighbours):
+        for j in row[:shortlist_size]:
+            candidates[j].add(i)
+    return candidates
+
+
+def recall_at_k(
+    df_exhaustive: pd.DataFrame,
+    df_users: pd.DataFrame,
+    neighbours: np.ndarray,
+    shortlist_sizes: list,
+    ks: list,
+) -> pd.DataFrame:
+    """
+    Recall@k of the two stage search against exhaustive expensive scores.
+
+    Re-ranking reproduces the exhaustive distance of every candidate, so a true
+    top-k neighbour is found exactly when it made it into the candidate set.
+
+    parameters
+    df_exhaustive : pd.DataFrame
+        expensive scores with the query user as user1_id, against all other users.
+    """
+    position = pd.Series(np.arange(len(df_users)), index=df_users["user_id"].values)
+    df_exhaustive = df_exhaustive.loc[
+        df_exhaustive["user1_id"].isin(position.index)
+        & df_exhaustive["user2_id"].isin(position.index)
+    ].sort_values(["user1_id", "distance"])
+    records = []
+    for shortlist_size in shortlist_sizes:
+        candidates = candidate_sets(neighbours, shortlist_size)
+        for k in ks:
+            recalls = []
+            for user, df_user in df_exhaustive.groupby("user1_id"):
+                true_top_k = position.loc[df_user["user2_id"].head(k)].values
+                found = candidates[position.loc[user]]
+                recalls.append(np.mean([j in found for j in true_top_k]))
+            records.append(
+                {
+                    "shortlist_size": shortlist_size,
+                    "k": k,
+                    "recall": float(np.mean(recalls)),
+                    "n_users": len(recalls),
+                    "n_pairs": sum(len(c) for c in candidates) // 2,
+                }
+            )
+    return pd.DataFrame(records)
+
+
+def exhaustive_sample(df_users: pd.DataFrame, cfg: DictConfig) -> pd.DataFrame:
+    """Expensive scores of a seeded sample of users against all users."""
+    rng = np.random.default_rng(cfg.retrieval.recall.seed)
+    sample = rng.choice(
+        len(df_users), size=min(cfg.retrieval.recall.sample_size, len(df_users)), replace=False
+    )
+    if cfg.retrieval.recall.exhaustive_scores:
+        df_scores = pd.read_csv(
+            cfg.retrieval.recall.exhaustive_scores,
+            usecols=["user1_id", "user2_id", "distance", "model", "similarity_metric"],
+        )
+        df_scores = df_scores.loc[
+            (df_scores["model"] == cfg.retrieval.model)
+            & (df_scores["similarity_metric"] == cfg.retrieval.metric)
+        ]
+    else:
+        output = Path(cfg.retrieval.recall.scores)
+        output.unlink(missing_ok=True)
+        pairs = np.array(
+            [(i, j) for i in sample for j in range(len(df_users)) if j != i], dtype=np.int64
+        )
+        rerank(pairs, df_users, cfg, output)
+        df_scores = pd.read_csv(output, usecols=["user1_id", "user2_id", "distance"])
+    # keep the sample user as user1 so every row belongs to one of its rankings
+    sample_users = df_users["user_id"].values[sample]
+    df_flipped = df_scores.loc[df_scores["user2_id"].isin(sample_users)].rename(
+        columns={"user1_id": "user2_id", "user2_id": "user1_id"}
+    )
+    return pd.concat(
+        [df_scores.loc[df_scores["user1_id"].isin(sample_users)], df_flipped]
+    ).drop_duplicates(subset=["user1_id", "user2_id"])
+
+
+@hydra.main(config_path="../../config", config_name="config_retrieval", version_base=None)
+def main(cfg: DictConfig):
+    if cfg.retrieval.signal == "landmarks":
+        df_users, distance_block = landmark_signal(cfg.retrieval.landmarks_csv)
+    else:
+        df_users, distance_block = embedding_signal(
+            cfg.embeddings.dir,
+            cfg.retrieval.cheap_model,
+            cfg.retrieval.cheap_metric,
+            cfg.embeddings.precision,
+        )
+    max_shortlist = max([cfg.retrieval.shortlist_size, *cfg.retrieval.recall.shortlist_sizes])
+    neighbours = shortlist(distance_block, len(df_users), max_shortlist, cfg.retrieval.block_size)
+
+    if cfg.retrieval.mode == "recall":
+        df_exhaustive = exhaustive_sample(df_users, cfg)
+        df_recall = recall_at_k(
+            df_exhaustive,
+            df_users,
+            neighbours,
+            list(cfg.retrieval.recall.shortlist_sizes),
+            list(cfg.retrieval.recall.k),
+        )
+        df_recall.to_csv(cfg.retrieval.recall.output, index=False)
+        log.info(f"\n{df_recall.to_string(index=False)}")
+        return
+
+    pairs = candidate_pairs(neighbours[:, : cfg.retrieval.shortlist_size])
+    log.info(
+        f"Scoring {len(pairs)} candidate pairs instead of {len(df_users) * (len(df_users) - 1) // 2}"
+    )
+    rerank(pairs, df_users, cfg, cfg.retrieval.scores)
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
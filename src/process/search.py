@@ -0,0 +1,255 @@
+import logging
+from pathlib import Path
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import DictConfig
+
+from src.process.embeddings import Int8Matrix, load_embeddings, pairwise_distances, take_rows
+from src.process.retrieval import latest_per_user
+
+log = logging.getLogger(__name__)
+
+
+def partition_embeddings(
+    df_index: pd.DataFrame, matrix: np.ndarray, df_strata: pd.DataFrame, by: list
+) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """
+    Reorder the embeddings so every partition (one combination of the `by`
+    strata columns) is a contiguous block of rows.
+
+    parameters
+    df_index : pd.DataFrame
+        user_id and img_path per row of `matrix`.
+    matrix : np.ndarray
+        embedding matrix.
+    df_strata : pd.DataFrame
+        user_id and the strata columns, e.g. from `cohort.add_strata`.
+    by : list
+        strata columns to partition by.
+
+    returns
+    tuple
+        index with `partition` (code) and `partition_name` columns, the
+        reordered matrix and the partition offsets, where partition p holds
+        rows offsets[p]:offsets[p + 1].
+    """
+    df_index = df_index.reset_index(drop=True).merge(
+        df_strata[["user_id", *by]], on="user_id", how="left", validate="many_to_one"
+    )
+    codes = df_index.groupby(by, dropna=False, observed=True, sort=True).ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=codes.max() + 1 if len(codes) else 0)
+    # names are built once per partition from its first member
+    first = order[np.r_[0, np.cumsum(counts)[:-1]]] if len(codes) else order
+    names = [", ".join(map(str, row)) for row in df_index.loc[first, by].itertuples(index=False)]
+    df_index = df_index.iloc[order].reset_index(drop=True)
+    df_index["partition"] = codes[order]
+    df_index["partition_name"] = np.asarray(names, dtype=object)[codes[order]]
+    return df_index, take_rows(matrix, order), np.r_[0, np.cumsum(counts)]
+
+
+def partitioned_path(
+    embeddings_dir: Path | str, model: str, by: list, precision: str = "float32"
+) -> Path:
+    # no dot in the name, since the .npy suffix is swapped in with with_suffix
+    suffix = "" if precision == "float32" else f"_{precision}"
+    return Path(embeddings_dir) / f"{model}_by_{'-'.join(by)}{suffix}"
+
+
+def save_partitioned(
+    embeddings_dir: Path | str,
+    model: str,
+    by: list,
+    df_index: pd.DataFrame,
+    matrix: np.ndarray,
+    offsets: np.ndarray,
+    precision: str = "float32",
+) -> None:
+    path = partitioned_path(embeddings_dir, model, by, precision)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(matrix, Int8Matrix):
+        matrix.save(path.with_suffix(".npy"))
+    else:
+        np.save(path.with_suffix(".npy"), matrix)
+    np.save(path.with_name(f"{path.name}_offsets.npy"), offsets)
+    df_index.to_csv(path.with_name(f"{path.name}_index.csv"), index=False)
+
+
+def load_partitioned(
+    embeddings_dir: Path | str, model: str, by: list, mmap: bool = True, precision: str = "float32"
+) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Partitioned embeddings; memory mapped, so a query only reads its partitions' rows."""
+    path = partitioned_path(embeddings_dir, model, by, precision)
+    if precision == "int8":
+        matrix = Int8Matrix.load(path.with_suffix(".npy"), mmap)
+    else:
+        matrix = np.load(path.with_suffix(".npy"), mmap_mode="r" if mmap else None)
+    offsets = np.load(path.with_name(f"{path.name}_offsets.npy"))
+    df_index = pd.read_csv(path.with_name(f"{path.name}_index.csv"))
+    return df_index, matrix, offsets
+
+
+def nearest(
+    queries: np.ndarray,
+    candidates: np.ndarray,
+    k: int,
+    metric: str,
+    exclude: np.ndarray | None = None,
+    block_size: int = 1024,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The `k` nearest candidates of every query, nearest first.
+
+    parameters
+    exclude : np.ndarray | None
+        candidate position to skip per query, e.g. the query itself; -1 skips none.
+
+    returns
+    tuple
+        distances and candidate positions of shape (n_queries, k); when there
+        are fewer than `k` candidates the rest is padded with inf and -1.
+    """
+    n = len(queries)
+    distances = np.full((n, k), np.inf, dtype=np.float32)
+    positions = np.full((n, k), -1, dtype=np.int64)
+    kk = min(k, len(candidates))
+    if kk == 0:
+        return distances, positions
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = np.asarray(pairwise_distances(queries[start:stop], candidates, metric), dtype=np.float32)
+        if exclude is not None:
+            rows = np.flatnonzero(exclude[start:stop] >= 0)
+            block[rows, exclude[start:stop][rows]] = np.inf
+        top = np.argpartition(block, kk - 1, axis=1)[:, :kk]
+        top_distances = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(top_distances, axis=1, kind="stable")
+        distances[start:stop, :kk] = np.take_along_axis(top_distances, order, axis=1)
+        positions[start:stop, :kk] = np.take_along_axis(top, order, axis=1)
+    # an excluded candidate can end up in a partition smaller than k
+    positions[np.isinf(distances)] = -1
+    return distances, positions
+
+
+def merge_nearest(results: list, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Merge per partition `nearest` results (with global positions) into one top k."""
+    distances = np.concatenate([d for d, _ in results], axis=1)
+    positions = np.concatenate([p for _, p in results], axis=1)
+    kk = min(k, distances.shape[1])
+    top = np.argpartition(distances, kk - 1, axis=1)[:, :kk]
+    order = np.argsort(np.take_along_axis(distances, top, axis=1), axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    return np.take_along_axis(distances, top, axis=1), np.take_along_axis(positions, top, axis=1)
+
+
+def search(
+    df_index: pd.DataFrame,
+    matrix: np.ndarray,
+    offsets: np.ndarray,
+    query_positions: np.ndarray,
+    k: int,
+    metric: str,
+    within: bool = True,
+    block_size: int = 1024,
+) -> pd.DataFrame:
+    """
+    Top `k` lookalikes of the queries in partitioned embeddings.
+
+    Within partition queries only compute distances to their own partition.
+    Cross partition queries search every partition and merge the results,
+    so no more than one partition's distances are in memory at a time.
+
+    parameters
+    df_index, matrix, offsets
+        output of `partition_embeddings` or `load_partitioned`.
+    query_positions : np.ndarray
+        rows of `matrix` to find lookalikes for.
+    within : bool
+        search only the query's own partition, else all partitions.
+
+    returns
+    pd.DataFrame
+        one row per query and rank with user1_id, img1_path, user2_id,
+        img2_path, distance and rank, nearest first.
+    """
+    query_positions = np.asarray(query_positions, dtype=np.int64)
+    partitions = df_index["partition"].to_numpy()[query_positions]
+    distances = np.full((len(query_positions), k), np.inf, dtype=np.float32)
+    positions = np.full((len(query_positions), k), -1, dtype=np.int64)
+    for p in range(len(offsets) - 1):
+        start, stop = offsets[p], offsets[p + 1]
+        queries = np.flatnonzero(partitions == p) if within else np.arange(len(query_positions))
+        if not len(queries) or start == stop:
+            continue
+        own = query_positions[queries]
+        exclude = np.where((own >= start) & (own < stop), own - start, -1)
+        found = nearest(
+            np.asarray(matrix[own], dtype=np.float32),
+            np.asarray(matrix[start:stop], dtype=np.float32),
+            k,
+            metric,
+            exclude,
+            block_size,
+        )
+        found = (found[0], np.where(found[1] >= 0, found[1] + start, -1))
+        if within:
+            distances[queries], positions[queries] = found
+        else:
+            distances, positions = merge_nearest([(distances, positions), found], k)
+    query, rank = np.nonzero(positions >= 0)
+    partners = positions[query, rank]
+    pairs = {
+        "user1_id": df_index["user_id"].to_numpy()[query_positions[query]],
+        "img1_path": df_index["img_path"].to_numpy()[query_positions[query]],
+        "user2_id": df_index["user_id"].to_numpy()[partners],
+        "img2_path": df_index["img_path"].to_numpy()[partners],
+        "distance": distances[query, rank],
+        "rank": rank + 1,
+    }
+    return pd.DataFrame(pairs)
+
+
+@hydra.main(config_path="../../config", config_name="config_retrieval", version_base=None)
+def main(cfg: DictConfig):
+    by = list(cfg.search.by)
+    model = cfg.search.model
+    precision = cfg.embeddings.precision
+    if (
+        cfg.search.rebuild
+        or not partitioned_path(cfg.embeddings.dir, model, by, precision).with_suffix(".npy").exists()
+    ):
+        df_index, matrix = load_embeddings(cfg.embeddings.dir, model, precision=precision)
+        latest = latest_per_user(df_index)
+        df_strata = pd.read_csv(cfg.search.strata_csv)
+        df_index, matrix, offsets = partition_embeddings(
+            df_index.iloc[latest], take_rows(matrix, latest), df_strata, by
+        )
+        save_partitioned(cfg.embeddings.dir, model, by, df_index, matrix, offsets, precision)
+    df_index, matrix, offsets = load_partitioned(cfg.embeddings.dir, model, by, precision=precision)
+    log.info(
+        f"{len(offsets) - 1} partitions by {by}, largest {np.diff(offsets).max()} of {len(df_index)} users"
+    )
+    if cfg.search.query_users:
+        query_positions = np.flatnonzero(df_index["user_id"].isin(list(cfg.search.query_users)))
+    else:
+        query_positions = np.arange(len(df_index))
+    df_lookalikes = search(
+        df_index,
+        matrix,
+        offsets,
+        query_positions,
+        cfg.search.k,
+        cfg.search.metric,
+        cfg.search.within,
+        cfg.retrieval.block_size,
+    )
+    df_lookalikes["model"] = model
+    df_lookalikes["similarity_metric"] = cfg.search.metric
+    df_lookalikes.to_csv(cfg.search.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
@@ -0,0 +1,110 @@
+import concurrent.futures
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import hydra
+import pandas as pd
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from src.process.landmark_geometry import parse_landmarks
+from src.visualization.visutil import render_contact_sheet
+
+log = logging.getLogger(__name__)
+
+
+def top_lookalike_pairs(df_scores: pd.DataFrame, user_id: int, n: int) -> pd.DataFrame:
+    """The `n` closest pairs involving `user_id`, with the user always shown on the left."""
+    df_user = df_scores.loc[
+        (df_scores["user1_id"] == user_id) | (df_scores["user2_id"] == user_id)
+    ].nsmallest(n, "distance")
+    flip = df_user["user2_id"] == user_id
+    df_user.loc[flip, ["user1_id", "user2_id", "img1_path", "img2_path"]] = df_user.loc[
+        flip, ["user2_id", "user1_id", "img2_path", "img1_path"]
+    ].values
+    return df_user
+
+
+def load_pair_landmarks(landmarks_csv: Path | str, paths: set) -> dict:
+    df_landmarks = pd.read_csv(landmarks_csv, usecols=["selfie_path", "landmarks"])
+    df_landmarks = df_landmarks.loc[
+        df_landmarks["selfie_path"].isin(paths) & df_landmarks["landmarks"].notna()
+    ]
+    return {
+        path: parse_landmarks(landmarks)
+        for path, landmarks in zip(df_landmarks["selfie_path"], df_landmarks["landmarks"])
+    }
+
+
+def write_sheet(
+    df_pairs: pd.DataFrame, landmarks: dict, output: Path, cfg: DictConfig
+) -> Path:
+    sheet = render_contact_sheet(
+        df_pairs,
+        landmarks,
+        ncols=cfg.sheets.ncols,
+        tile_height=cfg.sheets.tile_height,
+        decode_scale=cfg.sheets.decode_scale,
+    )
+    cv2.imwrite(output.as_posix(), sheet, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return output
+
+
+@hydra.main(config_path="../../config", config_name="config_contact_sheets", version_base=None)
+def main(cfg: DictConfig):
+    df_scores = pd.read_csv(
+        cfg.sheets.scores,
+        usecols=[
+            "user1_id",
+            "user2_id",
+            "img1_path",
+            "img2_path",
+            "distance",
+            "model",
+            "similarity_metric",
+        ],
+    )
+    df_scores = df_scores.loc[
+        (df_scores["model"] == cfg.sheets.model)
+        & (df_scores["similarity_metric"] == cfg.sheets.metric)
+    ]
+    users = (
+        list(cfg.sheets.users)
+        if cfg.sheets.users
+        else df_scores.nsmallest(cfg.sheets.n_users, "distance")["user1_id"].unique().tolist()
+    )
+    pairs = {user: top_lookalike_pairs(df_scores, user, cfg.sheets.pairs_per_sheet) for user in users}
+    pair_paths = set()
+    for df_pairs in pairs.values():
+        pair_paths.update(df_pairs["img1_path"])
+        pair_paths.update(df_pairs["img2_path"])
+    landmarks = load_pair_landmarks(cfg.sheets.landmarks_csv, pair_paths)
+
+    output_dir = Path(cfg.sheets.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with tqdm(desc="Rendering contact sheets", total=len(pairs)) as pbar:
+        with ThreadPoolExecutor(max_workers=cfg.sheets.max_workers) as executor:
+            futures = [
+                executor.submit(
+                    write_sheet,
+                    df_pairs,
+                    landmarks,
+                    output_dir / f"{user}_{cfg.sheets.model}_{cfg.sheets.metric}.jpg",
+                    cfg,
+                )
+                for user, df_pairs in pairs.items()
+                if len(df_pairs)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    log.info(f"Error: {e}")
+                pbar.update(1)
+
+
+if __name__ == "__main__":
+    main()
+    print("Done!")
@@ -12,6 +12,7 @@ from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
 from tqdm import tqdm
 
+from src.process.pairs import drop_scored, plan
 from src.visualization.visutil import (
     draw_landmarks_on_image,
     plot_face_blendshapes_bar_graph,
@@ -129,12 +130,8 @@ fig = plot_selfies_w_landmarks(
     selfie2_path=min_distance["selfie2_path"].values[0],
 )
 
-cosine_distance = dpf.verify(
-    img1_path=min_distance["selfie1_path"].values[0],
-    img2_path=min_distance["selfie2_path"].values[0],
-    detector_backend="mediapipe",
-    distance_metric="cosine",
-)["distance"]
+# already scored above, no need to verify the pair again
+cosine_distance = min_distance["distance"].values[0]
 
 
 fig.suptitle(
@@ -153,12 +150,8 @@ fig = plot_selfies_w_landmarks(
     selfie2_path=max_distance["selfie2_path"].values[0],
 )
 
-cosine_distance = dpf.verify(
-    img1_path=max_distance["selfie1_path"].values[0],
-    img2_path=max_distance["selfie2_path"].values[0],
-    detector_backend="mediapipe",
-    distance_metric="cosine",
-)["distance"]
+# already scored above, no need to verify the pair again
+cosine_distance = max_distance["distance"].values[0]
 
 fig.suptitle(
     f"Selfies for {max_distance['user1'].values[0]}, {max_distance['user2'].values[0]} | {cosine_distance = :.5f}"
@@ -168,7 +161,11 @@ fig.savefig(
 )
 fig.show()
 # %%
-for img1, img2 in tqdm(it.combinations(selfie_pool, 2)):
+# every other pair of the pool once, skipping the ones scored against the first selfie
+remaining_pairs = drop_scored(
+    plan(it.combinations(selfie_pool, 2)), df_selfie_comp, "selfie1_path", "selfie2_path"
+)
+for img1, img2 in tqdm(remaining_pairs):
     user1 = img1.parts[-2]
     user2 = img2.parts[-2]
     try:
@@ -1,54 +1,159 @@
+from functools import lru_cache
+from pathlib import Path
+
+import cv2
 import mediapipe as mp
-from mediapipe import solutions
-from mediapipe.framework.formats import landmark_pb2
 import numpy as np
 import matplotlib.pyplot as plt
+import pandas as pd
+
+from src.data.decode import read_selfie
+
+TESSELATION_COLOR = (0, 241, 241)
+LINE_THICKNESS = 2
+
+
+@lru_cache(maxsize=None)
+def connection_groups(style: str) -> tuple:
+    """
+    Face mesh connections as (color, thickness, index array) groups, built
+    once so drawing a face is a few `cv2.polylines` calls instead of one
+    `cv2.line` per connection.
+    """
+    face_mesh = mp.solutions.face_mesh
+    drawing_styles = mp.solutions.drawing_styles
+    if style == "tesselation":
+        specs = {
+            connection: (TESSELATION_COLOR, LINE_THICKNESS)
+            for connection in face_mesh.FACEMESH_TESSELATION
+        }
+    elif style == "contours":
+        specs = {
+            connection: (spec.color, spec.thickness)
+            for connection, spec in drawing_styles.get_default_face_mesh_contours_style().items()
+        }
+    elif style == "irises":
+        specs = {
+            connection: (spec.color, spec.thickness)
+            for connection, spec in drawing_styles.get_default_face_mesh_iris_connections_style().items()
+        }
+    else:
+        raise ValueError(f"Unknown connection style {style}")
+
+    grouped = {}
+    for connection, spec in specs.items():
+        grouped.setdefault(spec, []).append(connection)
+    return tuple(
+        (color, thickness, np.array(sorted(connections), dtype=np.int64))
+        for (color, thickness), connections in grouped.items()
+    )
+
+
+def landmarks_to_array(face_landmarks) -> np.ndarray:
+    return np.array([(lm.x, lm.y, lm.z) for lm in face_landmarks], dtype=np.float32)
+
+
+def draw_landmark_array(
+    image: np.ndarray,
+    landmarks: np.ndarray,
+    styles: tuple = ("tesselation", "contours", "irises"),
+) -> np.ndarray:
+    """
+    Draw a face mesh onto `image` in place.
+
+    parameters
+    image : np.ndarray
+        image to draw on, in the channel order the colors are meant for.
+    landmarks : np.ndarray
+        normalised landmark coordinates of shape (n_landmarks, 2 or 3).
+    """
+    height, width = image.shape[:2]
+    xy = np.asarray(landmarks, dtype=np.float32)[:, :2]
+    # landmarks outside the image are not drawn, as in mediapipe's draw_landmarks
+    inside = ((xy >= 0) & (xy <= 1)).all(axis=1)
+    pixels = np.minimum(
+        np.floor(xy * [width, height]), [width - 1, height - 1]
+    ).astype(np.int32)
+    for style in styles:
+        for color, thickness, connections in connection_groups(style):
+            connections = connections[connections.max(axis=1) < len(xy)]
+            connections = connections[inside[connections].all(axis=1)]
+            cv2.polylines(image, pixels[connections], False, color, thickness)
+    return image
 
 
 def draw_landmarks_on_image(rgb_image, detection_result):
-    face_landmarks_list = detection_result.face_landmarks
     annotated_image = np.copy(rgb_image)
+    for face_landmarks in detection_result.face_landmarks:
+        draw_landmark_array(annotated_image, landmarks_to_array(face_landmarks))
+    return annotated_image
 
-    # Loop through the detected faces to visualize.
-    for face_landmarks in face_landmarks_list:
-        # Draw the face landmarks.
-        face_landmarks_proto = landmark_pb2.NormalizedLandmarkList()
-        face_landmarks_proto.landmark.extend(
-            [
-                landmark_pb2.NormalizedLandmark(
-                    x=landmark.x, y=landmark.y, z=landmark.z
-                )
-                for landmark in face_landmarks
-            ]
-        )
 
-        mp.solutions.drawing_styles.get_default_face_mesh_tesselation_style()
+def render_pair_tile(
+    img1_path: Path | str,
+    img2_path: Path | str,
+    label: str,
+    landmarks: dict,
+    tile_height: int = 256,
+    decode_scale: int = 4,
+) -> np.ndarray:
+    """Two selfies side by side, with their landmark overlays and a label."""
+    faces = []
+    for img_path in (img1_path, img2_path):
+        image = read_selfie(img_path, scale=decode_scale, bgr=True)
+        face_landmarks = landmarks.get(Path(img_path).as_posix())
+        if face_landmarks is not None:
+            draw_landmark_array(image, face_landmarks)
+        width = round(image.shape[1] * tile_height / image.shape[0])
+        faces.append(cv2.resize(image, (width, tile_height), interpolation=cv2.INTER_AREA))
+    tile = np.hstack(faces)
+    cv2.putText(
+        tile, label, (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2, cv2.LINE_AA
+    )
+    return tile
 
-        solutions.drawing_utils.draw_landmarks(
-            image=annotated_image,
-            landmark_list=face_landmarks_proto,
-            connections=mp.solutions.face_mesh.FACEMESH_TESSELATION,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=mp.solutions.drawing_styles.DrawingSpec(
-                color=(0, 241, 241)
-            ),
-        )
-        solutions.drawing_utils.draw_landmarks(
-            image=annotated_image,
-            landmark_list=face_landmarks_proto,
-            connections=mp.solutions.face_mesh.FACEMESH_CONTOURS,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=mp.solutions.drawing_styles.get_default_face_mesh_contours_style(),
-        )
-        solutions.drawing_utils.draw_landmarks(
-            image=annotated_image,
-            landmark_list=face_landmarks_proto,
-            connections=mp.solutions.face_mesh.FACEMESH_IRISES,
-            landmark_drawing_spec=None,
-            connection_drawing_spec=mp.solutions.drawing_styles.get_default_face_mesh_iris_connections_style(),
-        )
 
-    return annotated_image
+def render_contact_sheet(
+    df_pairs: pd.DataFrame,
+    landmarks: dict,
+    ncols: int = 4,
+    tile_height: int = 256,
+    decode_scale: int = 4,
+) -> np.ndarray:
+    """
+    Grid of pair tiles for reviewing lookalikes.
+
+    parameters
+    df_pairs : pd.DataFrame
+        score rows with img1_path, img2_path, user1_id, user2_id and distance.
+    landmarks : dict
+        normalised landmark arrays keyed by selfie path; selfies without an
+        entry are shown without overlay.
+
+    returns
+    np.ndarray
+        BGR image of the whole sheet.
+    """
+    tiles = [
+        render_pair_tile(
+            row["img1_path"],
+            row["img2_path"],
+            f"{row['user1_id']} - {row['user2_id']} | {row['distance']:.4f}",
+            landmarks,
+            tile_height,
+            decode_scale,
+        )
+        for row in df_pairs.to_dict("records")
+    ]
+    tile_width = max(tile.shape[1] for tile in tiles)
+    tiles = [
+        cv2.copyMakeBorder(tile, 0, 0, 0, tile_width - tile.shape[1], cv2.BORDER_CONSTANT)
+        for tile in tiles
+    ]
+    blank = np.zeros_like(tiles[0])
+    tiles += [blank] * (-len(tiles) % ncols)
+    rows = [np.hstack(tiles[i : i + ncols]) for i in range(0, len(tiles), ncols)]
+    return np.vstack(rows)
 
 
 def plot_face_blendshapes_bar_graph(face_blendshapes):
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+import pytest
+from omegaconf import OmegaConf
+
+from src.process import backends
+from src.process.backends import (
+    OPTIMIZATIONS,
+    OnnxBackend,
+    TensorflowBackend,
+    export_onnx,
+    get_backend,
+    parity,
+)
+
+
+def toy_onnx_model(path, rng: np.random.Generator) -> tuple:
+    """A face-model-shaped graph: NHWC input, conv, relu, global pooling and a dense embedding."""
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper, numpy_helper
+
+    conv = rng.normal(size=(4, 3, 3, 3)).astype(np.float32)
+    dense = rng.normal(size=(4, 6)).astype(np.float32)
+    bias = rng.normal(size=6).astype(np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node("Transpose", ["input"], ["nchw"], perm=[0, 3, 1, 2]),
+            helper.make_node("Conv", ["nchw", "conv"], ["conv_out"], pads=[1, 1, 1, 1]),
+            helper.make_node("Relu", ["conv_out"], ["relu"]),
+            helper.make_node("GlobalAveragePool", ["relu"], ["pool"]),
+            helper.make_node("Flatten", ["pool"], ["flat"]),
+            helper.make_node("Gemm", ["flat", "dense", "bias"], ["embedding"]),
+        ],
+        "toy",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["n", 8, 8, 3])],
+        [helper.make_tensor_value_info("embedding", TensorProto.FLOAT, ["n", 6])],
+        [numpy_helper.from_array(w, name) for w, name in [(conv, "conv"), (dense, "dense"), (bias, "bias")]],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+    return conv, dense, bias
+
+
+def reference_embed(faces: np.ndarray, conv: np.ndarray, dense: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    padded = np.pad(faces, ((0, 0), (1, 1), (1, 1), (0, 0)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (3, 3), axis=(1, 2))
+    # windows: (n, 8, 8, channel, kh, kw) against filters (out, channel, kh, kw)
+    out = np.maximum(np.einsum("nhwckl,ockl->nhwo", windows, conv), 0)
+    return out.mean(axis=(1, 2)) @ dense + bias
+
+
+def test_onnx_backend_matches_a_reference_at_every_optimization_level(tmp_path):
+    pytest.importorskip("onnxruntime")
+    rng = np.random.default_rng(0)
+    weights = toy_onnx_model(tmp_path / "toy.onnx", rng)
+    faces = rng.uniform(size=(5, 8, 8, 3)).astype(np.float32)
+    expected = reference_embed(faces, *weights)
+    for optimization in OPTIMIZATIONS:
+        backend = OnnxBackend("toy", tmp_path / "toy.onnx", intra_op_threads=2, optimization=optimization)
+        embeddings = backend.embed(faces)
+        assert embeddings.shape == (5, 6)
+        assert parity(expected, embeddings)["max_rel_diff"] < 1e-5
+    # a batch of one, as represent runs it
+    np.testing.assert_allclose(backend.embed(faces[:1])[0], expected[0], rtol=1e-5)
+
+
+def test_backends_are_built_once_per_process(tmp_path):
+    pytest.importorskip("onnxruntime")
+    toy_onnx_model(tmp_path / "toy.onnx", np.random.default_rng(1))
+    options = {"name": "onnx", "onnx_dir": tmp_path.as_posix(), "optimization": "basic"}
+    assert get_backend(model="toy", **options) is get_backend(model="toy", **options)
+    with pytest.raises(ValueError):
+        get_backend("torch", "toy")
+
+
+def test_exported_keras_model_matches_tensorflow(tmp_path):
+    tf = pytest.importorskip("tensorflow")
+    pytest.importorskip("tf2onnx")
+    pytest.importorskip("onnxruntime")
+    tf.keras.utils.set_random_seed(0)
+    net = tf.keras.Sequential(
+        [
+            tf.keras.layers.Input((32, 32, 3)),
+            tf.keras.layers.Conv2D(8, 3, activation="relu"),
+            tf.keras.layers.BatchNormalization(),
+            tf.keras.layers.MaxPooling2D(),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(16),
+        ]
+    )
+    faces = np.random.default_rng(2).uniform(size=(4, 32, 32, 3)).astype(np.float32)
+    reference = TensorflowBackend("toy", net=net)
+    candidate = OnnxBackend("toy", export_onnx(net, tmp_path / "toy.onnx"))
+    report = parity(reference.embed(faces), candidate.embed(faces))
+    assert report["max_cosine_distance"] < 1e-6
+    assert report["max_rel_diff"] < 1e-4
+
+
+def test_parity_skips_a_model_without_preprocessed_selfies(tmp_path, monkeypatch):
+    for user in (1, 2):
+        (tmp_path / "selfies" / str(user)).mkdir(parents=True)
+        (tmp_path / "selfies" / str(user) / "2024-01-01_a.jpg").write_bytes(b"jpg")
+
+    class FakeBackend:
+        net = None
+
+        def __init__(self, *args):
+            pass
+
+        def embed(self, faces):
+            return np.ones((len(faces), 4), dtype=np.float32)
+
+    def preprocess(img, model):
+        if model == "Facenet":
+            raise ValueError("no face")
+        return np.zeros((1, 8, 8, 3), dtype=np.float32)
+
+    monkeypatch.setattr(backends, "TensorflowBackend", FakeBackend)
+    monkeypatch.setattr(backends, "OnnxBackend", FakeBackend)
+    monkeypatch.setattr(backends, "export_onnx", lambda net, path: None)
+    monkeypatch.setattr(backends, "deepface_input", lambda path, *args: path)
+    monkeypatch.setattr(backends, "preprocess", preprocess)
+    cfg = OmegaConf.create(
+        {
+            "shards": {"read": False, "dir": None},
+            "selfie_data": {"save_dir": str(tmp_path / "selfies")},
+            "registry": {"path": str(tmp_path / "registry.sqlite"), "skip": []},
+            "decode": {"scale": 1, "face_fraction": 0.5},
+            "backend": {
+                "onnx_dir": str(tmp_path / "onnx"),
+                "intra_op_threads": 1,
+                "inter_op_threads": 1,
+                "optimization": "all",
+                "parity": {
+                    "models": ["Facenet", "ArcFace"],
+                    "seed": 0,
+                    "sample_size": 2,
+                    "export": False,
+                    "output": str(tmp_path / "parity.csv"),
+                },
+            },
+        }
+    )
+    backends.main.__wrapped__(cfg)
+    assert pd.read_csv(tmp_path / "parity.csv")["model"].tolist() == ["ArcFace"]
+
+    # no model left at all: nothing is written
+    (tmp_path / "parity.csv").unlink()
+    cfg.backend.parity.models = ["Facenet"]
+    backends.main.__wrapped__(cfg)
+    assert not (tmp_path / "parity.csv").exists()
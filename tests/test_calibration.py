@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from src.data.summaries import DistanceSummary
+from src.process.calibration import (
+    auc,
+    equal_error_rate,
+    far_at_frr,
+    frr_at_far,
+    roc_curve,
+    roc_from_histograms,
+)
+
+
+def brute_force_rates(genuine: np.ndarray, impostor: np.ndarray, thresholds: np.ndarray):
+    far = np.array([(impostor <= t).mean() for t in thresholds])
+    frr = np.array([(genuine > t).mean() for t in thresholds])
+    return far, frr
+
+
+def distances(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    # rounded, so there are ties between and within the two distributions
+    genuine = np.round(rng.normal(0.35, 0.12, 2_000), 3)
+    impostor = np.round(rng.normal(0.75, 0.15, 5_000), 3)
+    return genuine, impostor
+
+
+def test_roc_curve_matches_brute_force():
+    genuine, impostor = distances()
+    roc = roc_curve(genuine, impostor)
+    assert roc["threshold"].is_unique and roc["threshold"].is_monotonic_increasing
+    assert set(roc["threshold"]) == set(np.r_[genuine, impostor])
+    far, frr = brute_force_rates(genuine, impostor, roc["threshold"].values)
+    np.testing.assert_allclose(roc["far"], far)
+    np.testing.assert_allclose(roc["frr"], frr)
+
+
+def test_histogram_roc_counts_distances_outside_the_bins():
+    genuine, impostor = distances(1)
+    # many genuine pairs below the bins and impostors above them; the edges
+    # fall between the rounded distances, so no distance sits on an edge
+    bin_range, n_bins = (0.4005, 0.7005), 30
+    summaries = []
+    for values in (genuine, impostor):
+        summary = DistanceSummary(bin_range, n_bins)
+        summary.update(values)
+        summaries.append(summary)
+    genuine_summary, impostor_summary = summaries
+    assert genuine_summary.underflow > 0 and impostor_summary.overflow > 0
+    roc = roc_from_histograms(
+        genuine_summary.counts,
+        impostor_summary.counts,
+        genuine_summary.edges,
+        (genuine_summary.underflow, genuine_summary.overflow),
+        (impostor_summary.underflow, impostor_summary.overflow),
+    )
+    far, frr = brute_force_rates(genuine, impostor, roc["threshold"].values)
+    np.testing.assert_allclose(roc["far"], far)
+    np.testing.assert_allclose(roc["frr"], frr)
+
+
+def test_operating_points():
+    genuine, impostor = distances(2)
+    roc = roc_curve(genuine, impostor)
+    eer, threshold = equal_error_rate(roc)
+    far, frr = brute_force_rates(genuine, impostor, np.array([threshold]))
+    # interpolated between two thresholds, so close to both rates there
+    assert far[0] == pytest.approx(eer, abs=0.01) and frr[0] == pytest.approx(eer, abs=0.01)
+
+    rate, threshold = frr_at_far(roc, 0.01)
+    far, frr = brute_force_rates(genuine, impostor, np.array([threshold]))
+    assert far[0] <= 0.01 and frr[0] == pytest.approx(rate)
+    rate, threshold = far_at_frr(roc, 0.05)
+    far, frr = brute_force_rates(genuine, impostor, np.array([threshold]))
+    assert frr[0] <= 0.05 and far[0] == pytest.approx(rate)
+
+    # probability that an impostor pair is further apart than a genuine one
+    pairs = impostor[None, :] - genuine[:, None]
+    assert auc(roc) == pytest.approx((pairs > 0).mean() + (pairs == 0).mean() / 2, abs=1e-3)
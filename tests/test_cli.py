@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import main
+
+HEAVY = ["azure.identity", "deepface", "tensorflow", "mediapipe", "cv2", "pandas", "hydra"]
+
+
+def test_entry_point_imports_nothing_heavy():
+    # spawned pool workers import the entry point again, before every task
+    code = f"import sys, main; print([m for m in {HEAVY!r} if m in sys.modules])"
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONPATH"}
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(main.__file__).parent,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert out.stdout.strip() == "[]"
+
+
+def test_every_command_resolves_to_a_hydra_script():
+    for command, (script, _) in main.COMMANDS.items():
+        path = main.ROOT / script
+        assert path.exists(), command
+        assert "@hydra.main" in path.read_text()
+    assert main.module_name(main.ROOT / "src/data/selfies.py") == "src.data.selfies"
+    assert main.module_name(main.ROOT / "src/process/deepface_inter.py") == "src.process.deepface_inter"
+    args = main.parse_args(["score-inter", "workers.max_workers=8", "timing.enabled=True"])
+    assert args.command == "score-inter"
+    assert args.overrides == ["workers.max_workers=8", "timing.enabled=True"]
+    args = main.parse_args(["score-intra", "--multirun", "model=Facenet,ArcFace"])
+    assert args.overrides == ["--multirun", "model=Facenet,ArcFace"]
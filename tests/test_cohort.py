@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from src.data.cohort import add_strata, stratified_sample
+
+
+def users(rng: np.random.Generator, n: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "user_id": np.arange(n) + 10_000,
+            "gender_desc": rng.choice(["female", "male"], size=n, p=[0.7, 0.3]),
+            "country_name": rng.choice(["Germany", "Austria", "France"], size=n),
+            "age_group_5y": rng.choice(["20-24", "25-29", None], size=n),
+            "weight_kg": rng.normal(70, 15, size=n),
+            "height_cm": rng.normal(170, 10, size=n),
+        }
+    )
+
+
+def test_strata_match_row_wise_labels():
+    df_users = users(np.random.default_rng(0), 2_000)
+    df_users.loc[0, ["weight_kg", "height_cm"]] = [18.5 * 1.7**2, 170]
+    df_users.loc[1, ["weight_kg", "height_cm"]] = [30 * 1.6**2, 160]
+    df_users.loc[2, "weight_kg"] = np.nan
+    df_strata = add_strata(df_users)
+
+    assert df_strata.loc[0, "bmi_cat"] == "balanced"
+    assert df_strata.loc[1, "bmi_cat"] == "obese"
+    assert pd.isna(df_strata.loc[2, "bmi_cat"])
+    assert "Austria" not in set(df_strata["country_name"])
+    expected = (
+        df_strata[["gender_desc", "age_group_5y", "country_name", "bmi_cat"]]
+        .astype(object)
+        .fillna("nan")
+        .astype(str)
+        .agg(", ".join, axis=1)
+    )
+    assert (df_strata["selectors"].astype(str) == expected).all()
+    # one stratum code per label
+    assert (df_strata.groupby("selectors", observed=True)["stratum"].nunique() == 1).all()
+
+
+def test_stratified_sample_is_seeded_and_capped():
+    df_strata = add_strata(users(np.random.default_rng(1), 5_000))
+    sample = stratified_sample(df_strata, 10, seed=3)
+    shuffled = stratified_sample(df_strata.sample(frac=1, random_state=7), 10, seed=3)
+
+    sizes = df_strata.groupby("stratum").size()
+    drawn = sample.groupby("stratum").size()
+    assert (drawn == sizes.clip(upper=10)).all()
+    assert sample["user_id"].is_unique
+    assert sample["user_id"].tolist() == shuffled["user_id"].tolist()
+    assert sample["user_id"].tolist() != stratified_sample(df_strata, 10, seed=4)["user_id"].tolist()
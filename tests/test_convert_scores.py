@@ -0,0 +1,50 @@
+import pandas as pd
+
+from src.data.results import convert_scores, scan_scores
+
+
+def scores(n_per_model: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "user1_id": range(2 * n_per_model),
+            "user2_id": range(1, 2 * n_per_model + 1),
+            "model": ["A"] * n_per_model + ["B"] * n_per_model,
+            "similarity_metric": "cosine",
+            "distance": 0.5,
+        }
+    )
+
+
+def test_reconverting_a_smaller_csv_drops_every_old_row(tmp_path):
+    csv = tmp_path / "scores.csv"
+    scores(30).to_csv(csv, index=False)
+    # small chunks, so model B only shows up after the first chunk
+    assert convert_scores(csv, tmp_path / "dataset", chunksize=7) == 60
+
+    scores(20).to_csv(csv, index=False)
+    assert convert_scores(csv, tmp_path / "dataset", chunksize=7) == 40
+    df = scan_scores(tmp_path / "dataset").to_table().to_pandas()
+    assert df.groupby("model", observed=True).size().to_dict() == {"A": 20, "B": 20}
+
+
+def test_convert_with_keys_keeps_rows_between_current_selfies(tmp_path):
+    csv_path = tmp_path / "scores.csv"
+    df_scores = scores(10)
+    df_scores["img1_path"] = [f"/selfies/{u}/a.jpg" for u in df_scores["user1_id"]]
+    df_scores["img2_path"] = [f"/selfies/{u}/a.jpg" for u in df_scores["user2_id"]]
+    df_scores.to_csv(csv_path, index=False)
+    keys = {f"{u}/a.jpg" for u in range(12)}
+    # rows with user 12 or more on either side are stale
+    assert convert_scores(csv_path, tmp_path / "dataset", keys=keys) == 11
+
+
+def test_columns_empty_in_some_chunks_keep_one_type(tmp_path):
+    csv = tmp_path / "scores.csv"
+    df_scores = scores(4)
+    # empty in the first and last chunk of 2 rows, text in between
+    df_scores["facial_areas"] = [None, None, "{}", "[{'x': 1}]", None, "{}", None, None]
+    df_scores.to_csv(csv, index=False)
+    assert convert_scores(csv, tmp_path / "dataset", chunksize=2) == 8
+    df = scan_scores(tmp_path / "dataset").to_table().to_pandas()
+    assert sorted(df["facial_areas"].dropna()) == ["[{'x': 1}]", "{}", "{}"]
+    assert df["distance"].dtype == "float32"
@@ -7,6 +7,8 @@ from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
 from PIL import Image
 
+from src.data.registry import CORRUPT, OK, SelfieRegistry, path_key
+
 
 def test_selfie_integrity(path: Path | str):
     path = Path(path)
@@ -17,27 +19,32 @@ def test_selfie_integrity(path: Path | str):
         raise
 
 
-def test_selfies(paths: Sequence[Path | str]):
+def test_selfies(paths: Sequence[Path | str], registry: SelfieRegistry | None = None):
     l = len(paths)
+    statuses = []
     with tqdm(total=l, ncols=100) as pbar:
         with ThreadPoolExecutor(max_workers=1000) as executor:
-            futures = [executor.submit(test_selfie_integrity, path) for path in paths]
+            futures = {executor.submit(test_selfie_integrity, path): path for path in paths}
             # sourcery skip: no-loop-in-tests
             for future in concurrent.futures.as_completed(futures):
                 try:
                     future.result()
+                    statuses.append((path_key(futures[future]), OK, ""))
                     pbar.update(1)
                 except Exception as e:
                     print(f"{future} raised an exception {e}")
+                    statuses.append((path_key(futures[future]), CORRUPT, str(e)))
                     pbar.update(1)
                     continue
+    if registry is not None:
+        registry.record_many("integrity", statuses)
 
 
 @hydra.main(config_path="../config", config_name="config", version_base=None)
 def main(cfg: DictConfig):
     save_dir = Path(hydra.utils.to_absolute_path(cfg.selfie_data.save_dir))
     paths = list(save_dir.glob("*/*.jpg"))
-    test_selfies(paths)
+    test_selfies(paths, SelfieRegistry(cfg.registry.path))
 
 
 if __name__ == "__main__":
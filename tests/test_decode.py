@@ -0,0 +1,90 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.data.decode import (
+    DCT_SCALES,
+    MODEL_INPUT_SIZES,
+    deepface_found_face,
+    pick_scale,
+    read_selfie,
+    resolve_scale,
+)
+
+
+def encoded_selfie(width: int = 803, height: int = 601, image_format: str = "JPEG") -> bytes:
+    # smooth, so a reduced decode should stay close to a reduced full decode
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.stack(
+        [x * 255 // width, y * 255 // height, 128 + 100 * np.sin(x / 40) * np.cos(y / 30)], axis=-1
+    ).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, image_format, quality=95)
+    return buffer.getvalue()
+
+
+def test_pick_scale_keeps_the_face_crop_above_the_model_input():
+    for model, target_side in MODEL_INPUT_SIZES.items():
+        for image_size in [(3024, 4032), (1080, 1920), (480, 640), (100, 100)]:
+            scale = pick_scale(image_size, target_side, face_fraction=0.5)
+            face_side = min(image_size) * 0.5
+            assert scale in DCT_SCALES
+            if scale > 1:
+                assert face_side / scale >= target_side, model
+            # the next scale would shrink the face below the input size
+            if scale < DCT_SCALES[-1]:
+                assert face_side / (2 * scale) < target_side, model
+    assert pick_scale((3024, 4032), MODEL_INPUT_SIZES["DeepID"]) == 8
+    assert pick_scale((3024, 4032), MODEL_INPUT_SIZES["VGG-Face"]) == 4
+    assert pick_scale((100, 100), MODEL_INPUT_SIZES["VGG-Face"]) == 1
+
+
+def test_resolve_scale_auto_reads_the_image_size(tmp_path):
+    data = encoded_selfie(1600, 2000)
+    path = tmp_path / "selfie.jpg"
+    path.write_bytes(data)
+    for model in ["ArcFace", "VGG-Face", "mediapipe"]:
+        expected = pick_scale((1600, 2000), MODEL_INPUT_SIZES[model])
+        assert resolve_scale(path, "auto", model) == expected
+        assert resolve_scale("not/read.jpg", "auto", model, data=data) == expected
+    assert resolve_scale(path, "4", "ArcFace") == 4
+    with pytest.raises(ValueError):
+        resolve_scale(path, 3, "ArcFace")
+
+
+def test_draft_decode_matches_a_reduced_full_decode(monkeypatch):
+    jpeg, png = encoded_selfie(), encoded_selfie(image_format="PNG")
+    full = read_selfie("selfie.jpg", data=jpeg)
+    assert full.shape == (601, 803, 3)
+
+    # JPEGs are scaled by the decoder, never reduced after a full decode
+    def no_reduce(self, factor):
+        raise AssertionError("reduce called on a JPEG")
+
+    for scale in DCT_SCALES[1:]:
+        expected = np.asarray(Image.fromarray(full).reduce(scale)).astype(float)
+        with monkeypatch.context() as patch:
+            patch.setattr(Image.Image, "reduce", no_reduce)
+            drafted = read_selfie("selfie.jpg", scale, data=jpeg)
+            reduced_cv2 = read_selfie("selfie.jpg", scale, data=jpeg, backend="cv2")
+        assert drafted.shape == expected.shape == (-(-601 // scale), -(-803 // scale), 3)
+        assert reduced_cv2.shape == drafted.shape
+        assert np.abs(drafted - expected).mean() < 2
+        # non JPEG files fall back to reducing the full decode
+        png_expected = np.asarray(Image.open(io.BytesIO(png)).convert("RGB").reduce(scale))
+        assert np.array_equal(read_selfie("selfie.png", scale, data=png), png_expected)
+        bgr = read_selfie("selfie.jpg", scale, bgr=True, data=jpeg)
+        assert np.array_equal(bgr, drafted[:, :, ::-1])
+
+
+def test_deepface_found_face_spots_the_whole_image_fallback(tmp_path):
+    img = np.zeros((60, 40, 3), dtype=np.uint8)
+    path = tmp_path / "selfie.jpg"
+    Image.fromarray(img).save(path)
+    whole = {"x": 0, "y": 0, "w": 40, "h": 60}
+    face = {"x": 5, "y": 10, "w": 20, "h": 25}
+    for arg in (img, path.as_posix()):
+        assert not deepface_found_face(arg, whole)
+        assert deepface_found_face(arg, face)
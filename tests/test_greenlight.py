@@ -0,0 +1,99 @@
+import errno
+
+import cv2
+import numpy as np
+import pytest
+
+from src.data.registry import CORRUPT, LANDMARK_FAILURE, MISSING_BLOB, NO_FACE, OK, SelfieRegistry
+from src.process import greenlight_selfies
+from src.process.greenlight_selfies import get_landmarks, skipped_selfies
+
+
+class FakeLandmarker:
+    def __init__(self, error=None):
+        self.error = error
+
+    def detect(self, image):
+        if self.error is not None:
+            raise self.error
+        return type("Result", (), {"face_landmarks": []})()
+
+
+def use_landmarker(monkeypatch, landmarker):
+    monkeypatch.setattr(
+        greenlight_selfies.vision.FaceLandmarker,
+        "create_from_options",
+        lambda options: landmarker,
+    )
+
+
+def jpeg_bytes():
+    ok, encoded = cv2.imencode(".jpg", np.full((64, 48, 3), 128, dtype=np.uint8))
+    return encoded.tobytes()
+
+
+def truncated_jpeg_bytes():
+    noise = np.random.default_rng(0).integers(0, 255, size=(256, 192, 3), dtype=np.uint8)
+    ok, encoded = cv2.imencode(".jpg", noise)
+    return encoded.tobytes()[:3000]
+
+
+def test_missing_model_is_a_task_error(tmp_path):
+    with pytest.raises(Exception):
+        get_landmarks("1/2024-01-01_a.jpg", tmp_path / "missing.task", data=jpeg_bytes())
+
+
+def test_undecodable_image_is_a_landmark_failure(monkeypatch):
+    use_landmarker(monkeypatch, FakeLandmarker())
+    result = get_landmarks("1/2024-01-01_a.jpg", "model.task", data=b"not a jpeg")
+    assert result == ("1/2024-01-01_a.jpg", None, 0, LANDMARK_FAILURE)
+
+
+@pytest.mark.parametrize("decode_scale", [1, 2])
+def test_truncated_image_is_a_landmark_failure(monkeypatch, decode_scale):
+    use_landmarker(monkeypatch, FakeLandmarker())
+    result = get_landmarks(
+        "1/2024-01-01_a.jpg", "model.task", decode_scale, data=truncated_jpeg_bytes()
+    )
+    assert result[3] == LANDMARK_FAILURE
+
+
+def test_decoder_oserror_is_a_landmark_failure(monkeypatch):
+    use_landmarker(monkeypatch, FakeLandmarker(OSError("broken data stream")))
+    result = get_landmarks("1/2024-01-01_a.jpg", "model.task", data=jpeg_bytes())
+    assert result[3] == LANDMARK_FAILURE
+
+
+def test_detect_failure_is_a_landmark_failure(monkeypatch):
+    use_landmarker(monkeypatch, FakeLandmarker(RuntimeError("bad image")))
+    result = get_landmarks("1/2024-01-01_a.jpg", "model.task", data=jpeg_bytes())
+    assert result[3] == LANDMARK_FAILURE
+
+
+def test_no_face(monkeypatch):
+    use_landmarker(monkeypatch, FakeLandmarker())
+    result = get_landmarks("1/2024-01-01_a.jpg", "model.task", data=jpeg_bytes())
+    assert result[3] == NO_FACE
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        MemoryError(),
+        OSError(errno.EIO, "disk"),
+        FileNotFoundError("gone"),
+        PermissionError(errno.EACCES, "denied"),
+    ],
+)
+def test_infrastructure_errors_are_raised(monkeypatch, error):
+    use_landmarker(monkeypatch, FakeLandmarker(error))
+    with pytest.raises(type(error)):
+        get_landmarks("1/2024-01-01_a.jpg", "model.task", data=jpeg_bytes())
+
+
+def test_skipped_selfies_keep_their_registry_status():
+    paths = ["1/a.jpg", "1/b.jpg", "2/c.jpg"]
+    df_skipped = skipped_selfies(paths, {"1/b.jpg": CORRUPT, "2/c.jpg": NO_FACE})
+    assert df_skipped.selfie_path.tolist() == ["1/b.jpg", "2/c.jpg"]
+    assert df_skipped.valid.tolist() == [False, True]
+    assert df_skipped.error.str.contains("no_face").tolist() == [False, True]
@@ -0,0 +1,147 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+import src.process.deepface_inter as deepface_inter
+from src.data.registry import NO_FACE, SelfieRegistry, path_key
+from src.data.shards import pack_selfies
+from src.data.summaries import SummarySet
+from src.process.incremental import (
+    both_directions,
+    build_topk,
+    find_delta,
+    load_manifest,
+    save_manifest,
+    score_delta,
+    selfie_fingerprints,
+    top_k,
+    update_topk,
+)
+
+
+def fake_distance(pic1: Path, pic2: Path) -> float:
+    # symmetric and distinct per pair of selfies, so the top k has no ties
+    code1, code2 = zlib.crc32(pic1.as_posix().encode()), zlib.crc32(pic2.as_posix().encode())
+    return abs(code1 - code2) / 2**32
+
+
+def fake_comps(pic1: Path, pic2: Path, metric: str, model: str, *args) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "user1_id": [int(pic1.parent.name)],
+            "user2_id": [int(pic2.parent.name)],
+            "img1_path": [pic1.as_posix()],
+            "img2_path": [pic2.as_posix()],
+            "model": [model],
+            "similarity_metric": [metric],
+            "distance": [fake_distance(pic1, pic2)],
+        }
+    )
+
+
+def fake_verify(pic1: Path, pic2: Path, metric: str, model: str, *args) -> tuple:
+    # user 200's selfie has no face
+    no_face = [(path_key(pic), NO_FACE, "") for pic in (pic1, pic2) if pic.parent.name == "200"]
+    return fake_comps(pic1, pic2, metric, model), no_face
+
+
+def selfie(root: Path, user: int, day: int) -> Path:
+    path = root / str(user) / f"2023-01-{day:02d}_x.jpg"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"jpg")
+    return path
+
+
+def all_pairs(paths: list) -> pd.DataFrame:
+    return pd.concat(
+        [fake_comps(a, b, "cosine", "Facenet") for i, a in enumerate(paths) for b in paths[i + 1 :]],
+        ignore_index=True,
+    )
+
+
+def test_delta_scores_only_new_pairs_and_matches_full_top_k(tmp_path, monkeypatch):
+    monkeypatch.setattr(deepface_inter, "inter_user_comps", fake_verify)
+    old = [selfie(tmp_path, user, 1) for user in range(100, 112)]
+    df_manifest = selfie_fingerprints(old)
+    df_topk = top_k(both_directions(all_pairs(old)), 3)
+
+    # two new users, one user with a newer selfie and one user gone
+    latest = [p for p in old if p.parent.name not in ("103", "107")]
+    latest += [selfie(tmp_path, 103, 2), selfie(tmp_path, 200, 1), selfie(tmp_path, 201, 1)]
+    df_current = selfie_fingerprints(latest)
+    delta, gone, stale = find_delta(df_current, df_manifest)
+    assert delta.tolist() == [103, 200, 201]
+    assert gone.tolist() == [107]
+    assert stale == {"103/2023-01-01_x.jpg", "107/2023-01-01_x.jpg"}
+
+    cfg = OmegaConf.create(
+        {"metric": "cosine", "model": "Facenet", "decode": {"scale": 1, "face_fraction": 0.5}, "shards": {"read": False, "dir": None}}
+    )
+    output = tmp_path / "delta.csv"
+    registry = SelfieRegistry(tmp_path / "registry.sqlite")
+    with ThreadPoolExecutor(4) as executor:
+        score_delta(executor, df_current, delta, cfg, output, SummarySet(), registry)
+    assert registry.bad_keys() == {"200/2023-01-01_x.jpg"}
+    df_delta = pd.read_csv(output)
+    # 3 delta users against 10 unchanged ones, plus the 3 pairs among themselves
+    assert len(df_delta) == 3 * 10 + 3
+    assert df_delta[["user1_id", "user2_id"]].isin(delta).any(axis=1).all()
+
+    df_updated = update_topk(df_topk, df_delta, stale, gone, 3)
+    df_full = top_k(both_directions(all_pairs(sorted(latest))), 3)
+    # users whose old top 3 lost nobody match a rebuild exactly
+    lost = set(
+        df_topk.loc[df_topk["partner_id"].isin([103, 107]), "user_id"]
+    ) | {103, 107}
+    keep = ~df_full["user_id"].isin(lost)
+    columns = ["user_id", "partner_id", "rank"]
+    pd.testing.assert_frame_equal(
+        df_updated.loc[~df_updated["user_id"].isin(lost), columns].reset_index(drop=True),
+        df_full.loc[keep, columns].reset_index(drop=True),
+        check_dtype=False,
+    )
+    assert 107 not in set(df_updated["user_id"]) | set(df_updated["partner_id"])
+    assert np.all(df_updated.groupby("user_id").size() <= 3)
+
+    # a rebuild over the old scores and the delta, kept to the current selfies,
+    # matches a full run for every user, including those that lost partners
+    all_pairs(old).to_csv(tmp_path / "full.csv", index=False)
+    df_rebuilt = build_topk([tmp_path / "full.csv", output], 3, set(df_current["img_key"]))
+    pd.testing.assert_frame_equal(
+        df_rebuilt[columns].reset_index(drop=True),
+        df_full[columns].reset_index(drop=True),
+        check_dtype=False,
+    )
+
+
+def test_build_topk_folds_chunks_and_parts(tmp_path):
+    paths = [selfie(tmp_path / "selfies", user, 1) for user in range(300, 320)]
+    df_scores = all_pairs(paths)
+    parts = tmp_path / "parts"
+    parts.mkdir()
+    df_scores.iloc[:100].to_csv(parts / "part_0.csv", index=False)
+    df_scores.iloc[100:].to_csv(parts / "part_1.csv", index=False)
+    columns = ["user_id", "partner_id", "rank"]
+    expected = top_k(both_directions(df_scores), 4)[columns]
+    pd.testing.assert_frame_equal(build_topk(parts, 4, chunksize=37)[columns], expected, check_dtype=False)
+
+
+def test_selfie_downloaded_again_is_changed_when_read_from_shards(tmp_path):
+    save_dir, shard_dir = tmp_path / "selfies", tmp_path / "shards"
+    paths = [selfie(save_dir, user, 1) for user in range(100, 104)]
+    pack_selfies(paths, shard_dir)
+    save_manifest(selfie_fingerprints(paths, shard_dir), tmp_path / "manifest.csv")
+    df_manifest = load_manifest(tmp_path / "manifest.csv")
+    assert find_delta(selfie_fingerprints(paths, shard_dir), df_manifest)[0].tolist() == []
+
+    # the same key downloaded again with other contents, then packed again
+    paths[2].write_bytes(b"a new jpg")
+    assert pack_selfies(paths, shard_dir) == 1
+    df_current = selfie_fingerprints(paths, shard_dir)
+    delta, gone, stale = find_delta(df_current, df_manifest)
+    assert delta.tolist() == [102]
+    assert stale == {"102/2023-01-01_x.jpg"}
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from src.process.landmark_geometry import (
+    inter_user_scores,
+    normalise_shapes,
+    procrustes_distances,
+)
+
+
+def random_rotation(rng: np.random.Generator) -> np.ndarray:
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    return q * np.sign(np.linalg.det(q))
+
+
+def reference_distance(a: np.ndarray, b: np.ndarray) -> float:
+    m = a.T @ b
+    s = np.linalg.svd(m, compute_uv=False)
+    nuclear = s[0] + s[1] + np.sign(np.linalg.det(m)) * s[2]
+    return np.sqrt(max(0.0, 1 - nuclear**2))
+
+
+def test_procrustes_matches_svd():
+    rng = np.random.default_rng(0)
+    shapes = normalise_shapes(rng.normal(size=(20, 478, 3)))
+    distances = procrustes_distances(shapes, shapes)
+    expected = np.array([[reference_distance(a, b) for b in shapes] for a in shapes])
+    np.testing.assert_allclose(distances, expected, atol=1e-6)
+
+
+def test_procrustes_invariant_to_similarity_transform():
+    rng = np.random.default_rng(1)
+    shapes = rng.normal(size=(5, 478, 3))
+    transformed = 3.0 * shapes @ random_rotation(rng).T + rng.normal(size=3)
+    distances = procrustes_distances(normalise_shapes(shapes), normalise_shapes(transformed))
+    np.testing.assert_allclose(distances.diagonal(), 0, atol=1e-6)
+
+
+def test_inter_user_scores_covers_upper_triangle():
+    rng = np.random.default_rng(2)
+    df_latest = pd.DataFrame(
+        {"user_id": np.arange(7), "selfie_path": [f"{u}/a.jpg" for u in range(7)]}
+    )
+    shapes = normalise_shapes(rng.normal(size=(7, 478, 3)))
+    df_scores = pd.concat(inter_user_scores(df_latest, shapes, threshold=0.05, block_size=3))
+    assert len(df_scores) == 7 * 6 // 2
+    assert (df_scores["user1_id"] < df_scores["user2_id"]).all()
@@ -0,0 +1,80 @@
+from itertools import combinations
+
+import numpy as np
+
+from src.process.embeddings import pairwise_distances
+from src.process.null_distribution import (
+    GroupSlots,
+    null_batch,
+    null_summary,
+    permutation_statistics,
+)
+
+
+def test_slots_cover_every_pair_within_a_user_once():
+    labels = np.array([7, 3, 7, 5, 3, 7, 9])
+    slots = GroupSlots(labels)
+    # pairs computed in ranges that cut across groups
+    chunks = [slots.pairs(start, min(start + 2, slots.n_pairs)) for start in range(0, slots.n_pairs, 2)]
+    slots_a = np.concatenate([a for a, _ in chunks])
+    slots_b = np.concatenate([b for _, b in chunks])
+    pairs = {tuple(sorted(pair)) for pair in zip(slots.order[slots_a], slots.order[slots_b])}
+    expected = {
+        (i, j) for i, j in combinations(range(len(labels)), 2) if labels[i] == labels[j]
+    }
+    assert pairs == expected
+    assert slots.n_pairs == len(slots_a) == len(expected)
+
+
+def test_pairs_follow_triu_order_in_large_groups():
+    sizes = [2, 3, 250, 1, 997]
+    slots = GroupSlots(np.repeat(np.arange(len(sizes)), sizes))
+    slots_a, slots_b = slots.pairs(0, slots.n_pairs)
+    expected_a, expected_b = [], []
+    start = 0
+    for size in sizes:
+        a, b = np.triu_indices(size, 1)
+        expected_a.append(start + a)
+        expected_b.append(start + b)
+        start += size
+    assert np.array_equal(slots_a, np.concatenate(expected_a))
+    assert np.array_equal(slots_b, np.concatenate(expected_b))
+
+
+def test_permutations_keep_group_sizes_and_match_pair_loop():
+    rng = np.random.default_rng(0)
+    labels = np.repeat(np.arange(40), rng.integers(1, 5, size=40))
+    matrix = rng.normal(size=(len(labels), 8)).astype(np.float32)
+    # users' selfies share a direction, so the observed pairs are closer than chance
+    matrix += 2 * rng.normal(size=(40, 8)).astype(np.float32)[labels]
+    slots = GroupSlots(labels)
+    order = slots.order
+
+    seed = np.random.SeedSequence(1)
+    null = null_batch(seed, 200, "cosine", 0.5, chunk_size=100, matrix=matrix, slots=slots)
+    again = null_batch(seed, 200, "cosine", 0.5, matrix=matrix, slots=slots)
+    assert np.allclose(null["mean"], again["mean"])
+
+    # one shuffled assignment against a plain loop over its pairs
+    assignment = np.random.default_rng(2).permutation(order)
+    shuffled = np.empty_like(labels)
+    shuffled[assignment] = labels[order]
+    distances = pairwise_distances(matrix, matrix, "cosine")
+    loop = [
+        distances[i, j]
+        for i, j in combinations(range(len(labels)), 2)
+        if shuffled[i] == shuffled[j]
+    ]
+    statistics = permutation_statistics(
+        matrix, assignment[None, :], slots, "cosine", 0.5, chunk_size=7
+    )
+    assert np.isclose(statistics["mean"][0], np.mean(loop), atol=1e-5)
+    assert statistics["share_below"][0] == np.mean(np.array(loop) <= 0.5)
+    # the streamed median is the lower middle distance within the sketch's relative accuracy
+    assert np.isclose(statistics["median"][0], np.quantile(loop, 0.5, method="lower"), rtol=0.001)
+
+    observed = permutation_statistics(matrix, order[None, :], slots, "cosine", 0.5)
+    df_summary = null_summary(observed, null).set_index("statistic")
+    assert df_summary.loc["mean", "observed"] < df_summary.loc["mean", "q1"]
+    assert df_summary.loc["mean", "p_value"] == 1 / 201
+    assert df_summary.loc["share_below", "p_value"] == 1 / 201
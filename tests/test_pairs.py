@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pandas as pd
+
+from src.process.pairs import by_first, drop_scored, inter_pairs, intra_pairs, plan, random_pairs
+
+
+def selfies(user: int, n: int) -> list:
+    # globbing returns files in no particular order
+    return [Path(f"/selfies/{user}/2023-01-{day:02d}_x.jpg") for day in reversed(range(1, n + 1))]
+
+
+def test_plan_dedupes_unordered_pairs_deterministically():
+    paths = selfies(1, 4)
+    first = intra_pairs(paths, "first")
+    assert [pic.name for pic in first[0]] == ["2023-01-01_x.jpg", "2023-01-02_x.jpg"]
+    every = intra_pairs(paths, "all")
+    assert len(every) == 6
+    reversed_pairs = [(b, a) for a, b in every]
+    assert plan(first, every, reversed_pairs) == plan(every) == every
+
+
+def test_inter_pairs_group_by_first_and_skip_scored():
+    latest = [selfies(user, 1)[0] for user in (3, 1, 2)]
+    groups = [(a.parent.name, [b.parent.name for b in bs]) for a, bs in by_first(inter_pairs(latest))]
+    assert groups == [("1", ["2", "3"]), ("2", ["3"])]
+
+    df_scores = pd.DataFrame(
+        {"img1_path": [latest[0].as_posix()], "img2_path": [latest[1].as_posix()]}
+    )
+    remaining = drop_scored(plan(inter_pairs(latest)), df_scores)
+    assert [(a.parent.name, b.parent.name) for a, b in remaining] == [("1", "2"), ("2", "3")]
+
+
+def test_random_pairs_are_seeded_and_kind_specific():
+    paths_by_user = {user: selfies(user, 5) for user in range(10)}
+    intra = random_pairs(paths_by_user, 50, same_user=True, seed=1)
+    inter = random_pairs(paths_by_user, 50, same_user=False, seed=1)
+    assert intra == random_pairs(paths_by_user, 50, same_user=True, seed=1)
+    assert all(a.parent == b.parent for a, b in intra)
+    assert all(a.parent != b.parent for a, b in inter)
@@ -0,0 +1,91 @@
+import os
+from concurrent.futures import as_completed
+
+import pytest
+
+from src.data.pool import RecyclingProcessPool, WorkerDied
+
+hog = None
+
+
+def grow(i: int) -> int:
+    global hog
+    # odd tasks leave 256 MiB behind, like a model cache that keeps growing
+    hog = bytearray(256 * 2**20) if i % 2 else None
+    if hog is not None:
+        hog[:: 4096] = b"x" * len(hog[:: 4096])
+    if i == 5:
+        os._exit(3)
+    return i
+
+
+def test_workers_recycle_on_rss_and_replace_dead_ones():
+    pool = RecyclingProcessPool(2, max_rss=200 * 2**20, sample_seconds=0.1)
+    with pool:
+        futures = {pool.submit(grow, i): i for i in range(8)}
+        results, errors = [], []
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except WorkerDied:
+                errors.append(futures[future])
+
+    assert sorted(results) == [i for i in range(8) if i != 5]
+    assert errors == [5]
+    # every odd task except the one that died crosses the threshold
+    assert pool.recycled == 3
+    assert pool.died == 1
+    df_memory = pool.memory_frame()
+    assert {"spawn", "retire", "exit"} <= set(df_memory["event"])
+    assert pool.peak_worker_rss >= 256 * 2**20
+
+
+def test_worker_startup_is_timed(tmp_path):
+    pool = RecyclingProcessPool(2, sample_seconds=0.1)
+    with pool:
+        assert sorted(pool.map(abs, range(-4, 4))) == [0, 1, 1, 2, 2, 3, 3, 4]
+    df_startup = pool.startup_frame()
+    assert len(df_startup) == 2
+    assert (df_startup["ready_s"] > 0).all()
+    # a worker that never got a task has no first task load time
+    assert df_startup["first_task_load_s"].notna().any()
+    pool.save_memory(tmp_path / "worker_memory.csv")
+    assert (tmp_path / "worker_startup.csv").exists()
+
+
+def test_submit_after_shutdown_raises():
+    pool = RecyclingProcessPool(1)
+    pool.shutdown()
+    with pytest.raises(RuntimeError):
+        pool.submit(grow, 0)
+
+
+def test_bounded_map_keeps_a_window_and_captures_errors():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from src.data.pool import bounded_map
+
+    pulled = []
+
+    def items():
+        for i in range(50):
+            pulled.append(i)
+            yield i
+
+    def task(i: int) -> int:
+        if i == 13:
+            raise ValueError(i)
+        return i * i
+
+    results, errors = {}, []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for item, result, error in bounded_map(executor, task, items(), max_in_flight=4):
+            # nothing is pulled further ahead than the window
+            assert len(pulled) - len(results) - len(errors) <= 4
+            if error is None:
+                results[item] = result
+            else:
+                errors.append(item)
+
+    assert errors == [13]
+    assert results == {i: i * i for i in range(50) if i != 13}
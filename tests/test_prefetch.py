@@ -0,0 +1,66 @@
+import random
+import time
+
+import src.data.prefetch as prefetch
+from src.data.prefetch import PrefetchReader
+
+
+def fake_read_bytes(delays: dict | None = None, size: int = 100):
+    def read_bytes(path, shard_dir=None):
+        if delays:
+            time.sleep(delays[path])
+        if path == "missing":
+            raise FileNotFoundError(path)
+        return path.encode().ljust(size, b".")
+
+    return read_bytes
+
+
+def wait_for(condition, timeout: float = 5.0) -> None:
+    t0 = time.monotonic()
+    while not condition() and time.monotonic() - t0 < timeout:
+        time.sleep(0.01)
+
+
+def test_yields_in_order_whatever_order_reads_finish(monkeypatch):
+    paths = [f"{i}/selfie.jpg" for i in range(40)]
+    rng = random.Random(0)
+    monkeypatch.setattr(prefetch, "read_bytes", fake_read_bytes({p: rng.uniform(0, 0.02) for p in paths}))
+    paths.insert(7, "missing")
+    with PrefetchReader(paths, max_bytes=2_000, threads=8) as reader:
+        items = list(reader)
+    assert [path for path, _ in items] == paths
+    # a failed read yields None, for the consumer to read the path itself
+    assert all(data == path.encode().ljust(100, b".") for path, data in items if path != "missing")
+    assert dict(items)["missing"] is None
+    assert reader.stats["reads"] == 40 and reader.stats["errors"] == 1
+
+
+def test_read_ahead_stops_at_max_bytes_until_released(monkeypatch):
+    monkeypatch.setattr(prefetch, "read_bytes", fake_read_bytes())
+    paths = [f"{i}/selfie.jpg" for i in range(50)]
+    reader = PrefetchReader(paths, max_bytes=1_000, threads=4, auto_release=False)
+    items = iter(reader)
+    consumed = [next(items) for _ in range(3)]
+    wait_for(lambda: reader.stats["reads"] >= 10)
+    time.sleep(0.1)
+    # 10 selfies of 100 bytes fill the budget, consumed or not
+    assert reader.stats["reads"] == 10
+
+    for _, data in consumed:
+        reader.release(data)
+    reader.release(None)
+    wait_for(lambda: reader.stats["reads"] >= 13)
+    time.sleep(0.1)
+    assert reader.stats["reads"] == 13
+
+    for path, data in items:
+        reader.release(data)
+    assert reader.stats["reads"] == 50
+
+
+def test_one_file_above_the_budget_is_still_read(monkeypatch):
+    monkeypatch.setattr(prefetch, "read_bytes", fake_read_bytes(size=5_000))
+    paths = [f"{i}/selfie.jpg" for i in range(5)]
+    with PrefetchReader(paths, max_bytes=1_000, threads=2) as reader:
+        assert [len(data) for _, data in reader] == [5_000] * 5
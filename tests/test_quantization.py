@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.process.embeddings import (
+    Int8Matrix,
+    blocked_distances,
+    load_embeddings,
+    pairwise_distances,
+    save_embeddings,
+)
+from src.process import quantization
+from src.process.quantization import quantization_report
+
+
+def clustered(rng: np.random.Generator, n: int, dim: int) -> np.ndarray:
+    centres = rng.normal(size=(n // 4, dim))
+    return (centres[rng.integers(0, len(centres), size=n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def test_int8_round_trip_and_blocked_kernels(tmp_path):
+    matrix = clustered(np.random.default_rng(0), 400, 64)
+    quantized = Int8Matrix.quantize(matrix)
+    assert quantized.nbytes < matrix.nbytes / 3.5
+    # half a quantization step per dimension at most
+    assert np.all(np.abs(quantized[:] - matrix) <= quantized.scale / 2 + 1e-6)
+
+    exact = pairwise_distances(matrix[:10], matrix, "cosine")
+    assert np.allclose(blocked_distances(matrix[:10], matrix, "cosine", block_size=64), exact, atol=1e-5)
+    # int8 rows are expanded per block, not for the whole matrix
+    approx = blocked_distances(quantized[:10], quantized, "cosine", block_size=64)
+    assert np.abs(approx - exact).max() < 0.02
+
+    df_index = pd.DataFrame({"user_id": np.arange(400), "img_path": "x"})
+    save_embeddings(tmp_path, "Facenet", df_index, matrix, ["float32", "float16", "int8"])
+    _, half = load_embeddings(tmp_path, "Facenet", mmap=True, precision="float16")
+    _, codes = load_embeddings(tmp_path, "Facenet", mmap=True, precision="int8")
+    assert half.dtype == np.float16
+    assert np.array_equal(codes.subset(np.arange(5)).codes, quantized.codes[:5])
+
+
+def test_report_shows_small_losses_for_compact_copies():
+    matrix = clustered(np.random.default_rng(1), 2_000, 128)
+    df_report = quantization_report(
+        matrix, "cosine", ["float16", "int8"], [1, 10], [0.2, 0.4], sample_size=200
+    ).set_index("precision")
+
+    assert df_report.loc["float16", "compression"] == 2
+    assert df_report.loc["int8", "compression"] > 3.5
+    assert df_report.loc["float16", "max_abs_error"] < 1e-3
+    assert df_report.loc["int8", "mean_abs_error"] < 0.01
+    assert (df_report["recall_at_10"] > 0.9).all()
+    assert (df_report["flip_rate_0.4"] < 0.01).all()
+    assert df_report.loc["float16", "recall_at_10"] >= df_report.loc["int8", "recall_at_10"]
+
+
+def test_no_float32_embeddings_writes_no_report(tmp_path):
+    cfg = OmegaConf.create(
+        {
+            "embeddings": {"dir": str(tmp_path)},
+            "quantization": {"models": ["ArcFace", "Facenet"], "output": str(tmp_path / "report.csv")},
+        }
+    )
+    quantization.main.__wrapped__(cfg)
+    assert not (tmp_path / "report.csv").exists()
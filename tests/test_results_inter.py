@@ -10,21 +10,18 @@ import numpy as np
 plt.style.use("seaborn-v0_8-whitegrid")
 
 # %%
-df_inter = pd.read_csv("../results/inter_user_scores.csv", header=0)
+from src.data.results import grouped_stats, partition_quantiles, query
+from src.data.summaries import load_summaries
+
 # %%
-df_inter = pd.read_parquet("../results/inter_user_scores.parquet")
+# dataset written by `python src/data/results.py`, already in compact dtypes
+df_inter = query(
+    "../results/datasets/inter_user_scores",
+    columns=["user1_id", "user2_id", "distance", "model", "similarity_metric"],
+)
 # %%
-df_inter = df_inter.astype(
-    {
-        "user1_id": "int32",
-        "user2_id": "int32",
-        "distance": "float32",
-        "threshold": "category",
-        "model": "category",
-        "detector_backend": "category",
-        "similarity_metric": "category",
-        "time": "float32",
-    }
+grouped_stats("../results/datasets/inter_user_scores").merge(
+    partition_quantiles("../results/datasets/inter_user_scores")
 )
 
 # %%
@@ -37,3 +34,18 @@ fig.show()
 
 
 # %%
+# same distribution from the summaries kept while scoring, without reading any scores
+summaries = load_summaries("../results/summaries", "inter_*.json")
+summaries.to_frame()
+
+# %%
+summary = summaries[("VGG-Face", "cosine")]
+edges = summary.edges
+percent = 100 * summary.counts / summary.count
+
+fig, ax = plt.subplots(figsize=(10, 10))
+ax.stairs(percent, edges, fill=True)
+ax.set_title("Distribution of distances between users")
+ax.vlines(x=max(summary.thresholds), ymin=0, ymax=percent.max(), color="red", label="Threshold")
+ax.set_xlim(summary.min, summary.max)
+fig.show()
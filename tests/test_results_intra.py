@@ -3,21 +3,17 @@ import pandas as pd
 import plotly.express as px
 from plotly.subplots import make_subplots
 
-# %%
-df_scores = pd.read_csv("../results/scores.csv")
+from src.data.results import grouped_stats, per_user_diffs, query
 
-df_grp = (
-    df_scores.groupby(["model", "similarity_metric"])["distance"].mean().reset_index()
-)
-df_grp["std"] = (
-    df_scores.groupby(["model", "similarity_metric"])["distance"]
-    .std()
-    .reset_index()["distance"]
-)
 # %%
-df_per_user = (
-    df_scores.groupby(["user_id", "model", "similarity_metric"]).diff().dropna().abs()
+# datasets written by `python src/data/results.py` from the score csvs
+df_scores = query(
+    "../results/datasets/scores", columns=["user_id", "model", "similarity_metric", "distance", "time"]
 )
+
+df_grp = grouped_stats("../results/datasets/scores").rename(columns={"mean": "distance"})
+# %%
+df_per_user = per_user_diffs("../results/datasets/scores")
 # %%
 df_per_user
 # %%
@@ -44,18 +40,13 @@ px.box(
 df_scores.groupby(["model", "similarity_metric"])["time"].sum() / 3600
 
 # %%
-df_scores_wbug = pd.read_csv("../results/scores_wbug.csv")
+df_scores_wbug = query(
+    "../results/datasets/scores_wbug", columns=["model", "similarity_metric", "distance"]
+)
 
 # %%
-df_grp_wbug = (
-    df_scores_wbug.groupby(["model", "similarity_metric"])["distance"]
-    .mean()
-    .reset_index()
-)
-df_grp_wbug["std"] = (
-    df_scores_wbug.groupby(["model", "similarity_metric"])["distance"]
-    .std()
-    .reset_index()["distance"]
+df_grp_wbug = grouped_stats("../results/datasets/scores_wbug").rename(
+    columns={"mean": "distance"}
 )
 
 
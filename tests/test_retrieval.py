@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.process.embeddings import pairwise_distances
+from src.process.retrieval import candidate_pairs, exhaustive_sample, recall_at_k, shortlist
+
+
+def signals(rng: np.random.Generator, n: int):
+    df_users = pd.DataFrame(
+        {"user_id": np.arange(n) + 10_000, "img_path": [f"/selfies/{u}/latest.jpg" for u in range(n)]}
+    )
+    expensive = rng.normal(size=(n, 16)).astype(np.float32)
+    # the cheap signal is a noisy view of the expensive one
+    cheap = expensive + 0.5 * rng.normal(size=(n, 16)).astype(np.float32)
+    return df_users, cheap, expensive
+
+
+def brute_force(distances: np.ndarray, k: int) -> np.ndarray:
+    distances = distances.copy()
+    np.fill_diagonal(distances, np.inf)
+    return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+
+def exhaustive_scores(df_users: pd.DataFrame, distances: np.ndarray, both: bool = False):
+    # every pair once, or with `both` from each side, as `exhaustive_sample` returns them
+    i, j = np.triu_indices(len(df_users), 1)
+    if both:
+        i, j = np.r_[i, j], np.r_[j, i]
+    user_ids = df_users["user_id"].to_numpy()
+    return pd.DataFrame(
+        {"user1_id": user_ids[i], "user2_id": user_ids[j], "distance": distances[i, j]}
+    )
+
+
+def test_shortlist_and_rerank_match_brute_force():
+    df_users, cheap, expensive = signals(np.random.default_rng(0), 60)
+    n = len(df_users)
+    cheap_distances = pairwise_distances(cheap, cheap, "cosine")
+
+    neighbours = shortlist(lambda start, stop: cheap_distances[start:stop], n, 8, block_size=7)
+    assert neighbours.shape == (n, 8)
+    assert np.array_equal(neighbours, brute_force(cheap_distances, 8))
+
+    # re-ranking the candidates with the expensive distances, against all pairs
+    expensive_distances = pairwise_distances(expensive, expensive, "cosine")
+    true_top_k = brute_force(expensive_distances, 3)
+    pairs = candidate_pairs(neighbours)
+    found = np.full((n, n), np.inf, dtype=np.float32)
+    found[pairs[:, 0], pairs[:, 1]] = expensive_distances[pairs[:, 0], pairs[:, 1]]
+    found[pairs[:, 1], pairs[:, 0]] = expensive_distances[pairs[:, 1], pairs[:, 0]]
+    reranked = brute_force(found, 3)
+    hits = np.mean([len(set(a) & set(b)) / 3 for a, b in zip(reranked, true_top_k)])
+
+    df_recall = recall_at_k(
+        exhaustive_scores(df_users, expensive_distances, both=True), df_users, neighbours, [8], [3]
+    )
+    assert np.isclose(df_recall.loc[0, "recall"], hits)
+    assert df_recall.loc[0, "n_pairs"] == len(pairs)
+
+    # a shortlist of everyone scores every pair, so recall is exact
+    everyone = shortlist(lambda start, stop: cheap_distances[start:stop], n, n)
+    assert len(candidate_pairs(everyone)) == n * (n - 1) // 2
+    df_exhaustive = exhaustive_scores(df_users, expensive_distances, both=True)
+    df_recall = recall_at_k(df_exhaustive, df_users, everyone, [n - 1], [1, 3, 10])
+    assert (df_recall["recall"] == 1).all()
+    assert (df_recall["n_users"] == n).all()
+
+
+def test_candidate_pairs_are_unique_and_ordered():
+    neighbours = np.array([[1, 2], [0, 3], [0, 1], [1, 2]])
+    pairs = candidate_pairs(neighbours)
+    assert pairs.tolist() == [[0, 1], [0, 2], [1, 2], [1, 3], [2, 3]]
+
+
+def test_exhaustive_sample_ranks_every_sample_user_against_all(tmp_path):
+    df_users, _, expensive = signals(np.random.default_rng(1), 20)
+    df_scores = exhaustive_scores(df_users, pairwise_distances(expensive, expensive, "cosine"))
+    df_scores["model"] = "ArcFace"
+    df_scores["similarity_metric"] = "cosine"
+    # rows of another model are ignored
+    df_other = df_scores.assign(model="Facenet", distance=0.0)
+    pd.concat([df_scores, df_other]).to_csv(tmp_path / "exhaustive.csv", index=False)
+    cfg = OmegaConf.create(
+        {
+            "retrieval": {
+                "model": "ArcFace",
+                "metric": "cosine",
+                "recall": {
+                    "seed": 3,
+                    "sample_size": 5,
+                    "exhaustive_scores": str(tmp_path / "exhaustive.csv"),
+                },
+            }
+        }
+    )
+    df_exhaustive = exhaustive_sample(df_users, cfg)
+    sizes = df_exhaustive.groupby("user1_id").size()
+    assert len(sizes) == 5
+    assert (sizes == len(df_users) - 1).all()
+    assert (df_exhaustive["user1_id"] != df_exhaustive["user2_id"]).all()
+    assert (df_exhaustive["distance"] > 0).all()
+    # the same seed picks the same sample
+    assert set(exhaustive_sample(df_users, cfg)["user1_id"]) == set(sizes.index)
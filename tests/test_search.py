@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+from src.process.embeddings import pairwise_distances
+from src.process.search import partition_embeddings, search
+
+
+def embeddings(rng: np.random.Generator, n: int):
+    df_index = pd.DataFrame(
+        {"user_id": np.arange(n) + 10_000, "img_path": [f"/selfies/{u}/latest.jpg" for u in range(n)]}
+    )
+    df_strata = pd.DataFrame(
+        {
+            "user_id": df_index["user_id"],
+            "gender_desc": rng.choice(["female", "male"], size=n),
+            "age_group_5y": rng.choice(["20-24", "25-29", "30-34"], size=n),
+        }
+    )
+    return df_index, rng.normal(size=(n, 16)).astype(np.float32), df_strata
+
+
+def brute_force(df_index, matrix, allowed, k):
+    distances = pairwise_distances(matrix, matrix, "cosine")
+    np.fill_diagonal(distances, np.inf)
+    distances[~allowed] = np.inf
+    nearest = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return {
+        user: set(df_index["user_id"].to_numpy()[row[np.isfinite(distances[i, row])]])
+        for i, (user, row) in enumerate(zip(df_index["user_id"], nearest))
+    }
+
+
+def test_within_and_cross_partition_match_brute_force():
+    df_index, matrix, df_strata = embeddings(np.random.default_rng(0), 300)
+    by = ["gender_desc", "age_group_5y"]
+    df_parts, parts, offsets = partition_embeddings(df_index, matrix, df_strata, by)
+    assert np.diff(offsets).sum() == len(df_index)
+    assert (np.diff(df_parts["partition"]) >= 0).all()
+
+    stratum = df_parts["partition_name"].to_numpy()
+    same = stratum[:, None] == stratum[None, :]
+    for within, allowed in [(True, same), (False, np.ones_like(same))]:
+        df_found = search(df_parts, parts, offsets, np.arange(len(df_parts)), 5, "cosine", within, block_size=64)
+        expected = brute_force(df_parts, parts, allowed, 5)
+        found = df_found.groupby("user1_id")["user2_id"].agg(set).to_dict()
+        assert found == expected
+        assert (df_found.groupby("user1_id")["distance"].diff().dropna() >= 0).all()
+        assert (df_found["user1_id"] != df_found["user2_id"]).all()
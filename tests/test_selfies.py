@@ -0,0 +1,46 @@
+import pandas as pd
+
+from src.data import selfies
+from src.data.registry import MISSING_BLOB, OK, SelfieRegistry
+from src.data.transfer import BlobTransfer
+
+
+def selfie_rows() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "user_id": [1, 1, 2],
+            "selfie_link_id": ["a", "b", "c"],
+            "full_path": [
+                f"selfies/x/y/2024-01-0{day}/z/{link}.jpg"
+                for day, link in [(1, "a"), (2, "b"), (3, "c")]
+            ],
+        }
+    )
+
+
+def test_recheck_clears_a_missing_blob_that_turned_up(tmp_path, monkeypatch):
+    registry = SelfieRegistry(tmp_path / "registry.sqlite")
+    # "b" failed to download once, "c" is still gone
+    registry.record("download", "1/2024-01-02_b.jpg", MISSING_BLOB, "404")
+    registry.record("blob_check", "2/2024-01-03_c.jpg", MISSING_BLOB)
+    checked = []
+
+    def check_blob_exists(row):
+        checked.append(row["selfie_link_id"])
+        return row["selfie_link_id"] if row["selfie_link_id"] == "c" else float("nan")
+
+    monkeypatch.setattr(selfies, "check_blob_exists", check_blob_exists)
+
+    # without a recheck the registry's missing blobs are dropped unchecked
+    df_found = selfies.filter_bad_blobs(selfie_rows(), registry, BlobTransfer())
+    assert df_found["selfie_link_id"].tolist() == ["a"]
+    assert checked == ["a"]
+    assert registry.bad_keys() == {"1/2024-01-02_b.jpg", "2/2024-01-03_c.jpg"}
+
+    df_found = selfies.filter_bad_blobs(
+        selfie_rows(), registry, BlobTransfer(), recheck_missing=True
+    )
+    assert df_found["selfie_link_id"].tolist() == ["a", "b"]
+    assert registry.bad_keys() == {"2/2024-01-03_c.jpg"}
+    df_status = registry.to_frame().set_index(["key", "stage"])["status"]
+    assert df_status[("1/2024-01-02_b.jpg", "blob_check")] == OK
@@ -0,0 +1,96 @@
+import os
+
+from src.data.shards import (
+    INDEX_NAME,
+    ShardReader,
+    ShardWriter,
+    list_selfie_paths,
+    list_user_selfie_paths,
+    pack_selfies,
+    read_bytes,
+)
+
+
+def write_selfies(save_dir, n_users: int = 4, per_user: int = 3) -> list:
+    paths = []
+    for user in range(100, 100 + n_users):
+        for day in range(1, per_user + 1):
+            path = save_dir / str(user) / f"2023-01-{day:02d}_{user}.jpg"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # distinct contents and sizes per selfie
+            path.write_bytes(os.urandom(100 + 37 * len(paths)))
+            paths.append(path)
+    return paths
+
+
+def test_pack_then_read_round_trip(tmp_path):
+    save_dir, shard_dir = tmp_path / "selfies", tmp_path / "shards"
+    paths = write_selfies(save_dir)
+    # small shards, so the selfies span several of them
+    assert pack_selfies(paths, shard_dir, shard_size=2_000) == len(paths)
+    assert len(list(shard_dir.glob("shard_*.bin"))) > 1
+
+    for path in paths:
+        assert bytes(read_bytes(path, shard_dir)) == path.read_bytes()
+    assert list_selfie_paths(save_dir, shard_dir) == list_selfie_paths(save_dir)
+    assert list_user_selfie_paths(save_dir, 101, shard_dir) == list_user_selfie_paths(save_dir, 101)
+    # a selfie missing from the shards is read from its file
+    extra = save_dir / "999" / "2023-01-01_999.jpg"
+    extra.parent.mkdir()
+    extra.write_bytes(b"not packed")
+    assert read_bytes(extra, shard_dir) == b"not packed"
+
+
+def test_packing_resumes_and_appends(tmp_path):
+    save_dir, shard_dir = tmp_path / "selfies", tmp_path / "shards"
+    paths = write_selfies(save_dir)
+    assert pack_selfies(paths[:5], shard_dir, shard_size=2_000) == 5
+    sizes = {shard.name: shard.stat().st_size for shard in shard_dir.glob("shard_*.bin")}
+    assert pack_selfies(paths, shard_dir, shard_size=2_000) == len(paths) - 5
+
+    # shards are append only: existing ones only grow
+    for name, size in sizes.items():
+        assert (shard_dir / name).stat().st_size >= size
+    reader = ShardReader(shard_dir)
+    assert len(reader) == len(paths)
+    for path in paths:
+        assert bytes(reader.get_path(path)) == path.read_bytes()
+    reader.close()
+
+
+def test_index_rows_survive_a_crash_and_a_partial_row_is_dropped(tmp_path):
+    save_dir, shard_dir = tmp_path / "selfies", tmp_path / "shards"
+    paths = write_selfies(save_dir)
+    writer = ShardWriter(shard_dir, shard_size=2_000)
+    for path in paths[:5]:
+        writer.add_file(path)
+    # the writer is never closed, as in a crashed run, yet its rows are on disk
+    reader = ShardReader(shard_dir)
+    assert len(reader) == 5
+    for path in paths[:5]:
+        assert bytes(reader.get_path(path)) == path.read_bytes()
+    reader.close()
+
+    # a crash in the middle of a row leaves a partial last line
+    with open(shard_dir / INDEX_NAME, "a") as f:
+        f.write("103/2023-01-02_10")
+    assert len(ShardReader(shard_dir)) == 5
+    assert pack_selfies(paths, shard_dir, shard_size=2_000) == len(paths) - 5
+    reader = ShardReader(shard_dir)
+    assert len(reader) == len(paths)
+    for path in paths:
+        assert bytes(reader.get_path(path)) == path.read_bytes()
+    reader.close()
+
+
+def test_cached_reader_sees_selfies_packed_later(tmp_path):
+    save_dir, shard_dir = tmp_path / "selfies", tmp_path / "shards"
+    paths = write_selfies(save_dir)
+    pack_selfies(paths[:5], shard_dir, shard_size=2_000)
+    assert len(list_selfie_paths(save_dir, shard_dir)) == 5
+
+    pack_selfies(paths, shard_dir, shard_size=2_000)
+    assert list_selfie_paths(save_dir, shard_dir) == sorted(paths)
+    # the packed bytes are read even once the file is gone from the mount
+    paths[-1].unlink()
+    assert len(read_bytes(paths[-1], shard_dir)) == 100 + 37 * (len(paths) - 1)
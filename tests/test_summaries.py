@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+from src.data.summaries import SummarySet, summary_path
+
+
+def score_table(rng: np.random.Generator, n: int) -> pd.DataFrame:
+    distances = rng.beta(2, 5, size=n)
+    return pd.DataFrame(
+        {
+            "model": rng.choice(["VGG-Face", "Facenet"], size=n),
+            "similarity_metric": "cosine",
+            "distance": distances,
+            "verified": distances <= 0.3,
+            "threshold": 0.3,
+        }
+    )
+
+
+def test_merged_shards_match_single_pass(tmp_path):
+    rng = np.random.default_rng(0)
+    df_scores = score_table(rng, 30_000)
+
+    whole = SummarySet()
+    whole.update(df_scores)
+    for i, df_shard in enumerate([df_scores.iloc[i::3] for i in range(3)]):
+        shard = SummarySet()
+        shard.update(df_shard)
+        shard.save(tmp_path / f"shard_{i}.json")
+    merged = SummarySet.load(tmp_path / "shard_0.json")
+    for i in (1, 2):
+        merged.merge(SummarySet.load(tmp_path / f"shard_{i}.json"))
+
+    for key, summary in whole.summaries.items():
+        np.testing.assert_array_equal(merged[key].counts, summary.counts)
+        assert merged[key].sketch.buckets == summary.sketch.buckets
+        assert merged[key].verified == summary.verified
+        np.testing.assert_allclose(merged[key].std, summary.std)
+
+
+def test_quantiles_within_relative_accuracy():
+    rng = np.random.default_rng(1)
+    df_scores = score_table(rng, 50_000)
+    summaries = SummarySet(relative_accuracy=0.005)
+    summaries.update(df_scores)
+
+    for (model, metric), summary in summaries.summaries.items():
+        distances = df_scores.loc[df_scores["model"] == model, "distance"].to_numpy()
+        for q in (0.01, 0.25, 0.5, 0.9, 0.99):
+            exact = np.quantile(distances, q, method="lower")
+            assert abs(summary.quantile(q) - exact) <= 0.011 * exact
+
+
+def test_summary_paths_of_one_process_never_collide(tmp_path):
+    paths = {summary_path(tmp_path, "inter") for _ in range(100)}
+    assert len(paths) == 100
+    assert all(path.name.startswith("inter_") for path in paths)
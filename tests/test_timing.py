@@ -0,0 +1,44 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src.data import timing
+
+
+def sleepy_task(seconds: float) -> None:
+    with timing.span("sleep"):
+        time.sleep(seconds)
+    timing.flush()
+
+
+def test_worker_spans_reach_the_report(tmp_path):
+    spans_dir = tmp_path / "spans"
+    timing.configure(spans_dir)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=2, initializer=timing.init_worker, initargs=(spans_dir,)
+        ) as executor:
+            for _ in timing.timed_iter(executor.map(sleepy_task, [0.01] * 8 + [0.2] * 2)):
+                with timing.span("write", 3):
+                    pass
+        timing.flush(force=True)
+        df_stages, df_workers = timing.performance_report(spans_dir)
+    finally:
+        timing.configure(None)
+
+    stages = df_stages.set_index("stage")
+    assert stages.loc["sleep", "spans"] == 10
+    assert stages.loc["write", "items"] == 30
+    assert stages.loc["wait", "spans"] == 10
+    # buckets are 10% wide, so quantiles land within ~5% of the sleeps
+    assert 9 <= stages.loc["sleep", "p50_ms"] <= 14
+    assert stages.loc["sleep", "p95_ms"] >= 190
+    assert df_workers.loc[df_workers["stage"] == "sleep", "spans"].sum() == 10
+
+
+def test_disabled_spans_record_nothing(tmp_path):
+    timing.configure(None)
+    with timing.span("sleep"):
+        pass
+    assert list(timing.timed_iter([1, 2])) == [1, 2]
+    timing.flush(force=True)
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,67 @@
+import pandas as pd
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+from src.data.fake_blob import FakeBlobContainer, write_blob
+from src.data.pool import bounded_map
+from src.data.transfer import AimdLimiter, BlobTransfer, is_throttled
+
+
+def container_with_blobs(root, n: int, **kwargs) -> FakeBlobContainer:
+    for i in range(n):
+        write_blob(root, "selfies", f"2023-01-01/{i}/{i}.jpg", b"jpg")
+    return FakeBlobContainer(root, synthetic=False, latency=0.005, **kwargs)
+
+
+def download_all(container: FakeBlobContainer, transfer: BlobTransfer, n: int) -> list:
+    def download(i: int) -> bytes:
+        return container.blob_client("selfies", f"2023-01-01/{i}/{i}.jpg").download_blob().readall()
+
+    done = []
+    with transfer.executor() as executor:
+        for i, data, error in bounded_map(executor, transfer.wrap(download), range(n)):
+            if error is None:
+                done.append(i)
+            else:
+                transfer.add_failed({"user_id": i, "full_path": f"/blob/selfies/2023-01-01/{i}/{i}.jpg"}, error)
+    return done
+
+
+def test_limit_settles_below_the_throttling_point(tmp_path):
+    container = container_with_blobs(tmp_path, 400, max_concurrent=6)
+    limiter = AimdLimiter(initial=2, max_limit=32)
+    transfer = BlobTransfer(limiter, retries=8, base_delay=0.01, max_delay=0.1, seed=0)
+    done = download_all(container, transfer, 400)
+
+    assert sorted(done) == list(range(400))
+    assert not transfer.failed
+    # the limit probed past the server's capacity, was throttled and backed off
+    assert container.throttled > 0
+    assert transfer.throttled == container.throttled
+    assert max(limit for _, limit in limiter.history) > 6
+    assert limiter.limit < 12
+    assert container.peak_concurrent <= 6
+
+
+def test_blobs_that_stay_throttled_go_to_the_retry_list(tmp_path):
+    container = container_with_blobs(tmp_path, 20, throttle_rate=1.0, throttle_status=429)
+    transfer = BlobTransfer(AimdLimiter(initial=4), retries=2, base_delay=0.001, max_delay=0.01)
+    assert download_all(container, transfer, 20) == []
+
+    assert container.throttled == 20 * 3
+    assert transfer.limiter.limit == transfer.limiter.min_limit
+    transfer.save_retry_list(tmp_path / "retry.csv")
+    df_retry = pd.read_csv(tmp_path / "retry.csv")
+    assert sorted(df_retry["user_id"]) == list(range(20))
+    assert (df_retry["attempts"] == 3).all()
+
+
+def test_missing_blobs_are_not_retried(tmp_path):
+    container = container_with_blobs(tmp_path, 0)
+    transfer = BlobTransfer(retries=3)
+    client = container.blob_client("selfies", "2023-01-01/1/1.jpg")
+    with pytest.raises(ResourceNotFoundError) as info:
+        transfer.call(client.download_blob)
+    assert not is_throttled(info.value)
+    assert info.value.attempts == 1
+    assert transfer.requests == 1 and transfer.retried == 0
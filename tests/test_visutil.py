@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+mp = pytest.importorskip("mediapipe")
+from mediapipe.framework.formats import landmark_pb2  # noqa: E402
+
+from src.visualization.contact_sheets import top_lookalike_pairs  # noqa: E402
+from src.visualization.visutil import draw_landmark_array, render_contact_sheet  # noqa: E402
+
+
+def synthetic_landmarks(rng: np.random.Generator, n: int = 478) -> np.ndarray:
+    landmarks = np.c_[
+        0.5 + 0.25 * rng.uniform(-1, 1, n),
+        0.5 + 0.3 * rng.uniform(-1, 1, n),
+        0.01 * rng.normal(size=n),
+    ].astype(np.float32)
+    # a few landmarks outside the image, which neither drawing shows
+    landmarks[:5, 0] = 1.2
+    return landmarks
+
+
+def draw_with_mediapipe(image: np.ndarray, landmarks: np.ndarray) -> np.ndarray:
+    """The per connection drawing `draw_landmark_array` replaced."""
+    proto = landmark_pb2.NormalizedLandmarkList()
+    proto.landmark.extend(
+        [
+            landmark_pb2.NormalizedLandmark(x=float(x), y=float(y), z=float(z))
+            for x, y, z in landmarks
+        ]
+    )
+    face_mesh, styles = mp.solutions.face_mesh, mp.solutions.drawing_styles
+    for connections, spec in [
+        (face_mesh.FACEMESH_TESSELATION, styles.DrawingSpec(color=(0, 241, 241))),
+        (face_mesh.FACEMESH_CONTOURS, styles.get_default_face_mesh_contours_style()),
+        (face_mesh.FACEMESH_IRISES, styles.get_default_face_mesh_iris_connections_style()),
+    ]:
+        mp.solutions.drawing_utils.draw_landmarks(image, proto, connections, None, spec)
+    return image
+
+
+def test_landmark_array_drawing_matches_mediapipe():
+    landmarks = synthetic_landmarks(np.random.default_rng(0))
+    image = np.full((240, 200, 3), 40, dtype=np.uint8)
+    ours = draw_landmark_array(image.copy(), landmarks)
+    reference = draw_with_mediapipe(image.copy(), landmarks)
+
+    # the same pixels are drawn, only the order of overlapping lines differs
+    drawn, drawn_reference = (ours != image).any(axis=-1), (reference != image).any(axis=-1)
+    assert drawn.mean() > 0.1
+    assert (drawn & drawn_reference).sum() / (drawn | drawn_reference).sum() > 0.99
+    assert (ours != reference).any(axis=-1).sum() / drawn_reference.sum() < 0.25
+
+
+def test_contact_sheet_grid(tmp_path):
+    rng = np.random.default_rng(1)
+    paths = []
+    for i, (height, width) in enumerate([(160, 120), (120, 160), (200, 120)]):
+        path = tmp_path / str(100 + i) / "selfie.jpg"
+        path.parent.mkdir()
+        Image.fromarray(rng.integers(0, 255, size=(height, width, 3), dtype=np.uint8)).save(path)
+        paths.append(path.as_posix())
+    df_scores = pd.DataFrame(
+        {
+            "user1_id": [100, 101, 100, 102, 101],
+            "user2_id": [101, 100, 102, 100, 102],
+            "img1_path": [paths[0], paths[1], paths[0], paths[2], paths[1]],
+            "img2_path": [paths[1], paths[0], paths[2], paths[0], paths[2]],
+            "distance": [0.1, 0.2, 0.3, 0.4, 0.05],
+        }
+    )
+    df_pairs = top_lookalike_pairs(df_scores, 100, 4)
+    assert (df_pairs["user1_id"] == 100).all()
+    assert df_pairs["distance"].tolist() == [0.1, 0.2, 0.3, 0.4]
+
+    landmarks = {paths[0]: synthetic_landmarks(rng)}
+    sheet = render_contact_sheet(df_pairs, landmarks, ncols=3, tile_height=64, decode_scale=2)
+    # at a height of 64 the selfies of 100 and 101 are 48 and 85 px wide, the widest tile
+    tile_width = 48 + 85
+    assert sheet.shape == (2 * 64, 3 * tile_width, 3)
+    # the fourth pair starts the second row, the padding tiles after it stay blank
+    assert sheet[64:, :tile_width].any()
+    assert not sheet[64:, tile_width:].any()
@@ -0,0 +1,94 @@
+import multiprocessing as mp
+import os
+import time
+
+import pytest
+
+from src.data.work_queue import DONE, FAILED, WorkQueue
+
+
+def drain(db_path, lease_seconds: float, crash_after: int | None = None) -> None:
+    queue = WorkQueue(db_path, lease_seconds=lease_seconds)
+    done = 0
+    while leases := queue.wait_lease(poll_seconds=lease_seconds / 4):
+        (lease,) = leases
+        if crash_after is not None and done == crash_after:
+            # dies holding a lease, without failing or completing the unit
+            os._exit(1)
+        with queue.keep_alive([lease.unit_id], interval=lease_seconds / 4):
+            time.sleep(0.01)
+        with open(os.path.join(os.path.dirname(db_path), f"{lease.unit_id}.{os.getpid()}"), "w"):
+            pass
+        assert queue.complete(lease.unit_id)
+        done += 1
+
+
+def test_many_processes_finish_every_unit_once(tmp_path):
+    db_path = (tmp_path / "queue.sqlite").as_posix()
+    queue = WorkQueue(db_path)
+    queue.ensure_plan("abc")
+    with pytest.raises(ValueError):
+        WorkQueue(db_path).ensure_plan("abd")
+    assert queue.add((f"unit_{i:03d}", {"start": i}) for i in range(60)) == 60
+    # every node seeds the queue, only the first adds anything
+    assert queue.add((f"unit_{i:03d}", {"start": i}) for i in range(60)) == 0
+
+    ctx = mp.get_context("spawn")
+    workers = [ctx.Process(target=drain, args=(db_path, 2, 2 if i == 0 else None)) for i in range(6)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+    assert workers[0].exitcode == 1
+    assert all(worker.exitcode == 0 for worker in workers[1:])
+
+    # the crashed worker's lease expired while the others were busy, or the
+    # last ones still running waited for it to expire and redid the unit
+    df_units = queue.to_frame()
+    assert (df_units["state"] == DONE).all()
+    finished = [name.split(".")[0] for name in os.listdir(tmp_path) if name.startswith("unit_")]
+    assert sorted(finished) == sorted(df_units["unit_id"])
+    assert df_units["attempts"].max() == 2
+
+
+def test_expired_lease_is_reclaimed_and_old_owner_cannot_complete(tmp_path):
+    db_path = tmp_path / "queue.sqlite"
+    slow = WorkQueue(db_path, lease_seconds=0.2, max_attempts=2, owner="slow")
+    fast = WorkQueue(db_path, lease_seconds=0.2, max_attempts=2, owner="fast")
+    slow.add([("a", {}), ("b", {})])
+
+    (lease,) = slow.lease()
+    assert [l.unit_id for l in fast.lease()] == ["b"]
+    assert fast.lease() == []
+    time.sleep(0.3)
+    assert fast.heartbeat(["b"]) == {"b"}
+    assert slow.heartbeat(["a"]) == {"a"}
+    time.sleep(0.3)
+    (stolen,) = fast.lease()
+    assert (stolen.unit_id, stolen.attempt) == ("a", 2)
+    assert not slow.complete("a")
+    assert fast.complete("a")
+
+    fast.fail("b", "boom")
+    (retry,) = slow.lease()
+    slow.fail(retry.unit_id, "boom")
+    assert fast.lease() == []
+    assert fast.counts() == {"pending": 0, "leased": 0, "done": 1, "failed": 1}
+    assert fast.to_frame().set_index("unit_id").loc["b", "state"] == FAILED
+
+
+def test_wait_lease_waits_for_a_held_lease_to_expire(tmp_path):
+    db_path = tmp_path / "queue.sqlite"
+    crashed = WorkQueue(db_path, lease_seconds=0.3, owner="crashed")
+    last = WorkQueue(db_path, lease_seconds=0.3, owner="last")
+    crashed.add([("a", {})])
+    (lease,) = crashed.lease()
+    assert last.lease() == []
+
+    t0 = time.monotonic()
+    (reclaimed,) = last.wait_lease(poll_seconds=0.05)
+    assert time.monotonic() - t0 >= 0.2
+    assert (reclaimed.unit_id, reclaimed.attempt) == ("a", 2)
+    assert last.complete("a")
+    # nothing pending or leased: finished, without waiting
+    assert last.wait_lease(poll_seconds=10) == []